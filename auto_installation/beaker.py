@@ -1,43 +1,358 @@
+import time
 import attr
 import json
+import shlex
+import functools
 import subprocess
-import time
 import logging
-from threading import Thread
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
+import requests
+from requests.adapters import HTTPAdapter
 from .cobbler import Cobbler
+from .constants import BKR_BACKEND, BKR_URL, BKR_CREDENTIAL, BKR_LOGIN_RETRY
 from .utils import ReserveUserWrongException, init_redis
 
 log = logging.getLogger("Beaker")
 
+# bkr commands running at once, in all and for the machines of one lab
+BKR_WORKERS = 16
+BKR_LAB_CONCURRENCY = 4
+# seconds the status of a machine is reused
+BKR_STATUS_TTL = 10
+
+
+def remove_cobbler_system(ch_name):
+    with Cobbler() as cb:
+        log.info("remove system %s from cobbler", ch_name)
+        cb.remove_system(ch_name)
+
 
 @attr.s
-class WatchInstallation(object):
+class InstallWaiter(object):
     ch_name = attr.ib()
-    p = attr.ib()
+    result = attr.ib(default=None)
+    event = attr.ib(default=attr.Factory(threading.Event), repr=False)
+    timer = attr.ib(default=None, repr=False)
+
+    def wait(self):
+        """Block until installation is done or failed
+
+        Returns:
+            ip of the installed host, or False when it failed or timed out
+        """
+        # no timeout here, python2 polls a timed wait, the timer of the
+        # watcher is what bounds it
+        self.event.wait()
+        return self.result
+
+
+@attr.s
+class InstallWatcher(object):
+    """Dispatch installation results published by /done to waiting jobs
+
+    One pubsub connection and one listener thread serve all machines,
+    every watched machine has its own timeout timer.
+    """
     redis_conn = attr.ib(default=init_redis())
+    timeout = attr.ib(default=1200)
+    on_done = attr.ib(default=remove_cobbler_system)
+    _waiters = attr.ib(default=attr.Factory(dict), repr=False)
+    _lock = attr.ib(default=attr.Factory(threading.Lock), repr=False)
+    _pubsub = attr.ib(default=None, repr=False)
+    _thread = attr.ib(default=None, repr=False)
 
-    def watch(self):
-        now = time.time()
+    def _listen(self, pubsub):
         while True:
-            msg = self.p.get_message(ignore_subscribe_messages=True)
-            log.info("waiting for installation message")
-            if msg:
-                log.info("get message from channel %s: %s", self.ch_name, msg)
-                with Cobbler() as cb:
-                    log.info("remove system %s from cobbler", self.ch_name)
-                    cb.remove_system(self.ch_name)
-                self.redis_conn.publish(self.ch_name, msg['data'])
+            try:
+                # messages are consumed by the channel handlers, listen()
+                # returns once the last channel is unsubscribed
+                for _ in pubsub.listen():
+                    pass
+            except Exception as e:
+                log.info("stop listening on installation channels: %s", e)
+                pubsub = None
+            with self._lock:
+                # a machine may have been watched since listen() returned
+                if pubsub is None or self._pubsub is not pubsub or \
+                        not self._waiters:
+                    if self._thread is threading.current_thread():
+                        self._thread = None
+                    return
+
+    def _handle(self, msg):
+        log.info("get message from channel %s: %s", msg['channel'],
+                 msg['data'])
+        if msg['data'].startswith('done'):
+            self._complete(msg['channel'], msg['data'].split(',')[1])
+        elif msg['data'] == 'fail':
+            self._complete(msg['channel'], False)
+
+    def _expire(self, ch_name, waiter):
+        log.error("provision job on %s is time-out after %ss", ch_name,
+                  self.timeout)
+        self._complete(ch_name, False, waiter=waiter, cleanup=False)
+
+    def _complete(self, ch_name, result, waiter=None, cleanup=True):
+        with self._lock:
+            if self._waiters.get(ch_name) is None or (
+                    waiter and self._waiters[ch_name] is not waiter):
+                return
+            waiter = self._waiters.pop(ch_name)
+            self._pubsub.unsubscribe(ch_name)
+        waiter.timer.cancel()
+
+        try:
+            if cleanup:
+                self.on_done(ch_name)
+        except Exception as e:
+            log.error(e)
+        finally:
+            waiter.result = result
+            waiter.event.set()
+
+    def watch(self, ch_name):
+        """Start waiting for the installation result of machine `ch_name`"""
+        waiter = InstallWaiter(ch_name)
+        waiter.timer = threading.Timer(self.timeout, self._expire,
+                                       [ch_name, waiter])
+        waiter.timer.setDaemon(True)
+
+        with self._lock:
+            self._waiters[ch_name] = waiter
+            if self._pubsub is None:
+                self._pubsub = self.redis_conn.pubsub(
+                    ignore_subscribe_messages=True)
+            self._pubsub.subscribe(**{ch_name: self._handle})
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._listen,
+                                                args=(self._pubsub, ))
+                self._thread.setDaemon(True)
+                self._thread.start()
+
+        waiter.timer.start()
+        log.info("waiting for installation message on channel %s", ch_name)
+        return waiter
+
+    def close(self):
+        with self._lock:
+            waiters, self._waiters = self._waiters.values(), {}
+            if self._pubsub is not None:
+                self._pubsub.close()
+            self._pubsub, self._thread = None, None
+        for waiter in waiters:
+            waiter.timer.cancel()
+            waiter.result = False
+            waiter.event.set()
+
+
+def lab_of(bkr_name):
+    """The lab of a machine, by the domain of its name"""
+    return bkr_name.split('.', 1)[-1]
+
+
+@attr.s
+class _Result(object):
+    value = attr.ib()
+
+    def get(self):
+        return self.value
+
+
+class _Future(object):
+    """The result of a command which may still wait for its lab"""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._value = None
+        self._error = None
+
+    def set(self, value=None, error=None):
+        self._value, self._error = value, error
+        self._done.set()
+
+    def get(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise threading.ThreadError("bkr command still running")
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+@attr.s
+class _Lab(object):
+    running = attr.ib(default=0)
+    waiting = attr.ib(default=attr.Factory(deque))
+
+
+@attr.s
+class BkrExecutor(object):
+    """Run bkr commands on a pool of threads
+
+    At most `per_lab` commands run at once for the machines of a lab, so
+    that a lab controller isn't flooded when many machines start together.
+    The others wait in the queue of their lab, not in a thread of the pool,
+    the pool stays free for the commands of the other labs.
+    A command run with a ttl, like the status of a machine, is shared by
+    the callers asking while it runs, and its output is reused for `ttl`
+    seconds.
+    """
+    workers = attr.ib(default=BKR_WORKERS)
+    per_lab = attr.ib(default=BKR_LAB_CONCURRENCY)
+    call = attr.ib(default=subprocess.call, repr=False)
+    check_output = attr.ib(default=subprocess.check_output, repr=False)
+    clock = attr.ib(default=time.time, repr=False)
+    _pool = attr.ib(default=None, repr=False)
+    _labs = attr.ib(default=attr.Factory(dict), repr=False)
+    _inflight = attr.ib(default=attr.Factory(dict), repr=False)
+    _cache = attr.ib(default=attr.Factory(dict), repr=False)
+    _lock = attr.ib(default=attr.Factory(threading.Lock), repr=False)
+
+    def run_argv(self, argv, output=False):
+        """Run `argv` in the calling thread"""
+        if output:
+            return self.check_output(argv)
+        try:
+            return self.call(argv)
+        except OSError as e:
+            # what the shell returned when bkr was missing
+            log.error("failed to run %s: %s", argv[0], e)
+            return 127
+
+    def _start(self, lab, task):
+        """Run `task` on the pool, must hold self._lock"""
+        if self._pool is None:
+            self._pool = ThreadPool(self.workers)
+        self._pool.apply_async(self._run, (lab, ) + task)
+
+    def _run(self, lab, key, argv, output, ttl, func, future):
+        ret, error = None, None
+        try:
+            ret = func() if func else self.run_argv(argv, output)
+        except Exception as e:
+            error = e
+        with self._lock:
+            self._inflight.pop(key, None)
+            if ttl and error is None:
+                self._cache[key] = (self.clock() + ttl, ret)
+            # the slot of the lab goes to the command waiting longest
+            if lab.waiting:
+                self._start(lab, lab.waiting.popleft())
+            else:
+                lab.running -= 1
+        future.set(ret, error)
+
+    def submit(self, argv, bkr_name, output=False, ttl=0, func=None):
+        """Start `argv` about machine `bkr_name`, return an object whose
+        get() waits for the return code, or the output if `output`.
+
+        `func` does the same as `argv` another way, it is called instead.
+        """
+        key = (tuple(argv), output)
+        with self._lock:
+            if ttl:
+                cached = self._cache.get(key)
+                if cached and cached[0] > self.clock():
+                    return _Result(cached[1])
+                if key in self._inflight:
+                    return self._inflight[key]
+            future = _Future()
+            if ttl:
+                self._inflight[key] = future
+            task = (key, argv, output, ttl, func, future)
+            lab = self._labs.setdefault(lab_of(bkr_name), _Lab())
+            if lab.running < self.per_lab:
+                lab.running += 1
+                self._start(lab, task)
+            else:
+                lab.waiting.append(task)
+        return future
+
+
+bkr_executor = BkrExecutor()
+
+
+class BkrUnavailable(Exception):
+    """The beaker server can't take the call, the bkr client may"""
+
+
+@attr.s
+class BkrSession(object):
+    """Http session logged in to the beaker server, shared by all jobs
+
+    A bkr command starts an interpreter and logs in every time, the
+    session only logs in again when the server forgets it.
+    """
+    url = attr.ib(default=BKR_URL)
+    credential = attr.ib(default=BKR_CREDENTIAL)
+    timeout = attr.ib(default=60)
+    login_retry = attr.ib(default=BKR_LOGIN_RETRY)
+    _session = attr.ib(default=None, repr=False)
+    _failed_ts = attr.ib(default=None, repr=False)
+    _lock = attr.ib(default=attr.Factory(threading.Lock), repr=False)
+
+    def _login(self):
+        if (self._failed_ts is not None and
+                time.time() - self._failed_ts < self.login_retry):
+            raise BkrUnavailable("login to {} failed lately".format(self.url))
+        session = requests.Session()
+        # a connection for each thread of the executor
+        session.mount(self.url, HTTPAdapter(pool_maxsize=BKR_WORKERS))
+        try:
+            r = session.post(
+                self.url + '/login', timeout=self.timeout,
+                data=dict(user_name=self.credential[0],
+                          password=self.credential[1]))
+            r.raise_for_status()
+        except requests.RequestException as e:
+            self._failed_ts = time.time()
+            raise BkrUnavailable("login to {} failed: {}".format(self.url, e))
+        self._failed_ts = None
+        self._session = session
+        return session
+
+    def _get_session(self, relogin=False):
+        """Return the session, and whether it was logged in just now"""
+        with self._lock:
+            if self._session is None or relogin:
+                return self._login(), True
+            return self._session, False
+
+    def _login_failed(self):
+        with self._lock:
+            self._failed_ts = time.time()
+            self._session = None
+
+    def request(self, method, path, **kwargs):
+        """Return the response to `path`, 4xx ones included. Raise
+        BkrUnavailable when the server can't be asked"""
+        relogin = False
+        for _ in range(2):
+            session, fresh = self._get_session(relogin)
+            try:
+                r = session.request(method, self.url + path,
+                                    timeout=self.timeout, **kwargs)
+            except requests.RequestException as e:
+                raise BkrUnavailable(e)
+            if r.status_code != 401:
                 break
-            elif (time.time() - now > 1200):
-                log.error("provision job is time-out after 20min")
-                self.redis_conn.publish(self.ch_name, 'fail')
+            if fresh:
+                # the server turns the session down right after the login,
+                # logging in again won't help for a while
+                self._login_failed()
                 break
-            time.sleep(10)
+            relogin = True
+        if r.status_code == 401 or r.status_code >= 500:
+            raise BkrUnavailable("{} {}: {}".format(method, path,
+                                                    r.status_code))
+        return r
 
 
-def inst_watcher(ch_name, p):
-    ins = WatchInstallation(ch_name, p)
-    return Thread(target=ins.watch)
+bkr_session = BkrSession()
+
+# the rest calls doing what a bkr command does, provision stays with bkr
+_POWER_ACTIONS = dict(power_on='on', power_off='off', reboot='reboot')
 
 
 @attr.s
@@ -70,15 +385,57 @@ class Beaker(object):
     srv_ip = attr.ib(default="0.0.0.0")
     srv_port = attr.ib(default=5000)
     ks_file = attr.ib(default="")
+    backend = attr.ib(default=BKR_BACKEND)
+    executor = attr.ib(default=bkr_executor, repr=False)
+    session = attr.ib(default=bkr_session, repr=False)
 
-    def _exec_cmd(self, cmd, bkr_name, args, output=False):
-        _cmd = self.CMDs[cmd].format(**args)
-        if not output:
-            ret = subprocess.call(_cmd, shell=True)
-            return ret
-        else:
-            ret = subprocess.check_output(_cmd, shell=True)
-            return ret
+    def _rest(self, cmd, bkr_name):
+        system = '/systems/{}'.format(bkr_name)
+        if cmd == 'status':
+            return self.session.request('GET', system + '/status')
+        elif cmd == 'reserve':
+            return self.session.request('POST', system + '/reservations/',
+                                        json={})
+        elif cmd == 'release':
+            return self.session.request(
+                'PATCH', system + '/reservations/+current',
+                json=dict(finish_time='now'))
+        elif cmd == 'clear_netboot':
+            return self.session.request(
+                'POST', system + '/commands/',
+                json=dict(action='none', clear_netboot=True))
+        return self.session.request(
+            'POST', system + '/commands/',
+            json=dict(action=_POWER_ACTIONS[cmd]))
+
+    def _call_rest(self, cmd, bkr_name, argv, output):
+        """Do `cmd` over the session, as the bkr command `argv` would do
+        it, or run `argv` if the server can't be asked"""
+        try:
+            r = self._rest(cmd, bkr_name)
+        except BkrUnavailable as e:
+            log.warning("%s of %s falls back to bkr: %s", cmd, bkr_name, e)
+            return self.executor.run_argv(argv, output)
+        if r.status_code >= 400:
+            log.error("%s of %s failed: %s %s", cmd, bkr_name,
+                      r.status_code, r.text)
+            if output:
+                raise subprocess.CalledProcessError(1, argv, r.text)
+            return 1
+        return r.text if output else 0
+
+    def submit(self, cmd, bkr_name, args=None, output=False, ttl=0):
+        """Start `cmd` on the bkr executor, see BkrExecutor.submit"""
+        argv = shlex.split(self.CMDs[cmd].format(
+            **(args or dict(bkr_name=bkr_name))))
+        func = None
+        if self.backend == 'rest' and cmd != 'provision':
+            func = functools.partial(self._call_rest, cmd, bkr_name, argv,
+                                     output)
+        return self.executor.submit(argv, bkr_name, output, ttl, func)
+
+    def _exec_cmd(self, cmd, bkr_name, args, output=False, ttl=0):
+        return self.submit(cmd, bkr_name, args, output, ttl).get()
 
     def power_on(self, bkr_name):
         """pass"""
@@ -115,7 +472,8 @@ class Beaker(object):
     def status(self, bkr_name):
         """pass"""
         ret = self._exec_cmd(
-            'status', bkr_name, dict(bkr_name=bkr_name), output=True)
+            'status', bkr_name, dict(bkr_name=bkr_name), output=True,
+            ttl=BKR_STATUS_TTL)
         data = json.loads(ret)
         if data['current_reservation']:
             if data['current_reservation']['user_name'] == 'yaniwang':
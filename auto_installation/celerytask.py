@@ -22,9 +22,12 @@ class RhvhTask(object):
     def simple(self):
         self.c.send_task('tasker.tasks.add', (2, 2))
 
-    def lanuchAuto(self, build_name, pxe, ts_level, target_build):
+    def lanuchAuto(self, build_name, pxe, ts_level, target_build,
+                   job_id=None):
+        # the task is known by the id of its job, it passes it to /start
         self.c.send_task('tasker.rhvh_auto.launch_autotesting',
-                         (build_name, pxe, ts_level, target_build))
+                         (build_name, pxe, ts_level, target_build),
+                         task_id=job_id)
 
     def lanuchCockpitAuto(self):
         self.c.send_task('tasker.rhvh_auto.launch_cockpit')
@@ -1,12 +1,26 @@
 import logging
-from fabric.api import settings, run, get, put
-from fabric.exceptions import NetworkError, CommandTimeout
 import re
-from utils import get_checkpoint_cases_map
+import time
+import uuid
+import threading
+from multiprocessing.pool import ThreadPool
+from utils import get_checkpoint_cases_map, log_router
+from sshpool import get_connection, CommandTimeout
+from constants import CHECKPOINT_WORKERS
+import checkresults
+import poll
 
 log = logging.getLogger('bender')
 
 
+def readonly_checkpoint(func):
+    """Mark a checkpoint which only reads from the host, it may run at the
+    same time as other read-only checkpoints
+    """
+    func.readonly = True
+    return func
+
+
 class CheckYoo(object):
     """"""
 
@@ -16,6 +30,10 @@ class CheckYoo(object):
         self._host_pass = None
         self._ksfile = None
         self._beaker_name = None
+        self.durations = {}  # {checkpoint: seconds}
+        self.timings = {}  # {checkpoint: (started, finished)}
+        # facts of the host saved with the results, e.g. its iqn
+        self.run_info = {}
 
     @property
     def host_string(self):
@@ -58,50 +76,79 @@ class CheckYoo(object):
     def ksfile(self, val):
         self._ksfile = val
 
+    @property
+    def conn(self):
+        return get_connection(self.host_string, self.host_user,
+                              self.host_pass)
+
+    def disconnect(self):
+        self.conn.close()
+
     def get_remote_file(self, remote_path, local_path):
-        with settings(
-                host_string=self.host_string,
-                user=self.host_user,
-                password=self.host_pass,
-                disable_known_hosts=True,
-                connection_attempts=120):
-            ret = get(remote_path, local_path)
-            if not ret.succeeded:
-                raise ValueError("Can't get {} from remote server:{}.".format(
-                    remote_path, self.host_string))
+        try:
+            self.conn.get(remote_path, local_path)
+        except Exception as e:
+            raise ValueError("Can't get {} from remote server:{}, {}".format(
+                remote_path, self.host_string, e))
 
     def put_remote_file(self, local_path, remote_path):
-        with settings(
-                host_string=self.host_string,
-                user=self.host_user,
-                password=self.host_pass,
-                disable_known_hosts=True,
-                connection_attempts=120):
-            ret = put(local_path, remote_path)
-            if not ret.succeeded:
-                raise ValueError("Can't put {} to remote server:{}.".format(
-                    local_path, self.host_string))
+        try:
+            self.conn.put(local_path, remote_path)
+        except Exception as e:
+            raise ValueError("Can't put {} to remote server:{}, {}".format(
+                local_path, self.host_string, e))
 
     def run_cmd(self, cmd, timeout=60):
         ret = None
         try:
-            with settings(
-                    host_string=self.host_string,
-                    user=self.host_user,
-                    password=self.host_pass,
-                    disable_known_hosts=True,
-                    connection_attempts=60):
-                ret = run(cmd, quiet=True, timeout=timeout)
-                if ret.succeeded:
-                    log.info('Run cmd "%s" succeeded', cmd)
-                    return True, ret
-                else:
-                    log.error('Run cmd "%s" failed', cmd)
-                    return False, ret
+            ret = self.conn.run(cmd, timeout=timeout)
+            if ret.succeeded:
+                log.info('Run cmd "%s" succeeded', cmd)
+                return True, ret
+            else:
+                log.error('Run cmd "%s" failed', cmd)
+                return False, ret
         except Exception as e:
             log.error('Run cmd "%s" failed with exception "%s"', cmd, e)
             return False, e
 
+    def run_cmds(self, cmds, timeout=60):
+        """Run cmds in one remote script, so all of them cost a single
+        ssh round trip. Return a list of (succeeded, output) in the order of
+        cmds, like run_cmd does for one command.
+        """
+        marker = 'BENDER-{}'.format(uuid.uuid4().hex)
+        script = '\n'.join(
+            "( {} ) ; printf '\\n{} %d\\n' $?".format(cmd, marker)
+            for cmd in cmds)
+
+        # each command is logged with its own result below
+        try:
+            output = self.conn.run(script, timeout=timeout)
+        except Exception as e:
+            log.error('Run cmds %s failed with exception "%s"', cmds, e)
+            return [(False, e)] * len(cmds)
+
+        results = []
+        # output, exit status, output, ..., what follows the last marker
+        parts = re.split(r'\r?\n?{} (\d+)\r?\n?'.format(marker), output)
+        for i, cmd in enumerate(cmds):
+            if 2 * i + 1 >= len(parts):
+                # the script was cut short, e.g. killed by a timeout
+                log.error('Run cmd "%s" got no result', cmd)
+                rest = parts[2 * i] if 2 * i < len(parts) else ''
+                results.append((False, rest.strip()))
+                continue
+            output = parts[2 * i].strip()
+            succeeded = parts[2 * i + 1] == '0'
+            if succeeded:
+                log.info('Run cmd "%s" succeeded', cmd)
+            else:
+                log.error('Run cmd "%s" failed', cmd)
+            results.append((succeeded, output))
+
+        return results
+
     def check_strs_in_file(self, fp, strs, timeout):
         log.info("start to check if %s in %s", strs, fp)
         try:
@@ -170,11 +217,21 @@ class CheckYoo(object):
     def call_func_by_name(self, name=''):
         func = getattr(self, name.lower(), None)
         if func:
-            return func()
+            start = time.time()
+            try:
+                return func()
+            finally:
+                end = time.time()
+                self.durations[name] = end - start
+                self.timings[name] = (start, end)
         else:
             raise NameError(
                 'The checkpoint function {} is not defined'.format(name))
 
+    def is_readonly(self, checkpoint):
+        func = getattr(self, checkpoint.lower(), None)
+        return getattr(func, 'readonly', False)
+
     def run_checkpoint(self, checkpoint, cases, cks):
         try:
             log.info("Start to run checkpoint:%s for cases:%s", checkpoint, cases)
@@ -190,6 +247,53 @@ class CheckYoo(object):
         finally:
             log.info("Run checkpoint:%s for cases:%s finished.", checkpoint, cases)
 
+    def _run_readonly_checkpoints(self, checkpoint_cases, cks):
+        if len(checkpoint_cases) < 2:
+            for checkpoint, cases in checkpoint_cases:
+                self.run_checkpoint(checkpoint, cases, cks)
+            return
+
+        owner = threading.current_thread().ident
+        scope = poll.current_scope()
+
+        def run(item):
+            # keep logging into the log file of the ks being checked
+            log_router.share(owner)
+            poll.bind_scope(scope)
+            try:
+                self.run_checkpoint(item[0], item[1], cks)
+            finally:
+                poll.unbind_scope()
+                log_router.unshare()
+
+        pool = ThreadPool(min(CHECKPOINT_WORKERS, len(checkpoint_cases)))
+        try:
+            pool.map(run, checkpoint_cases)
+        finally:
+            pool.close()
+            pool.join()
+
+    def run_checkpoints(self, checkpoint_cases, cks):
+        """Run the (checkpoint, cases) list in order, except that a run of
+        consecutive read-only checkpoints is done at the same time
+        """
+        start = time.time()
+        batch = []
+        for checkpoint, cases in checkpoint_cases:
+            if self.is_readonly(checkpoint):
+                batch.append((checkpoint, cases))
+                continue
+            self._run_readonly_checkpoints(batch, cks)
+            batch = []
+            self.run_checkpoint(checkpoint, cases, cks)
+        self._run_readonly_checkpoints(batch, cks)
+
+        for checkpoint, secs in sorted(
+                self.durations.items(), key=lambda item: -item[1]):
+            log.info("Checkpoint %s took %.2fs", checkpoint, secs)
+        log.info("All checkpoints took %.2fs, %.2fs if run one by one",
+                 time.time() - start, sum(self.durations.values()))
+
     def run_cases(self):
         cks = {}
         try:
@@ -200,14 +304,16 @@ class CheckYoo(object):
             # run check
             log.info("Start to run check points, please wait...")
 
-            roll_back_cases = None
-            for checkpoint, cases in checkpoint_cases_map.items():
-                if checkpoint == "roll_back_check":
-                    roll_back_cases = cases
-                    continue
-                self.run_checkpoint(checkpoint, cases, cks)
+            # read-only checkpoints go first so they are run as one batch,
+            # roll back changes the system so it is always the last one
+            roll_back_cases = checkpoint_cases_map.pop("roll_back_check", None)
+            checkpoint_cases = sorted(
+                checkpoint_cases_map.items(),
+                key=lambda item: not self.is_readonly(item[0]))
             if roll_back_cases:
-                self.run_checkpoint("roll_back_check", roll_back_cases, cks)
+                checkpoint_cases.append(("roll_back_check", roll_back_cases))
+
+            self.run_checkpoints(checkpoint_cases, cks)
         except Exception as e:
             log.error(e)
 
@@ -216,6 +322,31 @@ class CheckYoo(object):
     def go_check(self):
         pass
 
+    def save_results(self, results_file, cks, started):
+        """Append `cks`, the results of go_check, to the json-lines results
+        of the ks, see checkresults"""
+        run_id = uuid.uuid4().hex
+        checkpoint_of = {}
+        for checkpoint, cases in get_checkpoint_cases_map(
+                self.ksfile, self.beaker_name).items():
+            for case in cases:
+                checkpoint_of[case] = checkpoint
+
+        records = []
+        for case, status in sorted(cks.items()):
+            checkpoint = checkpoint_of.get(case)
+            ck_started, ck_finished = self.timings.get(checkpoint,
+                                                       (None, None))
+            records.append(dict(run=run_id, case=case, checkpoint=checkpoint,
+                                status=status, started=ck_started,
+                                finished=ck_finished,
+                                duration=self.durations.get(checkpoint)))
+
+        run = dict(self.run_info, run=run_id, ks=self.ksfile,
+                   machine=self.beaker_name, started=started,
+                   finished=time.time(), total=len(records))
+        checkresults.write_run(results_file, run, records)
+
 
 
 if __name__ == '__main__':
@@ -1,9 +1,9 @@
 import logging
-from fabric.network import disconnect_all
 import re
 import os
 import pickle
-from check_comm import CheckYoo
+from check_comm import CheckYoo, readonly_checkpoint
+from sshpool import CommandTimeout
 from constants import PROJECT_ROOT, DELL_PET105_01, DELL_PER510_01
 
 log = logging.getLogger('bender')
@@ -19,19 +19,21 @@ class CheckInstall(CheckYoo):
     """"""
 
     def __init__(self):
+        super(CheckInstall, self).__init__()
         self._checkdata_map = None
 
     def _set_checkdata_map(self):
         log.info("Start to read %s", REMOTE_CHECKDATA_MAP_PKL)
 
+        # hosts are checked in parallel, each one needs its own local copy
+        local_pkl = '{}.{}'.format(LOCAL_CHECKDATA_MAP_PKL, self.host_string)
         try:
-            if os.path.exists(LOCAL_CHECKDATA_MAP_PKL):
-                os.system('rm -f {}'.format(LOCAL_CHECKDATA_MAP_PKL))
+            if os.path.exists(local_pkl):
+                os.remove(local_pkl)
 
-            self.get_remote_file(REMOTE_CHECKDATA_MAP_PKL,
-                                 LOCAL_CHECKDATA_MAP_PKL)
+            self.get_remote_file(REMOTE_CHECKDATA_MAP_PKL, local_pkl)
 
-            fp = open(LOCAL_CHECKDATA_MAP_PKL, 'rb')
+            fp = open(local_pkl, 'rb')
             self._checkdata_map = pickle.load(fp)
             fp.close()
 
@@ -94,17 +96,14 @@ class CheckInstall(CheckYoo):
         return self.match_strs_in_cmd_output(cmd, patterns, timeout=300)
 
     def _check_recommended_swap_size(self):
-        cmd = "free -g | grep Mem | sed -r 's/\s*Mem:\s*([0-9]+)\s*.*/\\1/'"
-        ret = self.run_cmd(cmd, timeout=300)
-        if ret[0]:
-            memtotal = int(ret[1])
-        else:
-            return False
-
-        cmd = "free -g |grep Swap | sed -r 's/\s*Swap:\s*([0-9]+)\s*.*/\\1/'"
-        ret = self.run_cmd(cmd, timeout=300)
-        if ret[0]:
-            swap = int(ret[1])
+        cmds = [
+            "free -g | grep Mem | sed -r 's/\s*Mem:\s*([0-9]+)\s*.*/\\1/'",
+            "free -g |grep Swap | sed -r 's/\s*Swap:\s*([0-9]+)\s*.*/\\1/'"
+        ]
+        ret_mem, ret_swap = self.run_cmds(cmds, timeout=300)
+        if ret_mem[0] and ret_swap[0]:
+            memtotal = int(ret_mem[1])
+            swap = int(ret_swap[1])
         else:
             return False
 
@@ -241,11 +240,13 @@ class CheckInstall(CheckYoo):
 
         return True
 
+    @readonly_checkpoint
     def install_check(self):
         patterns = [r'^Status: OK']
         return self.match_strs_in_cmd_output(
             'nodectl check', patterns, timeout=300)
 
+    @readonly_checkpoint
     def partition_check(self):
         ck01 = self._check_parts_mnt_fstype()
         ck02 = self._check_parts_size()
@@ -253,6 +254,7 @@ class CheckInstall(CheckYoo):
 
         return ck01 and ck02
 
+    @readonly_checkpoint
     def static_network_check(self):
         device_data_map = self._checkdata_map.get('network').get('static')
         nic_device = device_data_map.get('DEVICE')
@@ -273,6 +275,7 @@ class CheckInstall(CheckYoo):
 
         return ck01 and ck02 and ck03 and ck04
 
+    @readonly_checkpoint
     def bond_check(self):
         device_data_map = self._checkdata_map.get('network').get('bond')
         bond_device = device_data_map.get('DEVICE')
@@ -284,6 +287,7 @@ class CheckInstall(CheckYoo):
 
         return ck01 and ck02 and ck03
 
+    @readonly_checkpoint
     def vlan_check(self):
         device_data_map = self._checkdata_map.get('network').get('vlan')
         vlan_device = device_data_map.get('DEVICE')
@@ -293,11 +297,13 @@ class CheckInstall(CheckYoo):
 
         return ck01 and ck02
 
+    @readonly_checkpoint
     def bond_vlan_check(self):
         ck01 = self.bond_check()
         ck02 = self.vlan_check()
         return ck01 and ck02
 
+    @readonly_checkpoint
     def nic_stat_dur_install_check(self):
         device_data_map = self._checkdata_map.get('network').get('nic')
         nic_device = device_data_map.get('DEVICE')
@@ -310,6 +316,7 @@ class CheckInstall(CheckYoo):
 
         return ck01 and ck02 and ck03
 
+    @readonly_checkpoint
     def dhcp_network_check(self):
         device_data_map = self._checkdata_map.get('network').get('dhcp')
         nic_device = device_data_map.get('DEVICE')
@@ -319,20 +326,24 @@ class CheckInstall(CheckYoo):
 
         return ck01 and ck02
 
+    @readonly_checkpoint
     def hostname_check(self):
         hostname = self._checkdata_map.get('network').get('hostname')
         return self.check_strs_in_cmd_output(
             'hostname', [hostname], timeout=300)
 
+    @readonly_checkpoint
     def lang_check(self):
         lang = self._checkdata_map.get('lang')
         return self.check_strs_in_cmd_output(
             'localectl status', [lang], timeout=300)
 
+    @readonly_checkpoint
     def ntp_check(self):
         ntp = self._checkdata_map.get('ntpservers')
         return self.check_strs_in_file('/etc/chrony.conf', [ntp], timeout=300)
 
+    @readonly_checkpoint
     def keyboard_check(self):
         vckey = self._checkdata_map.get('keyboard').get('vckeymap')
         xlayouts = self._checkdata_map.get('keyboard').get('xlayouts')
@@ -341,16 +352,19 @@ class CheckInstall(CheckYoo):
             ['VC Keymap: {}'.format(vckey), 'X11 Layout: {}'.format(xlayouts)],
             timeout=300)
 
+    @readonly_checkpoint
     def security_policy_check(self):
         return self.check_strs_in_cmd_output(
             'ls /root', ['openscap_data'], timeout=300)
 
+    @readonly_checkpoint
     def kdump_check(self):
         reserve_mb = self._checkdata_map.get('kdump').get('reserve-mb')
         return self.check_strs_in_file(
             '/etc/grub2.cfg', ['crashkernel={}M'.format(reserve_mb)],
             timeout=300)
 
+    @readonly_checkpoint
     def users_check(self):
         username = self._checkdata_map.get('user').get('name')
         ck01 = self.check_strs_in_file('/etc/passwd', [username], timeout=300)
@@ -359,26 +373,31 @@ class CheckInstall(CheckYoo):
             'ls /home', [username], timeout=300)
         return ck01 and ck02 and ck03
 
+    @readonly_checkpoint
     def firewall_check(self):
         return self.check_strs_in_cmd_output(
             'firewall-cmd --state', ['running'], timeout=300)
 
+    @readonly_checkpoint
     def selinux_check(self):
         selinux_status = self._checkdata_map.get('selinux')
         strs = 'SELINUX={}'.format(selinux_status)
         return self.check_strs_in_file(
             '/etc/selinux/config', [strs], timeout=300)
 
+    @readonly_checkpoint
     def sshd_check(self):
         return self.check_strs_in_cmd_output(
             'systemctl status sshd', ['running'], timeout=300)
 
+    @readonly_checkpoint
     def grubby_check(self):
         checkstr = self._checkdata_map.get('grubby')
 
         return self.check_strs_in_cmd_output(
             'grubby --info=0', [checkstr], timeout=300)
 
+    @readonly_checkpoint
     def bootloader_check(self):
         boot_device = self._checkdata_map.get('bootdevice')
         cmd = 'dd if={} bs=512 count=1 2>&1 | strings |grep -i grub'.format(
@@ -386,13 +405,28 @@ class CheckInstall(CheckYoo):
 
         return self.check_strs_in_cmd_output(cmd, ['GRUB'], timeout=300)
 
+    @readonly_checkpoint
     def fips_check(self):
         return self.check_strs_in_file(
             '/proc/sys/crypto/fips_enabled', ['1'], timeout=300)
 
+    @readonly_checkpoint
     def iqn_check(self):
-        return self.check_strs_in_file(
-            '/etc/iscsi/initiatorname.iscsi', ['iqn'], timeout=300)
+        fp = '/etc/iscsi/initiatorname.iscsi'
+        log.info("start to check if %s in %s", ['iqn'], fp)
+        try:
+            ret = self.run_cmd('cat {}'.format(fp), timeout=300)
+            log.info("Got result %s", ret)
+        except CommandTimeout as e:
+            log.error(e)
+            return False
+
+        if not ret[0] or 'iqn' not in ret[1]:
+            log.error("can not found iqn in %s", fp)
+            return False
+        # the reports make sure every install got its own iqn
+        self.run_info['iqn'] = ret[1].strip().split('=', 1)[-1]
+        return True
 
     def layout_init_check(self):
         resstr = (
@@ -407,7 +441,6 @@ class CheckInstall(CheckYoo):
         return False
 
     def go_check(self):
-        disconnect_all()
         if self._set_checkdata_map():
             cks = self.run_cases()
         else:
@@ -3,8 +3,7 @@ import requests
 import os
 import time
 import re
-from fabric.network import disconnect_all
-from check_comm import CheckYoo
+from check_comm import CheckYoo, readonly_checkpoint
 from constants import KS_FILES_DIR, DELL_PET105_01, DELL_PER510_01, DELL_PER515_01
 from const_upgrade import CHECK_NEW_LVS, RHVM_DATA_MAP, \
     RHVH_UPDATE_RPM_URL, \
@@ -13,6 +12,7 @@ from const_upgrade import CHECK_NEW_LVS, RHVM_DATA_MAP, \
     CHK_HOST_ON_RHVM_STAT_MAXCOUNT, CHK_HOST_ON_RHVM_STAT_INTERVAL, \
     ENTER_SYSTEM_MAXCOUNT, ENTER_SYSTEM_INTERVAL, ENTER_SYSTEM_TIMEOUT
 from rhvmapi import RhevmAction
+from poll import poll
 from __builtin__ import False
 
 log = logging.getLogger('bender')
@@ -22,6 +22,7 @@ class CheckUpgrade(CheckYoo):
     """"""
 
     def __init__(self):
+        super(CheckUpgrade, self).__init__()
         self._source_build = None
         self._target_build = None
         self._update_rpm_path = None
@@ -514,7 +515,8 @@ class CheckUpgrade(CheckYoo):
         log.info("Start to check ovirt-imageio-daemon status.")
 
         cmd = "systemctl status ovirt-imageio-daemon.service | grep 'Active: active' --color=never"
-        ret = self.run_cmd(cmd, timeout=FABRIC_TIMEOUT)
+        cmd2 = "ls -ld /var/log/ovirt-imageio-daemon/"
+        ret, ret2 = self.run_cmds([cmd, cmd2], timeout=FABRIC_TIMEOUT)
         if not ret[0]:
             log.error(
                 'Check ovirt-imageio-daemon status failed. The result of "%s" is %s',
@@ -528,8 +530,7 @@ class CheckUpgrade(CheckYoo):
             log.info('ovirt-imageio-daemon is not active.')
             ret01 = False
 
-        cmd = "ls -ld /var/log/ovirt-imageio-daemon/"
-        ret = self.run_cmd(cmd, timeout=FABRIC_TIMEOUT)
+        cmd, ret = cmd2, ret2
         if not ret[0]:
             log.error(
                 'Check ovirt-imageio-daemon owership failed. The result of "%s" is %s',
@@ -546,25 +547,21 @@ class CheckUpgrade(CheckYoo):
     def _check_boot_dmesg_log(self):
         log.info("Start to check /var/log/boot.log and /var/log/dmesg.")
 
-        cmd = "egrep -i 'error|fail' /var/log/boot.log --color=never"
-        ret = self.run_cmd(cmd, timeout=FABRIC_TIMEOUT)
-        log.info('The result of "%s" is %s', cmd, ret[1])
-        if ret[1].strip(' ') != '':
-            log.info('There are error or fail info in /var/log/boot.log')
-            ret01 = False
-        else:
-            ret01 = True
+        log_files = ["/var/log/boot.log", "/var/log/dmesg"]
+        cmds = [
+            "egrep -i 'error|fail' {} --color=never".format(fp)
+            for fp in log_files
+        ]
+        rets = self.run_cmds(cmds, timeout=FABRIC_TIMEOUT)
 
-        cmd = "egrep -i 'error|fail' /var/log/dmesg --color=never"
-        ret = self.run_cmd(cmd, timeout=FABRIC_TIMEOUT)
-        log.info('The result of "%s" is %s', cmd, ret[1])
-        if ret[1].strip(' ') != '':
-            log.info('There are error or fail info in /var/log/dmesg')
-            ret02 = False
-        else:
-            ret02 = True
+        ret_all = True
+        for fp, cmd, ret in zip(log_files, cmds, rets):
+            log.info('The result of "%s" is %s', cmd, ret[1])
+            if str(ret[1]).strip(' ') != '':
+                log.info('There are error or fail info in %s', fp)
+                ret_all = False
 
-        return ret01 and ret02
+        return ret_all
 
     def _check_separate_volumes(self):
         log.info("Start to check /var /var/log /var/log/audit /tmp /home on separate volumes .")
@@ -754,12 +751,14 @@ class CheckUpgrade(CheckYoo):
 
         return ck01 and ck02 and ck03 and ck04 and ck05
 
+    @readonly_checkpoint
     def packages_check(self):
         ck01 = self._check_imgbased_ver()
         ck02 = self._check_update_ver()
 
         return ck01 and ck02
 
+    @readonly_checkpoint
     def settings_check(self):
         ck01 = self.check_strs_in_file(
             self._add_file_name, [self._add_file_content],
@@ -825,12 +824,14 @@ class CheckUpgrade(CheckYoo):
         else:
             return False
 
+    @readonly_checkpoint
     def cmds_check(self):
         ck01 = self._check_lvs()
         ck02 = self._check_findmnt()
 
         return ck01 and ck02
 
+    @readonly_checkpoint
     def signed_check(self):
         cmd = "rpm -qa --qf '%{{name}}-%{{version}}-%{{release}}.%{{arch}} (%{{SIGPGP:pgpsig}})\n' | " \
             "grep -v 'Key ID' | " \
@@ -845,6 +846,7 @@ class CheckUpgrade(CheckYoo):
 
         return True
 
+    @readonly_checkpoint
     def knl_space_rpm_check(self):
         if "-4.0-" in self.source_build:
             raise RuntimeError(
@@ -857,6 +859,7 @@ class CheckUpgrade(CheckYoo):
                 "The source build is 4.0, no need to check user space rpm.")
         return self._check_user_space_rpm()
 
+    @readonly_checkpoint
     def avc_denied_check(self):
         log.info("Start to check avc denied errors.")
 
@@ -876,6 +879,7 @@ class CheckUpgrade(CheckYoo):
 
         return True
 
+    @readonly_checkpoint
     def iptables_status_check(self):
         ck01 = self._check_iptables_status()
         ck02 = self._check_firewalld_status()
@@ -885,18 +889,23 @@ class CheckUpgrade(CheckYoo):
     def ntpd_status_check(self):
         return self._check_ntpd_status()
 
+    @readonly_checkpoint
     def sysstat_check(self):
         return self._check_sysstat()
 
+    @readonly_checkpoint
     def ovirt_imageio_daemon_check(self):
         return self._check_ovirt_imageio_daemon_status()
 
+    @readonly_checkpoint
     def boot_dmesg_log_check(self):
         return self._check_boot_dmesg_log()
 
+    @readonly_checkpoint
     def separate_volumes_check(self):
         return self._check_separate_volumes()
 
+    @readonly_checkpoint
     def etc_var_file_update_check(self):
         ck01 = self.check_strs_in_file(
             self._add_file_name, [self._add_file_content],
@@ -953,11 +962,13 @@ class CheckUpgrade(CheckYoo):
 
     ## added by wujian, upgrade tier2 checks
     # 1-fips check
+    @readonly_checkpoint
     def fips_check(self):
         return self.check_strs_in_file(
             '/proc/sys/crypto/fips_enabled', ['1'], timeout=300)
 
     # 2-check kdump.service =active
+    @readonly_checkpoint
     def kdump_check(self):
         return self._check_kdump_status()
 
@@ -1486,14 +1497,15 @@ class CheckUpgrade(CheckYoo):
 
         log.info("Check host status on rhvm.")
 
-        count = 0
-        while (count < CHK_HOST_ON_RHVM_STAT_MAXCOUNT):
+        def host_is_up():
             host = self._rhvm.list_host(key="name", value=self._host_name)
-            if host and host.get('status') == 'up':
-                break
-            count = count + 1
-            time.sleep(CHK_HOST_ON_RHVM_STAT_INTERVAL)
-        else:
+            return host and host.get('status') == 'up'
+
+        if not poll(host_is_up,
+                    CHK_HOST_ON_RHVM_STAT_MAXCOUNT *
+                    CHK_HOST_ON_RHVM_STAT_INTERVAL,
+                    name='host up on rhvm', interval=5,
+                    max_interval=CHK_HOST_ON_RHVM_STAT_INTERVAL):
             log.error("Host is not up on rhvm.")
             return False
         log.info("Host is up on rhvm.")
@@ -1506,15 +1518,18 @@ class CheckUpgrade(CheckYoo):
             cmd = "systemctl reboot"
             self.run_cmd(cmd, timeout=10)
 
-        disconnect_all()
-        count = 0
-        while (count < ENTER_SYSTEM_MAXCOUNT):
-            time.sleep(ENTER_SYSTEM_INTERVAL)
-            ret = self.run_cmd("imgbase w", timeout=ENTER_SYSTEM_TIMEOUT)
-            if not ret[0]:
-                count = count + 1
-            else:
-                break
+        self.disconnect()
+        rets = []
+
+        def system_is_up():
+            rets.append(self.run_cmd("imgbase w", timeout=ENTER_SYSTEM_TIMEOUT))
+            return rets[-1][0]
+
+        # the first try waits for the host to go down for the reboot
+        poll(system_is_up, ENTER_SYSTEM_MAXCOUNT * ENTER_SYSTEM_INTERVAL,
+             name='system up after reboot', delay=ENTER_SYSTEM_INTERVAL,
+             interval=10, max_interval=ENTER_SYSTEM_INTERVAL)
+        ret = rets[-1]
 
         log.info("Reboot and log into system finished.")
         return ret
@@ -1697,8 +1712,9 @@ class CheckUpgrade(CheckYoo):
             "bond_ip": "ip -f inet addr show | grep 'inet 10' | awk '{print $2}'|awk -F '/' '{print $1}'",
         }
 
-        for k, v in cmdmap.items():
-            ret = self.run_cmd(v, timeout=FABRIC_TIMEOUT)
+        keys = cmdmap.keys()
+        rets = self.run_cmds([cmdmap[k] for k in keys], timeout=FABRIC_TIMEOUT)
+        for k, ret in zip(keys, rets):
             if ret[0]:
                 check_infos[k] = ret[1]
                 log.info("***%s***:\n%s", k, ret[1])
@@ -1709,7 +1725,6 @@ class CheckUpgrade(CheckYoo):
         return True
 
     def go_check(self):
-        disconnect_all()
         cks = {}
         try:
             if not self._collect_infos('old'):
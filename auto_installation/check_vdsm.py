@@ -2,9 +2,10 @@ import logging
 import re
 import time
 import functools
-from fabric.api import settings, run, local
-from fabric.network import disconnect_all
-from check_comm import CheckYoo
+from fabric.api import local
+from sshpool import get_connection
+from poll import poll
+from check_comm import CheckYoo, readonly_checkpoint
 from utils import get_checkpoint_cases_map
 from vdsmapi import RhevmAction
 from const_vdsm import RHVM_INFO, MACHINE_INFO, NFS_INFO, DELL_PER515_01
@@ -25,9 +26,11 @@ disk1_name_tpl = "atv_tpl_disk1"
 class CheckVdsm(CheckYoo):
     """"""
     def __init__(self):
+        super(CheckVdsm, self).__init__()
         self._build = None  # redhat-virtualization-host-4.1-20170531.0
         self._vlanid = None  # 50
         self._rhvm = None  # instance of RhevmAction
+        self._rhvm_round_trips = 0  # requests of the session before the check
         self._rhvm_fqdn = None  # rhvm41-vlan50-1.lab.eng.pek2.redhat.com
         self._dc_info = {}  # {"dc_name": vdsm_fc_dc, "is_local": False}
         self._cluster_info = {}  # {"cluster_name": cluster_name, "cpu_type": "AMD Opteron G1"}
@@ -96,6 +99,8 @@ class CheckVdsm(CheckYoo):
     def _get_rhvm(self):
         self._get_rhvm_fqdn()
         self._rhvm = RhevmAction(self._rhvm_fqdn)
+        # the session counts the requests of all checks since it was made
+        self._rhvm_round_trips = self._rhvm.round_trips
         log.info("Testing on rhvm %s" % self._rhvm_fqdn)
 
     def _get_dc_info(self):
@@ -204,24 +209,22 @@ class CheckVdsm(CheckYoo):
 
     def _wait_host_status(self, host_name, expect_status):
         log.info("Waitting for the host %s" % expect_status)
-        i = 0
-        host_status = "unknown"
-        while True:
-            if i > 60:
-                raise RuntimeError("Timeout waitting for host %s as current host status is: %s" % (
-                    expect_status, host_status))
+        status = {}
+
+        def host_is_expected():
             host_status = self._rhvm.list_host(host_name)['status']
+            status['host'] = host_status
             log.info("HOST: %s" % host_status)
-            if host_status == expect_status:
-                break
-            elif host_status == 'install_failed':
-                raise RuntimeError("Host is not %s as current status is: %s" % (
-                    expect_status, host_status))
-            elif host_status == 'non_operational':
+            if host_status in ('install_failed', 'non_operational'):
                 raise RuntimeError("Host is not %s as current status is: %s" % (
                     expect_status, host_status))
-            time.sleep(10)
-            i += 1
+            return host_status == expect_status
+
+        if not poll(host_is_expected, 600,
+                    name='host %s' % expect_status, interval=2,
+                    max_interval=15):
+            raise RuntimeError("Timeout waitting for host %s as current host status is: %s" % (
+                expect_status, status.get('host', 'unknown')))
 
     def _update_network_vlan_tag(self):
         log.info("Updating network of datacenter with vlan tag")
@@ -272,27 +275,30 @@ class CheckVdsm(CheckYoo):
     ##########################################
     # CheckPoint cl2_include_rhgs_pkg_check
     ##########################################
+    @readonly_checkpoint
     def cl2_include_rhgs_pkg_check(self):
         log.info("Checking the rhgs server package is included in rhvh")
-        cmd = "rpm -qa|grep glusterfs|wc -l"
-        ret = self.run_cmd(cmd)
-        if not ret[0]:
+        cmds = [
+            "rpm -qa|grep glusterfs|wc -l",
+            "service glusterd status|grep Active"
+        ]
+        ret_pkg, ret = self.run_cmds(cmds)
+        if not ret_pkg[0]:
             log.error("RHGS package is not complete")
             return False
-        cmd = "service glusterd status|grep Active"
-        ret = self.run_cmd(cmd)
         if ret[0] and re.search("(running)", ret[1]):
             return True
         else:
             log.error("glusterd service is not running")
             return False
 
+    @readonly_checkpoint
     def cl3_fcoe_service_check(self):
         log.info("Checking the fcoe related service is running")
         ck_services = ["fcoe.service", "lldpad.service", "lldpad.service"]
-        for ck_service in ck_services:
-            cmd = "service %s status" % ck_service
-            ret = self.run_cmd(cmd)
+        rets = self.run_cmds(
+            ["service %s status" % ck_service for ck_service in ck_services])
+        for ck_service, ret in zip(ck_services, rets):
             if ret[0] and re.search("(running)", ret[1]):
                 continue
             else:
@@ -402,11 +408,7 @@ class CheckVdsm(CheckYoo):
     def _clean_nfs_path(self, nfs_ip, nfs_pass, nfs_data_path):
         log.info("Cleaning the nfs path")
         cmd = "rm -rf %s/*" % nfs_data_path
-        with settings(
-            warn_only=True,
-            host_string='root@' + nfs_ip,
-            password=nfs_pass):
-            ret = run(cmd)
+        ret = get_connection(nfs_ip, 'root', nfs_pass).run(cmd)
         if ret.failed:
             raise RuntimeError("Failed to cleanup the nfs path %s" % nfs_data_path)
 
@@ -1018,18 +1020,20 @@ GATEWAY="{gateway}"\
 
     def _wait_vm_status(self, vm_name, expect_status):
         log.info("Waitting the vm to status %s" % expect_status)
-        i = 0
-        vm_status = "unknown"
-        while True:
-            if i > 30:
-                log.error("VM status is %s, not %s" % (vm_status, expect_status))
-                return False
+        status = {}
+
+        def vm_is_expected():
             vm_status = self._rhvm.list_vm(vm_name)['status']
+            status['vm'] = vm_status
             log.info("VM: %s" % vm_status)
-            if vm_status == expect_status:
-                return True
-            time.sleep(10)
-            i += 1
+            return vm_status == expect_status
+
+        if not poll(vm_is_expected, 300, name='vm %s' % expect_status,
+                    interval=2, max_interval=15):
+            log.error("VM status is %s, not %s" % (
+                status.get('vm', 'unknown'), expect_status))
+            return False
+        return True
 
     def _start_vm(self, vm_name):
         log.info("Start up the vm %s" % vm_name)
@@ -1202,10 +1206,7 @@ GATEWAY="{gateway}"\
             # run check
             log.info("Start to run check points, please wait...")
 
-            for l in checkpoint_cases_map_list:
-                checkpoint = l[0]
-                cases = l[1]
-                self.run_checkpoint(checkpoint, cases, cks)
+            self.run_checkpoints(checkpoint_cases_map_list, cks)
         except Exception as e:
             log.exception(e)
 
@@ -1229,14 +1230,18 @@ GATEWAY="{gateway}"\
             log.info("Run checkpoint:%s for cases:%s finished.", checkpoint, cases)
 
     def go_check(self):
-        disconnect_all()
-
         is_setup_success = self._setup_before_check()
 
         cks = self.run_cases() if is_setup_success else {}
 
         self._teardown_after_check()
 
+        if self._rhvm:
+            log.info("%d requests have been sent to %s over the shared "
+                     "session during this check",
+                     self._rhvm.round_trips - self._rhvm_round_trips,
+                     self._rhvm_fqdn)
+
         return cks
 
 
@@ -0,0 +1,52 @@
+"""Checkpoint results of a ks, one json object per line
+
+Every run of a ks appends a line per case and then a line for the run
+itself, a run cut short has no run line and is left out:
+
+    {"run": "<id>", "case": "RHEVM-1", "checkpoint": "install_check",
+     "status": "passed", "started": 1496282400.1, "finished": 1496282401.3,
+     "duration": 1.2}
+    {"run": "<id>", "ks": "ati_fc_04.ks", "machine": "dell-per510-01",
+     "started": 1496282400.0, "finished": 1496282500.0, "total": 1,
+     "iqn": "iqn.1994-05.com.redhat:5bd6c4f8a5e"}
+"""
+import os
+import json
+
+RESULTS_FILE = 'checkpoints.jsonl'
+
+
+def write_run(results_file, run, cases):
+    """Append the `cases` records of a run, then the `run` record"""
+    lines = [json.dumps(case, sort_keys=True) for case in cases]
+    lines.append(json.dumps(run, sort_keys=True))
+    with open(results_file, 'a+') as fp:
+        fp.seek(0, os.SEEK_END)
+        if fp.tell():
+            fp.seek(-1, os.SEEK_END)
+            if fp.read(1) != '\n':
+                # don't glue onto the last line of a run cut short
+                lines.insert(0, '')
+        # one write, runs of other threads are never interleaved
+        fp.write('\n'.join(lines) + '\n')
+
+
+def read_runs(results_file):
+    """Return the finished runs in the file in order, the `cases` of a run
+    are {case: status}"""
+    runs = []
+    cases = {}
+    with open(results_file) as fp:
+        for line in fp:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line of a run cut short
+                continue
+            if 'case' in record:
+                cases.setdefault(record['run'], {})[record['case']] = \
+                    record['status']
+            else:
+                record['cases'] = cases.pop(record['run'], {})
+                runs.append(record)
+    return runs
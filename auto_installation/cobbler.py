@@ -1,9 +1,11 @@
 import copy
+import time
+import threading
 import attr
 import xmlrpclib
 import logging
 
-from .constants import CB_API, CB_CREDENTIAL
+from .constants import CB_API, CB_CREDENTIAL, CB_TOKEN_TTL, CB_PROFILES_TTL
 
 
 def _cb_cred_checker(instance, attribute, value):
@@ -15,6 +17,36 @@ def _cb_cred_checker(instance, attribute, value):
         return True
 
 
+@attr.s
+class CobblerSession(object):
+    """Proxy, login token and profiles shared by all `Cobbler` instances
+    of the same api and credential, so `with Cobbler()` costs no rpc.
+    """
+    proxy = attr.ib()
+    lock = attr.ib(default=attr.Factory(threading.RLock), repr=False)
+    token = attr.ib(default=None)
+    token_ts = attr.ib(default=0)
+    multicall = attr.ib(default=True)
+    profiles = attr.ib(default=None)
+    profiles_ts = attr.ib(default=0)
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(cb_api, credential):
+    key = (cb_api, tuple(credential))
+    with _sessions_lock:
+        if key not in _sessions:
+            _sessions[key] = CobblerSession(xmlrpclib.Server(cb_api))
+        return _sessions[key]
+
+
+def _is_token_fault(e):
+    return isinstance(e, xmlrpclib.Fault) and 'token' in e.faultString.lower()
+
+
 @attr.s
 class Cobbler(object):
     system_tpl = dict(
@@ -36,26 +68,97 @@ class Cobbler(object):
         return self
 
     def __exit__(self, type, value, traceback):
-        self.log.warn("disconnected from {}".format(self.cb_api))
+        # session stays open for the next `with Cobbler()`
+        pass
+
+    @property
+    def session(self):
+        return get_session(self.cb_api, self.credential)
 
     @property
     def proxy(self):
-        return xmlrpclib.Server(self.cb_api)
+        return self.session.proxy
 
     @property
     def profiles(self):
-        ret = self.proxy.get_profiles()
-        return [pn['name'] for pn in ret if pn['name'].startswith('RHVH-4')]
-
-    def login(self):
-        self.token = self.proxy.login(*(self.credential))
-        self.log.info("logging into {}, get token is {}".format(self.cb_api,
-                                                                self.token))
+        ss = self.session
+        with ss.lock:
+            if ss.profiles is None or \
+                    time.time() - ss.profiles_ts > CB_PROFILES_TTL:
+                ret = ss.proxy.get_profiles()
+                ss.profiles = [pn['name'] for pn in ret
+                               if pn['name'].startswith('RHVH-4')]
+                ss.profiles_ts = time.time()
+            return list(ss.profiles)
+
+    def login(self, force=False):
+        ss = self.session
+        with ss.lock:
+            if force or not ss.token or \
+                    time.time() - ss.token_ts > CB_TOKEN_TTL:
+                ss.token = ss.proxy.login(*(self.credential))
+                ss.token_ts = time.time()
+                self.log.info("logging into {}, get token is {}".format(
+                    self.cb_api, ss.token))
+            self.token = ss.token
+
+    def _call(self, method, *args):
+        with self.session.lock:
+            return getattr(self.proxy, method)(*args)
+
+    def _call_auth(self, method, *args):
+        """Call `method` with the token as last argument, login again once
+        if cobbler has already expired the token
+        """
+        ss = self.session
+        with ss.lock:
+            try:
+                ret = getattr(ss.proxy, method)(*(args + (self.token, )))
+            except xmlrpclib.Fault as e:
+                if not _is_token_fault(e):
+                    raise
+                self.login(force=True)
+                ret = getattr(ss.proxy, method)(*(args + (self.token, )))
+            # cobbler tokens expire after a period of inactivity
+            ss.token_ts = time.time()
+            return ret
+
+    def _modify_and_save_system(self, system_id, params):
+        ss = self.session
+        with ss.lock:
+            relogin = True
+            while ss.multicall:
+                mc = xmlrpclib.MultiCall(ss.proxy)
+                for k, v in params.items():
+                    mc.modify_system(system_id, k, v, self.token)
+                mc.save_system(system_id, self.token)
+                try:
+                    # iterating raises the first fault of the batch
+                    tuple(mc())
+                    ss.token_ts = time.time()
+                    return
+                except xmlrpclib.Fault as e:
+                    if _is_token_fault(e) and relogin:
+                        # the batch is sent again whole, setting the same
+                        # fields twice does no harm
+                        self.login(force=True)
+                        relogin = False
+                        continue
+                    if 'multicall' not in e.faultString:
+                        raise
+                    self.log.warning("{} has no system.multicall, modify "
+                                     "system field by field".format(
+                                         self.cb_api))
+                    ss.multicall = False
+
+            for k, v in params.items():
+                self._call_auth('modify_system', system_id, k, v)
+            self._call_auth('save_system', system_id)
 
     def find_system(self, name_pattern):
         self.log.info("start to querying system {}".format(name_pattern))
 
-        ret = self.proxy.find_system(dict(name=name_pattern))
+        ret = self._call('find_system', dict(name=name_pattern))
         if ret:
             self.log.info("found system : {}".format(ret))
             return True
@@ -64,18 +167,15 @@ class Cobbler(object):
             return False
 
     def add_new_system(self, **kwargs):
-        system_id = self.proxy.new_system(self.token)
+        system_id = self._call_auth('new_system')
         params = copy.deepcopy(self.system_tpl)
         params.update(kwargs)
 
         self.log.info("add new host with {}".format(params))
-        for k, v in params.items():
-            self.proxy.modify_system(system_id, k, v, self.token)
-
-        self.proxy.save_system(system_id, self.token)
+        self._modify_and_save_system(system_id, params)
 
     def remove_system(self, system_name):
-        self.proxy.remove_system(system_name, self.token)
+        self._call_auth('remove_system', system_name)
 
 
 if __name__ == '__main__':
@@ -30,6 +30,9 @@ DELL_PER515_01 = 'dell-per515-01.lab.eng.pek2.redhat.com'
 
 COVERAGE_TEST = False
 
+# read-only checkpoints of one host run at the same time
+CHECKPOINT_WORKERS = 4
+
 # ANACONDA-TIER1, ANACONDA-TIER2, KS-TIER1, KS-TIER2,ALL
 DEBUG_TIER = 0x01
 ANACONDA_TIER1 = 0x02
@@ -128,11 +131,17 @@ else
 fi
 
 fetch /tmp/anamon http://{srv_ip}:{srv_port}/static/anamon.py
-python /tmp/anamon --server {srv_ip} --port {srv_port} --stage pre
-
 """.format(
     srv_ip=CURRENT_IP_PORT[0], srv_port=CURRENT_IP_PORT[1])
 
+# started after PRE_SCRIPT_01, the anamon of a kickstart rendered for a job
+# tells the server which job and machine its logs are of
+ANAMON_PRE_CMD = """python /tmp/anamon --server {srv_ip} --port {srv_port} \
+--stage pre --inotify{job_args}
+
+"""
+ANAMON_JOB_ARGS = " --job {token} --machine {bkr_name}"
+
 PRE_SCRIPT_02 = """
 fetch /tmp/clean_disk http://{srv_ip}:{srv_port}/static/clean_disk.py
 python /tmp/clean_disk
@@ -144,5 +153,23 @@ NOPXE_URL = "http://lab-01.rhts.eng.pek2.redhat.com:8000/nopxe/{0}"
 CB_API = "http://10.73.60.74/cobbler_api"
 CB_CREDENTIAL = ('cobbler', 'cobbler')
 CB_PROFILE = CFGS['cb_profile']
-ARGS_TPL = ('inst.ks=http://{srv_ip}:{srv_port}/static/auto/{ks_file} '
+# cobbler expires a token after 60 min without use
+CB_TOKEN_TTL = 1800
+CB_PROFILES_TTL = 300
+BKR_URL = "https://beaker.engineering.redhat.com"
+BKR_CREDENTIAL = (os.environ.get('BKR_USER', 'yaniwang'),
+                  os.environ.get('BKR_PASSWORD', ''))
+# 'rest' talks to the beaker server over a logged in http session, with
+# the bkr client as fallback, 'cli' always runs the bkr client. Without a
+# password there is no session to log in, the bkr client is the default
+BKR_BACKEND = os.environ.get('BKR_BACKEND',
+                             'rest' if BKR_CREDENTIAL[1] else 'cli')
+# seconds to use only the bkr client after the login failed
+BKR_LOGIN_RETRY = 300
+# kickstarts are rendered for each job and machine by the server, the
+# token is the id of the job
+ARGS_TPL = ('inst.ks=http://{srv_ip}:{srv_port}/ks/{token}/{bkr_name}/{ks_file} '
             '{addition_params}')
+# for a runner without a job, its kickstarts are written to static/auto
+FILE_ARGS_TPL = ('inst.ks=http://{srv_ip}:{srv_port}/static/auto/{ks_file} '
+                 '{addition_params}')
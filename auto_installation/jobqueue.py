@@ -0,0 +1,294 @@
+"""Run several automation jobs at once, as long as they don't share machines
+
+Every job declares the beaker machines it provisions, it starts once it
+holds the redis lock of all of them. The locks have a lease renewed while
+the job runs, so a crashed server doesn't keep the machines forever. Jobs
+wanting a busy machine wait in the order they were submitted.
+"""
+import time
+import json
+import uuid
+import logging
+import functools
+import threading
+import attr
+from .utils import ResultsAndLogs, get_machine_ksl_map, JOB_EVENTS_CHANNEL, \
+    JOB_KEY, JOB_TTL
+from .jobs import JobRunner
+
+log = logging.getLogger('bender')
+
+MACHINE_LOCK_KEY = 'machine_lock:{}'
+# milliseconds a lock is kept without renewing it
+LOCK_LEASE = 10 * 60 * 1000
+# seconds between two rounds of renewing the locks and starting jobs, the
+# locks may be held by another server too, so waiting jobs try again
+SCHEDULE_INTERVAL = 10
+
+JOB_STATES = ('queued', 'provisioning', 'installing', 'checking',
+              'reporting', 'done')
+
+# only the job holding a lock may renew or release it
+_RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+@attr.s
+class MachineLocks(object):
+    """Leased redis locks of beaker machines, owned by a job id"""
+    rd_conn = attr.ib()
+    lease = attr.ib(default=LOCK_LEASE)
+    _renew = attr.ib(default=None, repr=False)
+    _release = attr.ib(default=None, repr=False)
+
+    def __attrs_post_init__(self):
+        self._renew = self.rd_conn.register_script(_RENEW_SCRIPT)
+        self._release = self.rd_conn.register_script(_RELEASE_SCRIPT)
+
+    def owner(self, machine):
+        return self.rd_conn.get(MACHINE_LOCK_KEY.format(machine))
+
+    def acquire(self, machines, token):
+        """Lock all `machines` for `token`, or none of them"""
+        locked = []
+        for m in sorted(machines):
+            if not self.rd_conn.set(MACHINE_LOCK_KEY.format(m), token,
+                                    nx=True, px=self.lease):
+                self.release(locked, token)
+                return False
+            locked.append(m)
+        return True
+
+    def renew(self, machines, token):
+        """Extend the lease of the locks, return the machines whose lock
+        was lost"""
+        return [m for m in sorted(machines) if not self._renew(
+            keys=[MACHINE_LOCK_KEY.format(m)], args=[token, self.lease])]
+
+    def release(self, machines, token):
+        for m in machines:
+            self._release(keys=[MACHINE_LOCK_KEY.format(m)], args=[token])
+
+
+@attr.s
+class Job(object):
+    img_url = attr.ib()
+    machines = attr.ib()
+    target_build = attr.ib(default=None)
+    id = attr.ib(default=attr.Factory(lambda: uuid.uuid4().hex))
+    state = attr.ib(default='queued')
+    submitted = attr.ib(default=attr.Factory(time.time))
+    started = attr.ib(default=None)
+    machine_states = attr.ib(default=attr.Factory(dict))
+    results_logs = attr.ib(default=None, repr=False)
+
+    def as_dict(self):
+        return dict(id=self.id, img_url=self.img_url,
+                    target_build=self.target_build,
+                    machines=sorted(self.machines), state=self.state,
+                    machine_states=self.machine_states,
+                    submitted=self.submitted, started=self.started)
+
+
+def get_job(rd_conn, job_id):
+    """Return the state of a job as Job.as_dict does, None if unknown"""
+    fields = rd_conn.hgetall(JOB_KEY.format(job_id))
+    if not fields:
+        return None
+    job = json.loads(fields.pop('job'))
+    job['state'] = fields.pop('state')
+    job['machine_states'] = {k.split(':', 1)[1]: v
+                             for k, v in fields.items()
+                             if k.startswith('machine:')}
+    return job
+
+
+def run_job(job, rd_conn, on_state):
+    JobRunner(job.img_url, rd_conn, job.results_logs, job.target_build,
+              machines=job.machines, job_id=job.id, on_state=on_state).go()
+
+
+@attr.s
+class JobQueue(object):
+    """FIFO of jobs, a job starts when no job before it wants any of its
+    machines and all its machine locks are taken"""
+    rd_conn = attr.ib()
+    runner = attr.ib(default=run_job)
+    interval = attr.ib(default=SCHEDULE_INTERVAL)
+    locks = attr.ib(default=None)
+    # the job started last, its logs are the ones the server shows
+    latest = attr.ib(default=None)
+    _jobs = attr.ib(default=attr.Factory(list), repr=False)
+    _cond = attr.ib(default=attr.Factory(threading.Condition), repr=False)
+    _thread = attr.ib(default=None, repr=False)
+    _closed = attr.ib(default=False, repr=False)
+
+    def __attrs_post_init__(self):
+        self.locks = self.locks or MachineLocks(self.rd_conn)
+
+    def submit(self, img_url, target_build=None, machines=None, job_id=None):
+        """Queue a job on `machines`, all machines of the test level by
+        default. Raise ValueError for a machine the test level doesn't use.
+
+        `job_id` is the id given to the job when it was launched elsewhere,
+        see announce
+        """
+        known = set(get_machine_ksl_map())
+        machines = set(machines or known)
+        if not machines or machines - known:
+            raise ValueError("Unknown machines: {}".format(
+                ', '.join(sorted(machines - known))))
+
+        job = Job(img_url, frozenset(machines), target_build)
+        if job_id:
+            job.id = job_id
+        with self._cond:
+            if self.get(job.id):
+                raise ValueError("Job {} is queued already".format(job.id))
+            self._jobs.append(job)
+            self.set_state(job, 'queued')
+            log.info("job %s queued on %s", job.id, ', '.join(
+                sorted(machines)))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop,
+                                                name='jobqueue')
+                self._thread.setDaemon(True)
+                self._thread.start()
+            self._cond.notify()
+        return job
+
+    def announce(self, build, target_build=None):
+        """Record a job launched by a celery task before it reaches the
+        queue, the task submits it with the id returned here"""
+        job = Job(build, frozenset(), target_build)
+        self.set_state(job, 'queued')
+        return job
+
+    def get(self, job_id):
+        """The queued or running job `job_id`, None if there is none"""
+        with self._cond:
+            for job in self._jobs:
+                if job.id == job_id:
+                    return job
+        return None
+
+    def status(self):
+        with self._cond:
+            return [job.as_dict() for job in self._jobs]
+
+    def set_state(self, job, state, machine=None):
+        """Record the state of `job`, or of one of its machines, and tell
+        the clients following the job. The job is as far as its most
+        advanced machine, its state never goes back, and it is done when
+        all machines and the report are.
+        """
+        # the machine threads of a job report at the same time, the states
+        # are changed and written in the order they are taken
+        with self._cond:
+            advance = True
+            if machine:
+                job.machine_states[machine] = state
+                advance = state != 'done'
+            if advance and \
+                    JOB_STATES.index(state) >= JOB_STATES.index(job.state):
+                job.state = state
+
+            try:
+                key = JOB_KEY.format(job.id)
+                fields = dict(state=job.state, job=json.dumps(job.as_dict()))
+                if machine:
+                    fields['machine:' + machine] = state
+                event = dict(type='state', job=job.id, state=job.state,
+                             machine=machine,
+                             machine_state=state if machine else None,
+                             time=time.time())
+                pipe = self.rd_conn.pipeline()
+                pipe.hmset(key, fields)
+                if job.state == 'done':
+                    pipe.expire(key, JOB_TTL)
+                pipe.publish(JOB_EVENTS_CHANNEL.format(job.id),
+                             json.dumps(event))
+                pipe.execute()
+            except Exception as e:
+                # the job goes on without its watchers
+                log.error("can't publish the state of job %s: %s", job.id, e)
+
+    def close(self):
+        """Stop scheduling, the running jobs are left alone"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _loop(self):
+        while not self._closed:
+            with self._cond:
+                try:
+                    self._renew()
+                    self._schedule()
+                except Exception as e:
+                    log.exception(e)
+                self._cond.wait(self.interval)
+
+    def _renew(self):
+        for job in self._jobs:
+            if job.state == 'queued':
+                continue
+            lost = self.locks.renew(job.machines, job.id)
+            if lost:
+                log.error("job %s lost the lock of %s", job.id,
+                          ', '.join(lost))
+
+    def _schedule(self):
+        """Start the queued jobs which can run, must hold self._cond"""
+        busy = set()
+        for job in self._jobs:
+            if job.state == 'queued' and not job.machines & busy and \
+                    self.locks.acquire(job.machines, job.id):
+                self._start(job)
+            # a waiting job keeps its machines from the jobs after it
+            busy |= job.machines
+        self._set_running()
+
+    def _start(self, job):
+        job.started = time.time()
+        job.results_logs = ResultsAndLogs(job.id)
+        job.results_logs.img_url = job.img_url
+        self.latest = job
+        self.set_state(job, 'provisioning')
+        log.info("job %s started", job.id)
+
+        t = threading.Thread(target=self._run, args=(job, ),
+                             name='job-' + job.id)
+        t.setDaemon(True)
+        t.start()
+
+    def _run(self, job):
+        try:
+            self.runner(job, self.rd_conn,
+                        functools.partial(self.set_state, job))
+        except Exception as e:
+            log.exception(e)
+        finally:
+            with self._cond:
+                self.locks.release(job.machines, job.id)
+                self._jobs.remove(job)
+                self.set_state(job, 'done')
+                log.info("job %s done", job.id)
+                self._schedule()
+
+    def _set_running(self):
+        # kept for the clients which only know the old global flag
+        running = any(job.state != 'queued' for job in self._jobs)
+        self.rd_conn.set('running', int(running))
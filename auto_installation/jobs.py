@@ -1,23 +1,45 @@
 import time
 import logging
 import attr
-from threading import Thread
+from threading import Thread, Lock, current_thread
 import subprocess
 import os
 from .kickstarts import KickStartFiles
-from .beaker import Beaker, inst_watcher
-from .constants import CURRENT_IP_PORT, ARGS_TPL, HOSTS, CB_PROFILE, COVERAGE_TEST
+from .beaker import Beaker, InstallWatcher
+from .constants import CURRENT_IP_PORT, ARGS_TPL, FILE_ARGS_TPL, HOSTS, \
+    CB_PROFILE, COVERAGE_TEST
 from .const_install import KS_KERPARAMS_MAP
 from .cobbler import Cobbler
+from .sshpool import get_stats as get_ssh_stats
+from .sshpool import close_all as close_ssh_connections
+from .poll import get_wait_stats, reset_wait_stats, bind_scope, unbind_scope
 from .check_install import CheckInstall
 from .check_upgrade import CheckUpgrade
 from .check_vdsm import CheckVdsm
 from .util_result_index import cache_logs_summary
+from .checkresults import RESULTS_FILE as CHECK_RESULTS_FILE
+from .utils import job_log_publisher, log_router, setup_logging
 from reports import ResultsToPolarion
 from coverage_stat import upload_coverage_raw_res_from_host, generate_final_coverage_result
 
 log = logging.getLogger("bender")
 
+# the kind of test, and of report, by the prefix of a kickstart
+KS_TEST_FLAGS = (('ati', 'install'), ('atu', 'upgrade'), ('atv', 'vdsm'))
+
+
+def get_test_flag(job_queue):
+    """The report flag of a job: the one of the kickstart that was checked
+    last when the machines went one after the other, None if no kickstart
+    is ati/atu/atv"""
+    test_flag = None
+    for ksl in job_queue.values():
+        for ks in ksl:
+            for prefix, flag in KS_TEST_FLAGS:
+                if ks.find(prefix) == 0:
+                    test_flag = flag
+    return test_flag
+
 
 @attr.s
 class JobRunner(object):
@@ -28,20 +50,15 @@ class JobRunner(object):
     # ks_filter = attr.ib(default='must')
     debug = attr.ib(default=False)
     test_flag = attr.ib(default='install')
+    # run only the kickstarts of these machines, all of them by default
+    machines = attr.ib(default=None)
+    job_id = attr.ib(default=None)
+    # called with the state of the job, and the machine it is about
+    on_state = attr.ib(default=None)
 
-    def _wait_for_installation(self, p):
-        while True:
-            time.sleep(5)
-            log.info("waitting for install done")
-            msg = p.get_message(ignore_subscribe_messages=True)
-            if msg:
-                if 'done' in msg['data']:
-                    log.info('autoinstallation job is success')
-                    ip = msg['data'].split(',')[1]
-                    return ip
-                elif msg['data'] == 'fail':
-                    log.info('autoinstallation job is fail')
-                    return False
+    def _set_state(self, state, machine=None):
+        if self.on_state:
+            self.on_state(state, machine)
 
     def _wait_for_cockpit(self, bkr_name):
         pubsub_cockpit = self.rd_conn.pubsub()
@@ -58,19 +75,20 @@ class JobRunner(object):
     def _provision(self, ks, m):
         bp = Beaker(
             srv_ip=CURRENT_IP_PORT[0], srv_port=CURRENT_IP_PORT[1], ks_file=ks)
-        bp.reserve(m)
-        ret = bp.reboot(m)
-
-        log.info("reboot {} with return code {}".format(m, ret))
+        # the cobbler system is set up while beaker reserves the machine,
+        # it is ready before the machine reboots into pxe
+        reserving = bp.submit('reserve', m)
 
         addition_kernel_params = ''
         if ks in KS_KERPARAMS_MAP:
             addition_kernel_params = KS_KERPARAMS_MAP.get(ks)
 
         with Cobbler() as cb:
-            kargs = ARGS_TPL.format(
+            kargs = (ARGS_TPL if self.job_id else FILE_ARGS_TPL).format(
                 srv_ip=CURRENT_IP_PORT[0],
                 srv_port=CURRENT_IP_PORT[1],
+                token=self.job_id,
+                bkr_name=m,
                 ks_file=ks,
                 addition_params=addition_kernel_params)
             cb.add_new_system(
@@ -78,6 +96,10 @@ class JobRunner(object):
                 profile=CB_PROFILE,
                 modify_interface=HOSTS.get(m)['nic'],
                 kernel_options=kargs)
+
+        reserving.get()
+        ret = bp.reboot(m)
+        log.info("reboot {} with return code {}".format(m, ret))
         return ret
 
     def _set_repos(self):
@@ -96,93 +118,174 @@ class JobRunner(object):
 
     @property
     def job_queue(self):
-        return self.ksins.get_job_queue()
+        # the server renders the kickstarts of a job, see ARGS_TPL, they
+        # are only written to files for a runner without a job
+        return self.ksins.get_job_queue(self.machines,
+                                        write_files=self.job_id is None)
+
+    def _check(self, ks, m, ip):
+        if ks.find("ati") == 0:
+            ck = CheckInstall()
+        elif ks.find("atu") == 0:
+            ck = CheckUpgrade()
+            ck.source_build = self.build_url.split('/')[-2]
+            ck.target_build = self.target_build
+        elif ks.find("atv") == 0:
+            ck = CheckVdsm()
+            ck.build = self.build_url.split('/')[-2]
+        else:
+            log.error("ks file name %s isn't started with ati/atu/atv.", ks)
+            return
+
+        log.info("ip is %s", ip)
+        self._hosts.add(ip)
+        ck.host_string, ck.host_user, ck.host_pass = (ip, 'root', 'redhat')
+        ck.beaker_name = m
+        ck.ksfile = ks
+
+        started = time.time()
+        cks = ck.go_check()
+        log.info(cks)
+        try:
+            ck.save_results(
+                os.path.join(self.results_logs.current_log_path,
+                             CHECK_RESULTS_FILE), cks, started)
+        except Exception as e:
+            log.error("failed to save the results of %s: %s", ks, e)
+
+        if ks.find("ati") == 0 and COVERAGE_TEST:
+            # raw results of all hosts go through the same local tar file
+            with self._coverage_lock:
+                upload_coverage_raw_res_from_host(ck)
+                self._coverage_ck = ck
+
+                # TODO wati for cockpit new results format
+
+    def _run_ks(self, ks, m):
+        self.results_logs.logger_name = 'results'
+        self.results_logs.get_thread_logger(ks)
+        # the installer uploads its logs next to the results of the ks
+        self.results_logs.set_machine_log_path(
+            m, self.results_logs.current_log_path)
+        log.info("start provisioning on host %s with %s", m, ks)
+
+        self._set_state('provisioning', m)
+        if self.debug:
+            log.debug("now is debug mode, will not do provisioning")
+            ret = 0
+        else:
+            ret = self._provision(ks, m)
+
+        log.info(self.results_logs.current_log_path)
+
+        if ret != 0:
+            log.error("provisioning on host %s failed with return code %s",
+                      m, ret)
+            return
+
+        log.info("provisioning on host %s finished " +
+                 "with kickstart file %s return code 0", m, ks)
+        log.info("waitting for install done")
+        self._set_state('installing', m)
+        ip = self._inst_watcher.watch(m).wait()
+        if not ip:
+            log.info("auto installation failed, contine to next job")
+            return
+
+        log.info("auto installation finished, contine to chekcpoints")
+
+        self.results_logs.logger_name = 'checkpoints'
+        self.results_logs.get_thread_logger(ks)
+
+        self._set_state('checking', m)
+        self._check(ks, m, ip)
+
+    def _join_job(self):
+        """Make the records and waits of current thread part of the job"""
+        if self.job_id:
+            job_log_publisher.bind(self.job_id)
+        bind_scope(self.job_id)
+        log_router.join(self._job_thread)
+
+    def _leave_job(self):
+        log_router.leave()
+        unbind_scope()
+        job_log_publisher.unbind()
+
+    def _run_machine(self, m, ksl):
+        """Run all kickstarts of one machine, one after another"""
+        self._join_job()
+        try:
+            for ks in ksl:
+                try:
+                    self._run_ks(ks, m)
+                except Exception as e:
+                    log.exception(e)
+        finally:
+            self.results_logs.release_thread_logger()
+            self._leave_job()
+            self._set_state('done', m)
 
     def go(self):
+        setup_logging()
+        if self.job_id:
+            job_log_publisher.bind(self.job_id)
+        bind_scope(self.job_id)
+        try:
+            # job level log, it also collects records of all machines
+            self.results_logs.get_thread_logger()
+            self._job_thread = current_thread().ident
+            self._go()
+        finally:
+            self.results_logs.release_thread_logger()
+            unbind_scope()
+            job_log_publisher.unbind()
+
+    def _go(self):
         self._set_repos()
-        for m, ksl in self.job_queue.items():
-            for ks in ksl:
-                self.results_logs.get_actual_logger(ks)
-                log.info("start provisioning on host %s with %s", m, ks)
-
-                if self.debug:
-                    log.debug("now is debug mode, will not do provisioning")
-                    ret = 0
-                else:
-                    ret = self._provision(ks, m)
-
-                log.info(self.results_logs.current_log_path)
-
-                if ret == 0:
-                    log.info("provisioning on host %s finished " +
-                             "with kickstart file %s return code 0", m, ks)
-                    p = self.rd_conn.pubsub(ignore_subscribe_messages=True)
-                    log.info("subscribe channel %s", m)
-                    p.subscribe(m)
-                    log.info("start daemon thread to listen on channel %s", m)
-                    t = inst_watcher(m, p)
-                    t.setDaemon(True)
-                    t.start()
-                    t.join()
-
-                    ret = self._wait_for_installation(p)
-                    if not ret:
-                        log.info(
-                            "auto installation failed, contine to next job")
-                        continue
-                    else:
-                        log.info(
-                            "auto installation finished, contine to chekcpoints"
-                        )
-
-                        self.results_logs.logger_name = 'checkpoints'
-                        self.results_logs.get_actual_logger(ks)
-
-                        if ks.find("ati") == 0:
-                            self.test_flag = "install"
-                            ck = CheckInstall()
-                        elif ks.find("atu") == 0:
-                            self.test_flag = "upgrade"
-                            ck = CheckUpgrade()
-                            ck.source_build = self.build_url.split('/')[-2]
-                            ck.target_build = self.target_build
-                        elif ks.find("atv") == 0:
-                            self.test_flag = "vdsm"
-                            ck = CheckVdsm()
-                            ck.build = self.build_url.split('/')[-2]
-                        else:
-                            log.error(
-                                "ks file name %s isn't started with ati/atu/atv.",
-                                ks)
-                            continue
-
-                        log.info("ip is %s", ret)
-                        ck.host_string, ck.host_user, ck.host_pass = (ret,
-                                                                      'root',
-                                                                      'redhat')
-                        ck.beaker_name = m
-                        ck.ksfile = ks
-
-                        log.info(ck.go_check())
-
-                        if ks.find("ati") == 0 and COVERAGE_TEST:
-                            upload_coverage_raw_res_from_host(ck)
-
-                            # TODO wati for cockpit new results format
-                else:
-                    log.error(
-                        "provisioning on host %s failed with return code %s",
-                        m, ret)
-
-        self.generate_final_results()
+        self._coverage_lock = Lock()
+        self._coverage_ck = None
+        # the test hosts of this job, other jobs have their own
+        self._hosts = set()
+        self._inst_watcher = InstallWatcher(self.rd_conn)
 
-        if ks.find("ati") == 0 and COVERAGE_TEST:
-            generate_final_coverage_result(ck, self.build_url.split('/')[-2])
+        job_queue = self.job_queue
+        # worked out before the machines start, they finish in any order
+        self.test_flag = get_test_flag(job_queue) or self.test_flag
+        workers = []
+        for m, ksl in job_queue.items():
+            t = Thread(target=self._run_machine, args=(m, ksl), name=m)
+            t.setDaemon(True)
+            t.start()
+            workers.append(t)
 
-        cache_logs_summary()
-        self.rd_conn.set("running", "0")
+        for t in workers:
+            t.join()
+        self._inst_watcher.close()
+        for host, (connects, handshake_time) in get_ssh_stats(
+                self._hosts).items():
+            log.info("ssh %s: %d connects, %.2fs in handshakes", host,
+                     connects, handshake_time)
+        close_ssh_connections(self._hosts)
+        for name, (waits, secs, longest, timed_out) in sorted(
+                get_wait_stats(self.job_id).items()):
+            log.info("waited for %s %d times, %.0fs in all, %.0fs at most, "
+                     "%d timed out", name, waits, secs, longest, timed_out)
+        reset_wait_stats(self.job_id)
+
+        self._set_state('reporting')
+        final_path = self.generate_final_results()
+
+        if self._coverage_ck and COVERAGE_TEST:
+            generate_final_coverage_result(self._coverage_ck,
+                                           self.build_url.split('/')[-2])
+
+        # only this run is new to the logs summary
+        if final_path:
+            cache_logs_summary(final_path)
 
     def generate_final_results(self):
+        """Return the path of the final results, or None on error"""
         try:
             log_path = self.results_logs.current_log_path
             build_name = self.results_logs.parse_img_url()
@@ -193,10 +296,6 @@ class JobRunner(object):
             report = ResultsToPolarion(final_path, '-l', self.test_flag,
                                        self.target_build)
             report.run()
+            return final_path
         except Exception as e:
             log.error(e)
-
-
-def job_runner(img_url, rd_conn, results_logs, target_build=None):
-    ins = JobRunner(img_url, rd_conn, results_logs, target_build)
-    return Thread(target=ins.go)
@@ -3,17 +3,49 @@
 # pylint: disable=C0103, W0403
 
 import os
+import hashlib
 import logging
+import tempfile
+import threading
+from collections import OrderedDict
 
 from pykickstart.parser import Script
 from pykickstart.constants import KS_SCRIPT_PRE, KS_SCRIPT_POST
 
-from constants import KS_FILES_DIR, KS_FILES_AUTO_DIR, \
-    HOSTS, POST_SCRIPT_01, POST_SCRIPT_02, PRE_SCRIPT_01, PRE_SCRIPT_02, TEST_LEVEL
+from constants import KS_FILES_DIR, KS_FILES_AUTO_DIR, CURRENT_IP_PORT, \
+    HOSTS, POST_SCRIPT_01, POST_SCRIPT_02, PRE_SCRIPT_01, PRE_SCRIPT_02, TEST_LEVEL, \
+    ANAMON_PRE_CMD, ANAMON_JOB_ARGS
 from utils import get_machine_ksl_map, get_ks_machine_map
 
 loger = logging.getLogger('bender')
 
+LIVEIMG_PREFIX = "liveimg --url="
+
+# path -> (mtime, lines) of the templates read so far
+_templates = {}
+
+
+def _read_template(path):
+    """Return the lines of the kickstart template `path`, read again only
+    once the file has changed"""
+    mtime = os.stat(path).st_mtime
+    cached = _templates.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path) as fp:
+        lines = fp.read().splitlines(True)
+    _templates[path] = (mtime, lines)
+    return lines
+
+
+def _write(path, content):
+    # a machine may be downloading the previous version of the file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as fp:
+        fp.write(content)
+    os.chmod(tmp, 0644)
+    os.rename(tmp, path)
+
 
 class KickStartFiles(object):
     """"""
@@ -54,48 +86,118 @@ class KickStartFiles(object):
             sp.lineno = lineno
         return sp
 
-    def _convert_to_auto_ks(self):
-        loger.info("remove all old files under {}".format(KS_FILES_AUTO_DIR))
-        os.system("rm -f {}/*".format(KS_FILES_AUTO_DIR))
+    def _pre_script(self, token=None, bkr_name=None):
+        job_args = ''
+        if token:
+            job_args = ANAMON_JOB_ARGS.format(token=token, bkr_name=bkr_name)
+        anamon = ANAMON_PRE_CMD.format(srv_ip=CURRENT_IP_PORT[0],
+                                       srv_port=CURRENT_IP_PORT[1],
+                                       job_args=job_args)
+        return str(self._generate_ks_script(
+            PRE_SCRIPT_01 + anamon + PRE_SCRIPT_02,
+            script_type=KS_SCRIPT_PRE,
+            error_on_fail=False))
+
+    def _post_script(self, ks, bkr_name):
+        if 'atv_bonda' not in ks:
+            nic_name = HOSTS.get(bkr_name).get(
+                "nic").keys()[0].split('-')[-1]
+            content = POST_SCRIPT_01.format(nic_name) + bkr_name
+        else:
+            content = POST_SCRIPT_02 + bkr_name
+        return str(self._generate_ks_script(content, error_on_fail=False))
+
+    def render(self, ks, bkr_name, pre_script=None, token=None):
+        """Return the kickstart `ks` for machine `bkr_name`: the template
+        installing the liveimg, followed by the pre and post scripts. The
+        logs of the install go to job `token` if it is given"""
+        new_live_img = LIVEIMG_PREFIX + self._liveimg + '\n'
+        lines = [new_live_img if LIVEIMG_PREFIX in line else line
+                 for line in _read_template(os.path.join(KS_FILES_DIR, ks))]
+        if pre_script is None:
+            pre_script = self._pre_script(token, bkr_name)
+        return ''.join(lines) + pre_script + self._post_script(ks, bkr_name)
+
+    def _convert_to_auto_ks(self, machines=None):
+        """Write the kickstarts of `machines`, all machines by default.
+
+        Other jobs may be installing the rest of the machines, their files
+        are left alone then.
+        """
+        if not os.path.isdir(KS_FILES_AUTO_DIR):
+            os.makedirs(KS_FILES_AUTO_DIR)
+        elif not machines:
+            loger.info("remove all old files under {}".format(
+                KS_FILES_AUTO_DIR))
+            for name in os.listdir(KS_FILES_AUTO_DIR):
+                path = os.path.join(KS_FILES_AUTO_DIR, name)
+                if os.path.isfile(path):
+                    os.remove(path)
 
         ks_machine_map = get_ks_machine_map()
+        # the same for every kickstart
+        pre_script = self._pre_script()
 
         for ks in ks_machine_map:
 
             bkr_name = ks_machine_map.get(ks)
-
-            nic_name = HOSTS.get(bkr_name).get("nic").keys()[0].split('-')[-1]
-
-            ks_ = os.path.join(KS_FILES_DIR, ks)
-            ks_out = os.path.join(KS_FILES_AUTO_DIR, ks)
-
-            new_live_img = "liveimg --url=" + self._liveimg
-
-            os.system("sed '/liveimg --url=/ c\{}' {} > {}".format(
-                new_live_img, ks_, ks_out))
-
-            if 'atv_bonda' not in ks:
-                post_script = self._generate_ks_script(
-                    POST_SCRIPT_01.format(nic_name) + bkr_name,
-                    error_on_fail=False)
-            else:
-                post_script = self._generate_ks_script(
-                    POST_SCRIPT_02 + bkr_name, error_on_fail=False)
-
-            pre_script = self._generate_ks_script(
-                PRE_SCRIPT_01 + PRE_SCRIPT_02,
-                script_type=KS_SCRIPT_PRE,
-                error_on_fail=False)
-
-            with open(ks_out, "a") as fp:
-                fp.write(pre_script.__str__())
-                fp.write(post_script.__str__())
-
-    def get_job_queue(self):
+            if machines and bkr_name not in machines:
+                continue
+
+            try:
+                content = self.render(ks, bkr_name, pre_script)
+            except (IOError, OSError) as e:
+                loger.error("failed to render %s: %s", ks, e)
+                continue
+            _write(os.path.join(KS_FILES_AUTO_DIR, ks), content)
+
+    def get_job_queue(self, machines=None, write_files=True):
+        """Return {machine: [ks]} of `machines`, all machines by default.
+
+        The kickstarts are written under KS_FILES_AUTO_DIR unless they are
+        served by the kickstart endpoint of the server.
+        """
         print "current test level is %x" % TEST_LEVEL
-        self._convert_to_auto_ks()
-
-        return get_machine_ksl_map()
+        if write_files:
+            self._convert_to_auto_ks(machines)
+
+        return {m: ksl for m, ksl in get_machine_ksl_map().items()
+                if not machines or m in machines}
+
+
+class RenderCache(object):
+    """The `size` kickstarts rendered last, with their etag
+
+    A rendered kickstart is known by its template, the liveimg, the machine
+    and the job, and by the mtime of the template so that an edited
+    template is rendered again.
+    """
+
+    def __init__(self, size=256):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, ks, liveimg, bkr_name, token=None):
+        """Return (etag, content) of the kickstart, raise IOError or
+        OSError if there is no such template"""
+        mtime = os.stat(os.path.join(KS_FILES_DIR, ks)).st_mtime
+        key = (ks, liveimg, bkr_name, token, mtime)
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item:
+                self._items[key] = item
+                return item
+
+        k = KickStartFiles()
+        k.liveimg = liveimg
+        content = k.render(ks, bkr_name, token=token)
+        item = (hashlib.md5(content).hexdigest(), content)
+        with self._lock:
+            self._items[key] = item
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+        return item
 
 
 if __name__ == '__main__':
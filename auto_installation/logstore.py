@@ -0,0 +1,132 @@
+"""Store the log chunks uploaded by anamon
+
+Chunks are written in place at their offset, the file is only truncated
+when the client asks for it, so sending a chunk again is harmless and a
+client can resume from the committed length after an error.
+"""
+import os
+import zlib
+import errno
+import weakref
+import threading
+
+# a lock lives as long as a write holds it, the locks of the files
+# uploaded long ago are gone
+_locks = weakref.WeakValueDictionary()
+_locks_lock = threading.Lock()
+
+# Content-Encoding of the request bodies the upload handlers can decode,
+# advertised to anamon in the X-Accept-Encoding response header
+ENCODINGS = {
+    'deflate': zlib.MAX_WBITS,
+    'gzip': 16 + zlib.MAX_WBITS,
+}
+ACCEPT_ENCODING = ', '.join(sorted(ENCODINGS))
+
+
+class ChunkGapError(ValueError):
+    """The chunk starts after the end of the file"""
+
+    def __init__(self, committed):
+        super(ChunkGapError, self).__init__(
+            "Chunk would leave a gap after byte {}".format(committed))
+        self.committed = committed
+
+
+class UnsupportedEncoding(ValueError):
+    """The request body is encoded in a way we can not decode"""
+
+
+class DecodedStream(object):
+    """Read a compressed stream as plain bytes, `size` at most at a time,
+    so a small body can not expand into a huge buffer
+    """
+
+    def __init__(self, stream, encoding, read_size=64 * 1024):
+        encoding = (encoding or '').strip().lower()
+        if encoding not in ENCODINGS:
+            raise UnsupportedEncoding(encoding)
+        self.stream = stream
+        self.read_size = read_size
+        self._dec = zlib.decompressobj(ENCODINGS[encoding])
+        self._buf = b''
+        self._eof = False
+
+    def _fill(self, size):
+        while len(self._buf) < size and not self._eof:
+            if self._dec.unconsumed_tail:
+                raw = self._dec.unconsumed_tail
+            else:
+                raw = self.stream.read(self.read_size)
+            if not raw:
+                self._buf += self._dec.flush()
+                self._eof = True
+                break
+            self._buf += self._dec.decompress(raw, size - len(self._buf))
+
+    def read(self, size):
+        self._fill(size)
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def readline(self, limit=1024 * 1024):
+        while b'\n' not in self._buf and len(self._buf) < limit and \
+                not self._eof:
+            self._fill(len(self._buf) + self.read_size)
+        end = self._buf.find(b'\n')
+        end = limit if end < 0 else min(end + 1, limit)
+        data, self._buf = self._buf[:end], self._buf[end:]
+        return data
+
+
+def request_stream(stream, encoding=None):
+    """Return `stream`, or a DecodedStream of it for an encoded body"""
+    if not encoding or encoding.strip().lower() == 'identity':
+        return stream
+    return DecodedStream(stream, encoding)
+
+
+def _lock_of(log_file):
+    with _locks_lock:
+        return _locks.setdefault(log_file, threading.Lock())
+
+
+def committed_length(log_file):
+    try:
+        return os.path.getsize(log_file)
+    except OSError:
+        return 0
+
+
+def write_chunk(log_file, offset, data, truncate=False):
+    """Write `data` at `offset` of `log_file` and return the committed
+    length of the file. Raise ChunkGapError if `offset` is beyond it.
+
+    With `truncate` the file is cut at `offset` first, a client sends its
+    file again from the start that way after it was truncated or replaced.
+    """
+    log_path = os.path.dirname(log_file)
+    try:
+        os.makedirs(log_path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    with _lock_of(log_file):
+        fd = os.open(log_file, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            size = os.fstat(fd).st_size
+            if offset > size:
+                raise ChunkGapError(size)
+            if truncate:
+                os.ftruncate(fd, offset)
+                size = offset
+
+            os.lseek(fd, offset, os.SEEK_SET)
+            view = memoryview(data)
+            while view:
+                n = os.write(fd, view)
+                view = view[n:]
+            return max(size, offset + len(data))
+        finally:
+            os.close(fd)
@@ -0,0 +1,260 @@
+"""Upload test records to a polarion test run in batches
+
+A batch of records goes in with a single update of the test run instead of
+a request per record. The first update is checked on the server, if the
+test run didn't keep its records they are added one by one as before. The
+pace follows the server: a slow answer or an error makes the next request
+wait longer, quick answers shorten the wait again. Every batch uploaded is
+written to a journal, an upload interrupted halfway resumes on the same
+test run after the last batch in the journal.
+"""
+import os
+import time
+import json
+import logging
+import datetime
+import functools
+from collections import Counter
+import attr
+try:
+    from pylarion.test_record import TestRecord
+except ImportError:
+    TestRecord = None
+
+log = logging.getLogger('bender')
+
+JOURNAL_FILE = 'polarion_upload.journal'
+BATCH_SIZE = 50
+
+
+def _comment(test_result):
+    if test_result == 'passed':
+        return "pass without error"
+    return "failed, detail in attatched log"
+
+
+def make_test_record(test_case_id, test_result, executed_by='yaniwang',
+                     executed=None, duration=66.6):
+    rec = TestRecord()
+    rec.test_case_id = test_case_id
+    rec.result = test_result
+    rec.comment = _comment(test_result)
+    rec.executed_by = executed_by
+    rec.executed = executed or datetime.datetime.now()
+    rec.duration = duration
+    return rec
+
+
+def add_test_record(tr, test_case_id, test_result, executed_by='yaniwang',
+                    executed=None, duration=66.6):
+    """Add a record to the test run `tr` by a request of its own"""
+    tr.add_test_record_by_fields(
+        test_case_id=test_case_id,
+        test_result=test_result,
+        test_comment=_comment(test_result),
+        executed_by=executed_by,
+        executed=executed or datetime.datetime.now(),
+        duration=duration)
+
+
+@attr.s
+class RateLimiter(object):
+    """Wait between requests as long as the server seems to need
+
+    The wait doubles on an error and halves on a quick answer, an answer
+    slower than `slow` seconds makes the next request wait as long.
+    """
+    min_interval = attr.ib(default=0.0)
+    max_interval = attr.ib(default=60.0)
+    slow = attr.ib(default=5.0)
+    interval = attr.ib(default=0.0)
+    clock = attr.ib(default=time.time, repr=False)
+    sleep = attr.ib(default=time.sleep, repr=False)
+    _last = attr.ib(default=None, repr=False)
+
+    def wait(self):
+        if self._last is not None:
+            delay = self._last + self.interval - self.clock()
+            if delay > 0:
+                self.sleep(delay)
+        self._last = self.clock()
+
+    def _set(self, interval):
+        self.interval = min(self.max_interval,
+                            max(self.min_interval, interval))
+
+    def succeeded(self, elapsed):
+        if elapsed > self.slow:
+            self._set(max(self.interval, elapsed))
+        else:
+            self._set(self.interval / 2)
+
+    def failed(self):
+        self._set(max(self.interval * 2, 1.0))
+
+
+@attr.s
+class UploadJournal(object):
+    """Json lines of the test run and of the records uploaded to it
+
+        {"test_run": "RHVH_4_1_06011000"}
+        {"test_run": "RHVH_4_1_06011000",
+         "records": [["ati_fc_04.ks", "RHEVM-1"], ...]}
+        {"test_run": "RHVH_4_1_06011000", "finished": true}
+    """
+    path = attr.ib()
+
+    def _lines(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as fp:
+            for line in fp:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # the last line of an upload cut short
+                    continue
+
+    def test_run_id(self):
+        """The test run of an unfinished upload, None if there is none"""
+        test_run_id = None
+        for entry in self._lines():
+            test_run_id = entry['test_run']
+            if entry.get('finished'):
+                test_run_id = None
+        return test_run_id
+
+    def uploaded(self, test_run_id):
+        done = set()
+        for entry in self._lines():
+            if entry['test_run'] == test_run_id:
+                done.update(tuple(r) for r in entry.get('records', []))
+        return done
+
+    def _append(self, entry):
+        with open(self.path, 'a') as fp:
+            fp.write(json.dumps(entry) + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    def started(self, test_run_id):
+        self._append({'test_run': test_run_id})
+
+    def add(self, test_run_id, records):
+        self._append({'test_run': test_run_id,
+                      'records': [list(r) for r in records]})
+
+    def finished(self, test_run_id):
+        self._append({'test_run': test_run_id, 'finished': True})
+
+
+@attr.s
+class BulkExporter(object):
+    """Add records to the test run `tr` a batch per update
+
+    The records are (ks, test case id, result) tuples, blocked results
+    are not uploaded. A failed request is retried `retries` times with an
+    exponential backoff before giving up.
+
+    `reload` returns the test run as the server has it. The first batch
+    is checked with it, when the update didn't keep the records they are
+    added one by one with `add_record` from then on.
+    """
+    tr = attr.ib()
+    journal = attr.ib(default=None)
+    batch_size = attr.ib(default=BATCH_SIZE)
+    retries = attr.ib(default=5)
+    backoff = attr.ib(default=2.0)
+    limiter = attr.ib(default=attr.Factory(RateLimiter))
+    make_record = attr.ib(default=make_test_record, repr=False)
+    reload = attr.ib(default=None, repr=False)
+    add_record = attr.ib(default=add_test_record, repr=False)
+    bulk = attr.ib(default=True)
+    _verified = attr.ib(default=False, repr=False)
+
+    def _pending(self, records):
+        done = set()
+        unknown = Counter()
+        if self.journal:
+            done = self.journal.uploaded(self.tr.test_run_id)
+            # an update may have reached the server while its journal
+            # entry didn't make it to the disk, its records are on the
+            # test run already
+            unknown.update(r.test_case_id for r in self.tr.records or [])
+            unknown.subtract(case for _, case in done)
+        pending = []
+        for r in records:
+            if r[2] not in ('passed', 'failed') or r[:2] in done:
+                continue
+            if unknown[r[1]] > 0:
+                unknown[r[1]] -= 1
+                continue
+            pending.append(r)
+        return pending
+
+    def _request(self, func, count):
+        for attempt in range(self.retries + 1):
+            self.limiter.wait()
+            started = self.limiter.clock()
+            try:
+                func()
+            except Exception as e:
+                self.limiter.failed()
+                if attempt == self.retries:
+                    raise
+                log.warning("Upload of %d records failed (%s), retry", count,
+                            e)
+                self.limiter.sleep(self.backoff ** attempt)
+            else:
+                self.limiter.succeeded(self.limiter.clock() - started)
+                return
+
+    def _journal(self, records):
+        if self.journal:
+            self.journal.add(self.tr.test_run_id, [r[:2] for r in records])
+
+    def _update(self, batch):
+        uploaded = list(self.tr.records or [])
+        new = [self.make_record(case, result) for _, case, result in batch]
+
+        def update():
+            # the whole list is set again, a retry after an update which
+            # reached the server doesn't add the batch twice
+            self.tr.records = uploaded + new
+            self.tr.update()
+        self._request(update, len(batch))
+
+    def _kept(self, batch):
+        """Whether the test run on the server has the records of `batch`"""
+        tr = self.reload()
+        cases = Counter(r.test_case_id for r in tr.records or [])
+        if all(cases[case] > 0 for _, case, _ in batch):
+            return True
+        self.tr = tr
+        return False
+
+    def _send(self, batch):
+        if self.bulk:
+            self._update(batch)
+            if self._verified or self.reload is None or self._kept(batch):
+                self._verified = True
+                self._journal(batch)
+                return
+            log.warning("Test run %s doesn't keep the records of an "
+                        "update, add them one by one", self.tr.test_run_id)
+            self.bulk = False
+
+        for record in batch:
+            self._request(functools.partial(self.add_record, self.tr,
+                                            record[1], record[2]), 1)
+            self._journal([record])
+
+    def upload(self, records):
+        """Upload the records not in the journal yet, return how many were
+        uploaded"""
+        pending = self._pending(records)
+        for i in range(0, len(pending), self.batch_size):
+            self._send(pending[i:i + self.batch_size])
+            log.info("Uploaded %d/%d records",
+                     min(i + self.batch_size, len(pending)), len(pending))
+        return len(pending)
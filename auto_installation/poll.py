@@ -0,0 +1,103 @@
+"""Wait for something to happen by asking again and again
+
+The first questions come quickly and the wait between two of them doubles
+up to a ceiling, with some jitter so that hosts waiting together don't
+ask the engine at the same moment. A host up in 4 minutes is seen then,
+not at the next multiple of a fixed 5 minutes sleep.
+"""
+import time
+import random
+import logging
+import threading
+
+log = logging.getLogger('bender')
+
+# scope -> name -> [waits, seconds waited in all, longest wait, waits
+# timed out], the waits of a thread count in the scope it is bound to, e.g.
+# the job it works for
+_stats = {}
+_stats_lock = threading.Lock()
+_scopes = {}
+
+
+def bind_scope(scope, ident=None):
+    ident = ident or threading.current_thread().ident
+    _scopes[ident] = scope
+
+
+def unbind_scope(ident=None):
+    ident = ident or threading.current_thread().ident
+    _scopes.pop(ident, None)
+
+
+def current_scope():
+    return _scopes.get(threading.current_thread().ident)
+
+
+def _record(name, waited, timed_out):
+    with _stats_lock:
+        stat = _stats.setdefault(current_scope(), {}).setdefault(
+            name, [0, 0.0, 0.0, 0])
+        stat[0] += 1
+        stat[1] += waited
+        stat[2] = max(stat[2], waited)
+        if timed_out:
+            stat[3] += 1
+
+
+def get_wait_stats(scope=None):
+    """Return {name: (waits, seconds in all, longest, timed out)} of the
+    waits in `scope`"""
+    with _stats_lock:
+        return {name: tuple(stat)
+                for name, stat in _stats.get(scope, {}).items()}
+
+
+def reset_wait_stats(scope=None):
+    with _stats_lock:
+        _stats.pop(scope, None)
+
+
+def poll(check, timeout, name=None, delay=0, interval=5, max_interval=60,
+         factor=2, jitter=0.1, sleep=time.sleep, clock=time.time):
+    """Call `check` until it returns something true, return that
+
+    Args:
+        check: returns a true value when the wait is over, raises if
+            what it waits for can't happen any more
+        timeout: seconds after which the last value of `check`, a false
+            one, is returned
+        name: what is waited for, the key of the wait stats
+        delay: seconds before the first call
+        interval, max_interval, factor: the wait before the next call
+            starts at `interval` and is multiplied by `factor` after each
+            call, up to `max_interval`
+        jitter: the part of a wait picked at random
+    """
+    name = name or getattr(check, '__name__', 'poll')
+    started = clock()
+    deadline = started + timeout
+    wait = interval
+    calls = 0
+    ret = None
+    timed_out = False
+    try:
+        if delay:
+            sleep(min(delay, timeout))
+        while True:
+            ret = check()
+            calls += 1
+            if ret:
+                return ret
+            left = deadline - clock()
+            if left <= 0:
+                timed_out = True
+                log.error("gave up waiting for %s after %.0fs", name,
+                          clock() - started)
+                return ret
+            sleep(min(left, wait * random.uniform(1 - jitter, 1 + jitter)))
+            wait = min(wait * factor, max_interval)
+    finally:
+        waited = clock() - started
+        _record(name, waited, timed_out)
+        log.info("waited %.1fs for %s, %d calls", waited, name, calls)
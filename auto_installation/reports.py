@@ -1,7 +1,7 @@
 import os
 import time
 import argparse
-import datetime
+import functools
 try:
     from pylarion.test_run import TestRun
 except ImportError:
@@ -10,7 +10,9 @@ from constants import TR_ID, TR_PROJECT_ID, TR_TPL, LOG_URL
 from const_install import KS_PRESSURE_MAP
 import re
 import json
-from utils import get_testcase_map
+from utils import get_testcase_index
+from checkresults import read_runs, RESULTS_FILE as CHECK_RESULTS_FILE
+from polarion_upload import BulkExporter, UploadJournal, JOURNAL_FILE
 from collections import OrderedDict
 
 import ssl
@@ -48,72 +50,58 @@ class ResultsToPolarion(object):
                              TR_TPL.format(level))
         return ret
 
-    def export_to_polarion(
-            self,
-            tr,
-            test_case_id,
-            test_result,  # passed or failed
-            test_comment="pass without error",
-            executed_by='yaniwang',  # krb_id
-            executed=datetime.datetime.now(),
-            duration=66.6):
-
-        if test_result == 'passed':
-            tr.add_test_record_by_fields(
-                test_case_id=test_case_id,
-                test_result=test_result,
-                test_comment=test_comment,
-                executed_by=executed_by,
-                executed=executed,
-                duration=duration)
-        elif test_result == 'failed':
-            tr.add_test_record_by_fields(
-                test_case_id=test_case_id,
-                test_result=test_result,
-                test_comment="failed, detail in attatched log",
-                executed_by=executed_by,
-                executed=executed,
-                duration=duration)
-        else:
-            # TODO deal with blocked
-            pass
-
-    def _parse_checkpoints(self, res):
-        ks = res.split('/')[-2]
+    def _merge_runs(self, ks, rets, iqns):
+        """Merge the results of every run of `ks`, a ks of KS_PRESSURE_MAP
+        is installed several times and every install must pass
+        """
         if ks in KS_PRESSURE_MAP:
             num = int(KS_PRESSURE_MAP[ks])
         else:
             num = 1
 
-        p1 = re.compile(r"{'RHEVM-\d")
-        p2 = re.compile(r'InitiatorName=iqn')
-        rets = []
-        iqns = []
-        if os.path.exists(res):
-            for line in open(res):
-                if p1.search(line):
-                    rets.append(eval(line.split("::")[-1]))
-                if p2.search(line):
-                    iqns.append(line.split(":")[-1].rstrip("')\n"))
-
         retNum = len(rets)
         if retNum != num:
             newret = {}
         else:
-            newret = rets[0]
+            newret = dict(rets[0])
             if num > 1:
                 for ret in rets[1:]:
                     for k in newret:
-                        newret[k] = newret[k] and ret[k]
+                        if ret.get(k) != 'passed':
+                            newret[k] = 'failed'
 
                 if len(iqns) == num and len(set(iqns)) != num:
-                    testcase_map = get_testcase_map()
-                    for k, v in testcase_map.items():
-                        if 'iqn_check' in v and k in newret:
-                            newret[k] = False
+                    for k in get_testcase_index().cases_of_checkpoint(
+                            'iqn_check'):
+                        if k in newret:
+                            newret[k] = 'failed'
                             break
         return newret
 
+    def _read_checkpoint_results(self, res):
+        """Results of the ks from its json-lines results file"""
+        ks = res.split('/')[-2]
+        runs = [run for run in read_runs(res) if run['cases']]
+        iqns = [run['iqn'] for run in runs if run.get('iqn')]
+        return self._merge_runs(ks, [run['cases'] for run in runs], iqns)
+
+    def _parse_checkpoints(self, res):
+        """Results of the ks from its checkpoints log, for the runs older
+        than the json-lines results"""
+        ks = res.split('/')[-2]
+
+        p1 = re.compile(r"{'RHEVM-\d")
+        p2 = re.compile(r'InitiatorName=iqn')
+        rets = []
+        iqns = []
+        if os.path.exists(res):
+            for line in open(res):
+                if p1.search(line):
+                    rets.append(eval(line.split("::")[-1]))
+                if p2.search(line):
+                    iqns.append(line.split(":")[-1].rstrip("')\n"))
+        return self._merge_runs(ks, rets, iqns)
+
     def _gen_title(self):
         src_ver = self.source_build.split('-')[-2].replace('.', '_')
         src_build_name = self.source_build.replace('redhat-virtualization-host', 'rhvh')
@@ -147,7 +135,12 @@ class ResultsToPolarion(object):
         failed_num = 0
         for a, b, c in os.walk(root_path):
             for ks in sorted(b):
-                ret = self._parse_checkpoints(os.path.join(a, ks, 'checkpoints'))
+                results_file = os.path.join(a, ks, CHECK_RESULTS_FILE)
+                if os.path.exists(results_file):
+                    ret = self._read_checkpoint_results(results_file)
+                else:
+                    ret = self._parse_checkpoints(
+                        os.path.join(a, ks, 'checkpoints'))
                 final_results[self.source_build][ks] = ret
                 actual_run_cases.extend(list(ret.keys()))
                 values = list(ret.values())
@@ -155,9 +148,10 @@ class ResultsToPolarion(object):
                 failed_num = failed_num + values.count('failed')
             break
 
-        need_run_cases = list(get_testcase_map().keys())
+        need_run_cases = list(get_testcase_index().testcases.keys())
         final_results['sum'] = OrderedDict()
         final_results['sum']['title'] = self._gen_title()
+        final_results['sum']['test_flag'] = self.test_flag
         final_results['sum']['log_url'] = self._gen_log_url()
         final_results['sum']['total'] = len(need_run_cases)
         final_results['sum']['passed'] = pass_num
@@ -195,21 +189,32 @@ class ResultsToPolarion(object):
 
         title = final_results.get("sum").get("title")
 
-        tr = self.create_testrun(title)
-        tr.group_id = self.source_build
-        tr.description = '{} with {}'.format(title, ks_list)
-        tr.status = 'finished'
-        tr.update()
+        # an upload cut short goes on with the test run it created
+        journal = UploadJournal(
+            os.path.join(os.path.dirname(jfile), JOURNAL_FILE))
+        test_run_id = journal.test_run_id()
+        if test_run_id:
+            print "Resume the upload to {}".format(test_run_id)
+            tr = TestRun(project_id=TR_PROJECT_ID, test_run_id=test_run_id)
+        else:
+            tr = self.create_testrun(title)
+            tr.group_id = self.source_build
+            tr.description = '{} with {}'.format(title, ks_list)
+            tr.status = 'finished'
+            tr.update()
+            journal.started(tr.test_run_id)
 
         print tr.uri
         print tr.test_run_id
 
-        rets = final_results.get(self.source_build).values()
-        for ret in rets:
-            for k, v in ret.items():
-                self.export_to_polarion(tr, k, v)
-                print "be nice with server, sleep 1 sec"
-                time.sleep(1)
+        records = []
+        for ks, ret in sorted(final_results.get(self.source_build).items()):
+            for k, v in sorted(ret.items()):
+                records.append((ks, k, v))
+        BulkExporter(tr, journal, reload=functools.partial(
+            TestRun, project_id=TR_PROJECT_ID,
+            test_run_id=tr.test_run_id)).upload(records)
+        journal.finished(tr.test_run_id)
 
         print "Transport results to polarion finished."
 
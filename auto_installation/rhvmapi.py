@@ -1,7 +1,7 @@
 import logging
 import base64
-import requests
-import shutil
+from rhvmconn import get_rhevm_connection
+from poll import poll
 from time import sleep
 
 log = logging.getLogger('bender')
@@ -23,11 +23,6 @@ class RhevmAction:
         "Content-type": "application/xml"
     }
 
-    cert_url = ("https://{rhevm_fqdn}/ovirt-engine/services"
-                "/pki-resource?resource=ca-certificate&format=X509-PEM-CA")
-
-    rhevm_cert = "/tmp/rhevm.cert"
-
     def __init__(self,
                  rhevm_fqdn,
                  user="admin",
@@ -41,26 +36,18 @@ class RhevmAction:
         self.token = base64.b64encode(
             self.auth_format.format(
                 user=self.user, domain=self.domain, password=self.password))
+        self.headers = dict(self.headers)
         self.headers.update({
-            "Authorization":
-            "Basic {token}".format(token=self.token)
+            "Authorization": "Basic {token}".format(token=self.token)
         })
-        self._get_rhevm_cert_file()
-        self.req = requests.Session()
-
-    def _get_rhevm_cert_file(self):
-        r = requests.get(
-            self.cert_url.format(rhevm_fqdn=self.rhevm_fqdn),
-            stream=True,
-            verify=False)
-
-        if r.status_code == 200:
-            with open(self.rhevm_cert, 'wb') as f:
-                r.raw.decode_content = True
-                shutil.copyfileobj(r.raw, f)
-        else:
-            raise RuntimeError("Can not get the cert file from %s" %
-                               self.rhevm_fqdn)
+        # session and cert are shared by all instances of the same engine
+        self._conn = get_rhevm_connection(self.rhevm_fqdn, self.token)
+        self.rhevm_cert = self._conn.cert
+        self.req = self._conn.session
+
+    @property
+    def round_trips(self):
+        return self._conn.round_trips
 
     ###################################
     # Datacenter related functions
@@ -110,7 +97,11 @@ class RhevmAction:
         api_url = self.api_url.format(
             rhevm_fqdn=self.rhevm_fqdn, item="datacenters")
 
-        r = self.req.get(api_url, headers=self.headers, verify=self.rhevm_cert)
+        r = self.req.get(
+            api_url,
+            headers=self.headers,
+            verify=self.rhevm_cert,
+            params={'search': 'name=%s' % dc_name})
 
         if r.status_code != 200:
             raise RuntimeError("Can not list datacenters from %s" %
@@ -175,7 +166,11 @@ class RhevmAction:
         api_url = self.api_url.format(
             rhevm_fqdn=self.rhevm_fqdn, item="clusters")
 
-        r = self.req.get(api_url, headers=self.headers, verify=self.rhevm_cert)
+        r = self.req.get(
+            api_url,
+            headers=self.headers,
+            verify=self.rhevm_cert,
+            params={'search': 'name=%s' % cluster_name})
 
         if r.status_code != 200:
             raise RuntimeError("Can not list clusters from %s" %
@@ -282,7 +277,28 @@ class RhevmAction:
 
     def list_host(self, key=None, value=None):
         api_url = self.api_url.format(rhevm_fqdn=self.rhevm_fqdn, item="hosts")
-        r = self.req.get(api_url, headers=self.headers, verify=self.rhevm_cert)
+        # let the engine do the filtering instead of fetching all hosts
+        if key == 'id':
+            r = self.req.get(
+                api_url + '/%s' % value,
+                headers=self.headers,
+                verify=self.rhevm_cert)
+            if r.status_code == 404:
+                return None
+            if r.status_code != 200:
+                raise RuntimeError("Can not get host %s from %s" %
+                                   (value, self.rhevm_fqdn))
+            return r.json()
+        elif key == 'name':
+            params = {'search': 'name=%s' % value}
+        else:
+            params = None
+
+        r = self.req.get(
+            api_url,
+            headers=self.headers,
+            verify=self.rhevm_cert,
+            params=params)
 
         if r.status_code != 200:
             raise RuntimeError("Can not list hosts from %s" % self.rhevm_fqdn)
@@ -315,22 +331,19 @@ class RhevmAction:
                 log.info("r.status_code is %d", r.status_code)
                 raise RuntimeError("Failed to execute upgradecheck.")
 
-        count_max = 13
-        sleep_time = 300
+        timeout = 13 * 300
+        max_interval = 300
         # if rhvm_version == "rhvm41":
         if rhvm_version != "rhvm40":
-            count_max = 10
-            sleep_time = 30
-
-        count = 0
-        while (count < count_max):
-            sleep(sleep_time)
-            update_available = self.list_host(
-                key="id", value=host_id)['update_available']
-            if update_available == 'true':
-                break
-            count = count + 1
-        else:
+            timeout = 10 * 30
+            max_interval = 30
+
+        def update_available():
+            return self.list_host(
+                key="id", value=host_id)['update_available'] == 'true'
+
+        if not poll(update_available, timeout, name='update available',
+                    delay=10, interval=10, max_interval=max_interval):
             log.error("update is not available.")
             return False
 
@@ -414,15 +427,12 @@ class RhevmAction:
             # check upgrade status
             description = 'Host {} upgrade was completed successfully'.format(
                 host_name)
-            count = 0
-            while (count < 4):
-                sleep(300)
-                if self._get_host_event_by_des(host_name, description):
-                    log.info(description)
-                    break
-                count = count + 1
-            else:
+            if not poll(
+                    lambda: self._get_host_event_by_des(host_name, description),
+                    4 * 300, name='upgrade of %s' % host_name, delay=60,
+                    interval=15, max_interval=60):
                 raise RuntimeError("Upgrade host %s failed." % host_name)
+            log.info(description)
         else:
             raise RuntimeError("Can't find host with name %s" % host_name)
 
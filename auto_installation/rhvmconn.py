@@ -0,0 +1,108 @@
+"""Keep-alive http sessions and ca certs shared by all RhevmAction of an
+engine, used by both rhvmapi and vdsmapi
+"""
+import os
+import time
+import shutil
+import logging
+import tempfile
+import threading
+import attr
+import requests
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger('bender')
+
+CERT_URL = ("https://{rhevm_fqdn}/ovirt-engine/services"
+            "/pki-resource?resource=ca-certificate&format=X509-PEM-CA")
+CERT_FILE = "/tmp/rhevm-{rhevm_fqdn}.cert"
+POOL_MAXSIZE = 10
+
+
+class RhevmSession(requests.Session):
+    """Session which fetches the ca cert of the engine again when the
+    cached one doesn't verify, the engine may have been reinstalled"""
+    conn = None
+
+    def request(self, *args, **kwargs):
+        started = time.time()
+        try:
+            return requests.Session.request(self, *args, **kwargs)
+        except requests.exceptions.SSLError as e:
+            if self.conn is None or kwargs.get('verify') != self.conn.cert:
+                raise
+            log.warning("%s, fetch the cert of %s again", e,
+                        self.conn.rhevm_fqdn)
+            self.conn.refresh_cert(started)
+            return requests.Session.request(self, *args, **kwargs)
+
+
+@attr.s
+class RhevmConnection(object):
+    rhevm_fqdn = attr.ib()
+    session = attr.ib(default=attr.Factory(RhevmSession), repr=False)
+    cert = attr.ib(default=None)
+    round_trips = attr.ib(default=0)
+    _lock = attr.ib(default=attr.Factory(threading.Lock), repr=False)
+    _cert_lock = attr.ib(default=attr.Factory(threading.Lock), repr=False)
+
+    def _count(self, r, *args, **kwargs):
+        # the session is shared by the threads of all jobs
+        with self._lock:
+            self.round_trips += 1
+
+    def setup(self):
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE)
+        self.session.mount("https://", adapter)
+        self.session.hooks['response'].append(self._count)
+        self.session.conn = self
+        self.cert = self._get_cert_file()
+
+    def refresh_cert(self, since):
+        """Fetch the cert again, unless another thread did after `since`"""
+        with self._cert_lock:
+            if os.path.exists(self.cert) and \
+                    os.path.getmtime(self.cert) > since:
+                return
+            self._get_cert_file(refresh=True)
+
+    def _get_cert_file(self, refresh=False):
+        cert = CERT_FILE.format(rhevm_fqdn=self.rhevm_fqdn)
+        if not refresh and os.path.exists(cert) and os.path.getsize(cert):
+            return cert
+
+        r = self.session.get(
+            CERT_URL.format(rhevm_fqdn=self.rhevm_fqdn),
+            stream=True,
+            verify=False)
+
+        if r.status_code != 200:
+            raise RuntimeError("Can not get the cert file from %s" %
+                               self.rhevm_fqdn)
+
+        # other engines' jobs may read the same dir at the same time
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cert))
+        with os.fdopen(fd, 'wb') as f:
+            r.raw.decode_content = True
+            shutil.copyfileobj(r.raw, f)
+        os.rename(tmp, cert)
+        log.info("Cached the cert file of %s to %s", self.rhevm_fqdn, cert)
+
+        return cert
+
+
+_conns = {}
+_conns_lock = threading.Lock()
+
+
+def get_rhevm_connection(rhevm_fqdn, token):
+    """Return the connection to `rhevm_fqdn` authenticated with `token`,
+    it is created on first use and reused afterwards
+    """
+    key = (rhevm_fqdn, token)
+    with _conns_lock:
+        if key not in _conns:
+            conn = RhevmConnection(rhevm_fqdn)
+            conn.setup()
+            _conns[key] = conn
+        return _conns[key]
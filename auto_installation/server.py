@@ -1,27 +1,41 @@
 from __future__ import unicode_literals
 # pylint: disable=W0403, C0103
 import os
+import zlib
+import socket
 import base64
+import hashlib
 import json
 import utils
 import subprocess as sp
 
 from flask import Flask, request, redirect, abort, jsonify
 from flask_cors import CORS
+from gevent.socket import wait_read
 
-from .utils import init_redis, setup_funcs, get_lastline_of_file
-from .util_result_index import cache_logs_summary
+from .utils import init_redis, setup_funcs, get_lastline_of_file, \
+    setup_logging, get_machine_ksl_map, JOB_EVENTS_CHANNEL
+from . import logstore
+from .util_result_index import get_logs_summary, query_logs_summary, \
+    get_logs_summary_version, ensure_logs_summary
 from .constants import CURRENT_IP_PORT, BUILDS_SERVER_URL, CB_PROFILE, HOSTS, TEST_LEVEL, PROJECT_ROOT
-from .jobs import job_runner
+from .jobqueue import JobQueue, get_job
+from .kickstarts import RenderCache
 from .cobbler import Cobbler
 from .mongodata import MongoQuery
 from .celerytask import RhvhTask
 from .reports import ResultsToPolarion
 
+setup_logging()
 rd_conn = init_redis()
 IP, PORT = CURRENT_IP_PORT
+UPLOAD_READ_SIZE = 1024 * 1024
+# seconds between the keepalive comments of an idle event stream
+EVENTS_KEEPALIVE = 15
 # ensure singleton instance
 results_logs = utils.results_logs
+job_queue = JobQueue(rd_conn)
+ks_cache = RenderCache()
 mongo = MongoQuery()
 rt = RhvhTask()
 
@@ -45,30 +59,33 @@ def post_result(code):
 def start_job():
     """This method is the trigger function to start a automation test
 
+    The job is queued, it starts as soon as none of its machines is used
+    by another job. The client is redirected to the state of the job, its
+    progress is streamed by /api/v1/jobs/<job_id>/events.
+
     Args:
         img_url (str): /var/www/builds/rhevh/
         rhevh7-ng-36/rhev-hypervisor7-ng-3.6-20160518.0/
         rhev-hypervisor7-ng-3.6-20160518.0.x86_64.liveimg.squashfs
+        machines (list): beaker machines of the job, all machines of the
+        test level by default
+        job_id (str): the id of a job launched by /api/v1/autojob/lanuch
 
     """
     if request.method == 'POST':
-        if rd_conn.get("running") == "0":
-            rd_conn.set("running", 1)
-            data = request.get_json()
-            img_url = data.get('img', None)
-            target_build = data.get('target_build', None)
-            if img_url:
-                _img_url = img_url.replace('/var/www/builds',
-                                           BUILDS_SERVER_URL)
-
-                results_logs.img_url = _img_url
-
-                t = job_runner(_img_url, rd_conn, results_logs, target_build)
-                t.setDaemon(True)
-                t.start()
-                return redirect('/post_result')
-        else:
-            return redirect('/goaway')
+        data = request.get_json()
+        img_url = data.get('img', None)
+        target_build = data.get('target_build', None)
+        if img_url:
+            _img_url = img_url.replace('/var/www/builds', BUILDS_SERVER_URL)
+            try:
+                job = job_queue.submit(_img_url, target_build,
+                                       data.get('machines'),
+                                       data.get('job_id'))
+            except ValueError as e:
+                return jsonify(error=str(e)), 400
+            return redirect('/api/v1/jobs/{}'.format(job.id))
+        abort(400)
     else:
         abort(406)
 
@@ -109,24 +126,188 @@ def done_job(em1ip, bkr_name, cockpit=None):
         return "cockpit done job"
 
 
+@app.route('/ks/<token>/<bkr_name>/<ks_file>')
+def get_kickstart(token, bkr_name, ks_file):
+    """The kickstart `ks_file` of machine `bkr_name` installing the liveimg
+    of the job `token`.
+
+    The installer fetches it again on every retry, the ETag saves sending
+    it twice.
+    """
+    job = get_job(rd_conn, token)
+    if not job or bkr_name not in job['machines'] or bkr_name not in HOSTS:
+        abort(404)
+    # only the kickstarts queued for the machine
+    if ks_file not in get_machine_ksl_map().get(bkr_name, ()):
+        abort(404)
+    try:
+        etag, content = ks_cache.get(ks_file.encode('utf-8'),
+                                     job['img_url'].encode('utf-8'),
+                                     bkr_name.encode('utf-8'),
+                                     token.encode('utf-8'))
+    except (IOError, OSError):
+        abort(404)
+
+    if request.if_none_match.contains(etag):
+        return app.response_class(status=304, headers={'ETag': '"%s"' % etag})
+    res = app.response_class(content, mimetype='text/plain')
+    res.set_etag(etag)
+    return res
+
+
+def _current_logs():
+    """Logs of the job started last, anamon uploads go there"""
+    job = job_queue.latest
+    return job.results_logs if job else results_logs
+
+
+def _log_path(token=None, bkr_name=None):
+    """Log directory of the kickstart machine `bkr_name` of job `token`
+    installs, the anamon of kickstarts without a job uploads to the job
+    started last
+    """
+    if token is None:
+        return _current_logs().current_log_path
+    job = job_queue.get(token)
+    log_path = job and job.results_logs and \
+        job.results_logs.machine_log_path(bkr_name)
+    if not log_path:
+        # the job is over, or the machine isn't one of it
+        abort(410)
+    return log_path
+
+
+def _path_part(name):
+    """`name` if it is a single entry of a directory, abort otherwise, a
+    stage or log name of an upload never leaves the log directory"""
+    if not name or name in ('.', '..') or os.path.basename(name) != name:
+        abort(400)
+    return name
+
+
+def _log_file(stage, log_name, token=None, bkr_name=None):
+    return os.path.join(_log_path(token, bkr_name), _path_part(stage),
+                        _path_part(log_name))
+
+
+def _upload_stream():
+    """The request body, decoded if anamon compressed it"""
+    try:
+        return logstore.request_stream(
+            request.stream, request.headers.get('Content-Encoding'))
+    except logstore.UnsupportedEncoding:
+        abort(415)
+
+
+@app.after_request
+def advertise_upload_encodings(response):
+    # anamon only compresses its uploads once it sees this header, so the
+    # old servers still get plain bodies
+    if request.path.startswith('/upload/v'):
+        response.headers['X-Accept-Encoding'] = logstore.ACCEPT_ENCODING
+    return response
+
+
 @app.route('/upload/<stage>/<log_name>/<offset>')
 def upload_anaconda_log(stage, log_name, offset):
+    """Legacy upload of base64 blocks in a json body, kept for the anamon
+    of older installers
+    """
     _data = request.get_json()
     data = base64.decodestring(_data['data'])
-    log_file = os.path.join(results_logs.current_log_path, stage, log_name)
-    log_path = os.path.dirname(log_file)
-
-    if not os.path.exists(log_path):
-        os.system("mkdir -p {}".format(log_path))
+    log_file = _log_file(stage, log_name)
 
     if offset != '-1':
-        with open(log_file, 'w') as fp:
-            fp.seek(int(offset))
-            fp.write(data)
-            fp.flush()
+        try:
+            logstore.write_chunk(log_file, int(offset), data)
+        except logstore.ChunkGapError as e:
+            return jsonify(committed=e.committed), 409
     return "upload done"
 
 
+@app.route('/upload/v1/<stage>/<log_name>', methods=['GET'])
+@app.route('/upload/v1/<token>/<bkr_name>/<stage>/<log_name>', methods=['GET'])
+def get_uploaded_log_length(stage, log_name, token=None, bkr_name=None):
+    log_file = _log_file(stage, log_name, token, bkr_name)
+    return jsonify(committed=logstore.committed_length(log_file))
+
+
+@app.route('/upload/v1/<stage>/<log_name>/<int:offset>', methods=['PUT', 'POST'])
+@app.route('/upload/v1/<token>/<bkr_name>/<stage>/<log_name>/<int:offset>',
+           methods=['PUT', 'POST'])
+def upload_log_chunk(stage, log_name, offset, token=None, bkr_name=None):
+    """Write the raw request body at `offset` of the log, return the length
+    the server has committed, clients continue from there. With
+    ?truncate=1 the log is cut at `offset` first.
+    """
+    log_file = _log_file(stage, log_name, token, bkr_name)
+    committed = logstore.committed_length(log_file)
+    truncate = request.args.get('truncate') == '1'
+    stream = _upload_stream()
+    try:
+        while True:
+            data = stream.read(UPLOAD_READ_SIZE)
+            if not data:
+                break
+            committed = logstore.write_chunk(log_file, offset, data,
+                                             truncate)
+            truncate = False
+            offset += len(data)
+    except logstore.ChunkGapError as e:
+        return jsonify(committed=e.committed), 409
+    except zlib.error:
+        abort(400)
+    return jsonify(committed=committed)
+
+
+@app.route('/upload/v2/<stage>', methods=['POST'])
+@app.route('/upload/v2/<token>/<bkr_name>/<stage>', methods=['POST'])
+def upload_log_chunks(stage, token=None, bkr_name=None):
+    """Write chunks of several logs sent in one request.
+
+    The body is a json manifest line, [{"name", "offset", "size"}, ...],
+    followed by the bytes of every chunk in the same order. A chunk with
+    "truncate" set cuts its log at the offset first. Return the committed
+    length of each log, {name: committed}.
+    """
+    log_path = os.path.join(_log_path(token, bkr_name), _path_part(stage))
+    stream = _upload_stream()
+    try:
+        manifest = json.loads(stream.readline())
+    except (ValueError, zlib.error):
+        abort(400)
+    # nothing is written when a name is wrong
+    for chunk in manifest:
+        _path_part(chunk['name'])
+
+    committed = {}
+    for chunk in manifest:
+        log_name = chunk['name']
+        log_file = os.path.join(log_path, log_name)
+        offset, left = chunk['offset'], chunk['size']
+        truncate = bool(chunk.get('truncate'))
+        while left > 0:
+            try:
+                data = stream.read(min(left, UPLOAD_READ_SIZE))
+            except zlib.error:
+                abort(400)
+            if not data:
+                abort(400)
+            left -= len(data)
+            if log_name in committed and offset > committed[log_name]:
+                # the earlier part of this chunk was rejected
+                continue
+            try:
+                committed[log_name] = logstore.write_chunk(
+                    log_file, offset, data, truncate)
+            except logstore.ChunkGapError as e:
+                committed[log_name] = e.committed
+            truncate = False
+            offset += len(data)
+        committed.setdefault(log_name, logstore.committed_length(log_file))
+    return jsonify(committed)
+
+
 # =========== api section =====================================================
 
 
@@ -135,16 +316,77 @@ def get_current_status():
     ret = {
         'cb_profile': CB_PROFILE,
         'running': rd_conn.get("running"),
+        'jobs': job_queue.status(),
         'test_level': TEST_LEVEL,
         'hosts': HOSTS
     }
     return jsonify(ret)
 
 
+@app.route('/api/v1/jobs')
+def get_jobs():
+    return jsonify(job_queue.status())
+
+
+@app.route('/api/v1/jobs/<job_id>')
+def get_job_state(job_id):
+    job = get_job(rd_conn, job_id)
+    if not job:
+        abort(404)
+    return jsonify(job)
+
+
+def _sse(event, data):
+    return 'event: {}\ndata: {}\n\n'.format(event, data)
+
+
+@app.route('/api/v1/jobs/<job_id>/events')
+def stream_job_events(job_id):
+    """Stream the state changes and log lines of a job as server-sent
+    events, the current state comes first. The stream ends with the job.
+    """
+    pubsub = rd_conn.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(JOB_EVENTS_CHANNEL.format(job_id))
+    # read the state after subscribing, no change is missed in between
+    job = get_job(rd_conn, job_id)
+    if not job:
+        pubsub.close()
+        abort(404)
+
+    def events():
+        try:
+            yield _sse('state', json.dumps(job))
+            if job['state'] == 'done':
+                return
+            conn = pubsub.connection
+            while True:
+                if not conn.can_read():
+                    # only this greenlet waits, other requests go on
+                    try:
+                        wait_read(conn._sock.fileno(),
+                                  timeout=EVENTS_KEEPALIVE)
+                    except socket.timeout:
+                        yield ': keepalive\n\n'
+                    continue
+                msg = pubsub.get_message()
+                if msg is None:
+                    continue
+                event = json.loads(msg['data'])
+                yield _sse(event['type'], msg['data'])
+                if event['type'] == 'state' and event['state'] == 'done':
+                    return
+        finally:
+            pubsub.close()
+
+    return app.response_class(events(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache'})
+
+
 @app.route('/api/v1/current/build')
 def get_current_build():
-    build_path = results_logs.current_log_path
-    log_file = results_logs.current_log_file
+    logs = _current_logs()
+    build_path = logs.current_log_path
+    log_file = logs.current_log_file
     ret = {'path': build_path, 'log': get_lastline_of_file(log_file)}
     return jsonify(ret)
 
@@ -185,8 +427,10 @@ def auto_job_lanuch():
         with open(cfg, 'w') as fp:
             json.dump(cfg_, fp)
         # abort(401)
-        rt.lanuchAuto(build, pxe, ts_level, target_build)
-        return jsonify("job is launched")
+        # the celery task starts the job by /start later, with this id
+        job = job_queue.announce(build, target_build)
+        rt.lanuchAuto(build, pxe, ts_level, target_build, job.id)
+        return redirect('/api/v1/jobs/{}'.format(job.id))
 
 
 @app.route('/api/v1/upgradejob/lanuch', methods=['POST'])
@@ -209,7 +453,7 @@ def get_last_result():
             "total": -1
         }
     }
-    log_path = os.path.dirname(results_logs.current_log_path)
+    log_path = os.path.dirname(_current_logs().current_log_path)
     result_file = os.path.join(log_path, 'final_results.json')
 
     if not os.path.exists(result_file):
@@ -280,13 +524,43 @@ def git_branchs():
 
 @app.route('/api/v1/logs/summary', methods=['GET'])
 def logs_summary():
-    """_="""
-    res = rd_conn.get('logs_summary')
-    if not res:
-        print("no cache found, generate new cache")
-        cache_logs_summary()
-    res = json.loads(rd_conn.get('logs_summary'))
-    return jsonify(res)
+    """Without any query parameter, return all runs as
+    {date: {"<time>__<build>": [ks_dirs, sum]}}.
+
+    Otherwise return {"total", "page", "limit", "runs"}, filtered by:
+    from/to: dates as YYYY-mm-dd, build: part of the build name,
+    flag: install/upgrade/vdsm, page/limit: 1-based page and its size
+    """
+    # the summary only changes when a run is indexed, so the index version
+    # and the query are enough to tell if the client has it already. The
+    # index is built first, building it changes the version
+    ensure_logs_summary(rd_conn)
+    etag = '{}-{}'.format(
+        get_logs_summary_version(rd_conn),
+        hashlib.md5(request.query_string).hexdigest())
+    if request.if_none_match.contains(etag):
+        return app.response_class(status=304, headers={'ETag': '"%s"' % etag})
+
+    if not request.args:
+        res = jsonify(get_logs_summary(rd_conn))
+    else:
+        try:
+            page = max(int(request.args.get('page', 1)), 1)
+            limit = min(max(int(request.args.get('limit', 20)), 1), 500)
+            total, runs = query_logs_summary(
+                rd_conn,
+                date_from=request.args.get('from'),
+                date_to=request.args.get('to'),
+                build=request.args.get('build'),
+                test_flag=request.args.get('flag'),
+                page=page,
+                limit=limit)
+        except ValueError:
+            abort(400)
+        res = jsonify(total=total, page=page, limit=limit, runs=runs)
+
+    res.set_etag(etag)
+    return res
 
 
 if __name__ == '__main__':
@@ -0,0 +1,241 @@
+"""Persistent ssh connections to the test hosts, one per (host, user).
+
+The connection of a host is kept open for the whole job instead of being
+set up again for every command. It is health checked before each use and
+re-established when the host went away, e.g. rebooted by _enter_system.
+"""
+import os
+import stat
+import time
+import socket
+import logging
+import threading
+import attr
+import paramiko
+
+log = logging.getLogger('bender')
+
+CONNECT_TIMEOUT = 10
+KEEPALIVE_INTERVAL = 30
+
+_NETWORK_ERRORS = (socket.error, EOFError, paramiko.SSHException)
+
+
+class NetworkError(Exception):
+    pass
+
+
+class CommandTimeout(Exception):
+    def __init__(self, timeout):
+        super(CommandTimeout, self).__init__(
+            "Timed out waiting for the command after {} seconds".format(
+                timeout))
+        self.timeout = timeout
+
+
+class CmdResult(str):
+    """Output of a remote command, behaves like the string fabric's run
+    returns
+    """
+
+    @classmethod
+    def make(cls, output, return_code, command):
+        ret = cls(output)
+        ret.return_code = return_code
+        ret.command = command
+        return ret
+
+    @property
+    def succeeded(self):
+        return self.return_code == 0
+
+    @property
+    def failed(self):
+        return not self.succeeded
+
+
+def _shell_escape(cmd):
+    for c in ('\\', '"', '$', '`'):
+        cmd = cmd.replace(c, '\\' + c)
+    return cmd
+
+
+@attr.s
+class SSHConnection(object):
+    host = attr.ib()
+    user = attr.ib()
+    password = attr.ib(default=None, repr=False)
+    port = attr.ib(default=22)
+    connects = attr.ib(default=0)
+    handshake_time = attr.ib(default=0.0)
+    _client = attr.ib(default=None, repr=False)
+    _lock = attr.ib(default=attr.Factory(threading.RLock), repr=False)
+
+    @property
+    def is_alive(self):
+        transport = self._client and self._client.get_transport()
+        if not transport or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except _NETWORK_ERRORS:
+            return False
+        return True
+
+    def _connect(self, attempts):
+        self.close()
+        for i in range(attempts):
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            start = time.time()
+            try:
+                client.connect(
+                    self.host,
+                    port=self.port,
+                    username=self.user,
+                    password=self.password,
+                    timeout=CONNECT_TIMEOUT,
+                    allow_agent=False,
+                    look_for_keys=False)
+            except paramiko.AuthenticationException:
+                raise
+            except _NETWORK_ERRORS as e:
+                log.debug("Connect to %s failed(%d/%d): %s", self.host, i + 1,
+                          attempts, e)
+                if i + 1 < attempts:
+                    time.sleep(1)
+                continue
+
+            self.handshake_time += time.time() - start
+            self.connects += 1
+            client.get_transport().set_keepalive(KEEPALIVE_INTERVAL)
+            self._client = client
+            log.debug("Connected to %s@%s, connects: %d", self.user,
+                      self.host, self.connects)
+            return client
+
+        raise NetworkError("Can not connect to {} after {} attempts".format(
+            self.host, attempts))
+
+    def _open_channel(self, attempts):
+        with self._lock:
+            # a transport that looked alive may still be broken, give it
+            # one more try with a new connection
+            for retry in (True, False):
+                if not self.is_alive:
+                    self._connect(attempts)
+                try:
+                    return self._client.get_transport().open_session(
+                        timeout=CONNECT_TIMEOUT)
+                except _NETWORK_ERRORS:
+                    self.close()
+                    if not retry:
+                        raise
+
+    def run(self, cmd, timeout=None, attempts=60):
+        chan = self._open_channel(attempts)
+        out = []
+        try:
+            chan.get_pty()
+            chan.exec_command('/bin/bash -l -c "{}"'.format(
+                _shell_escape(cmd)))
+            deadline = timeout and time.time() + timeout
+            while True:
+                if deadline:
+                    chan.settimeout(max(deadline - time.time(), 0.01))
+                try:
+                    data = chan.recv(32768)
+                except socket.timeout:
+                    raise CommandTimeout(timeout)
+                if not data:
+                    break
+                out.append(data)
+            return_code = chan.recv_exit_status()
+        finally:
+            chan.close()
+
+        return CmdResult.make(''.join(out).strip(), return_code, cmd)
+
+    def _open_sftp(self, attempts):
+        chan = self._open_channel(attempts)
+        chan.invoke_subsystem('sftp')
+        return paramiko.SFTPClient(chan)
+
+    def get(self, remote_path, local_path, attempts=120):
+        if os.path.isdir(local_path):
+            local_path = os.path.join(local_path,
+                                      os.path.basename(remote_path))
+        sftp = self._open_sftp(attempts)
+        try:
+            sftp.get(remote_path, local_path)
+        finally:
+            sftp.close()
+        return local_path
+
+    def put(self, local_path, remote_path, attempts=120):
+        sftp = self._open_sftp(attempts)
+        try:
+            try:
+                if stat.S_ISDIR(sftp.stat(remote_path).st_mode):
+                    remote_path = os.path.join(remote_path,
+                                               os.path.basename(local_path))
+            except IOError:
+                pass
+            sftp.put(local_path, remote_path)
+        finally:
+            sftp.close()
+        return remote_path
+
+    def close(self):
+        with self._lock:
+            if self._client:
+                self._client.close()
+                self._client = None
+
+
+_conns = {}
+_conns_lock = threading.Lock()
+
+
+def get_connection(host_string, user, password=None):
+    """Return the connection of `user` to `host_string`("host" or
+    "host:port"), it is only really connected when first used
+    """
+    host, _, port = host_string.partition(':')
+    key = (host, int(port or 22), user)
+    with _conns_lock:
+        conn = _conns.get(key)
+        if not conn:
+            conn = _conns[key] = SSHConnection(
+                host, user, password, port=key[1])
+        elif password is not None:
+            conn.password = password
+        return conn
+
+
+def _of_hosts(hosts):
+    with _conns_lock:
+        return [(key, conn) for key, conn in _conns.items()
+                if hosts is None or key[0] in hosts]
+
+
+def close_all(hosts=None):
+    """Close the connections to `hosts`, all connections by default. The
+    connections to `hosts` are forgotten too, with their stats
+    """
+    for key, conn in _of_hosts(hosts):
+        conn.close()
+        if hosts is not None:
+            with _conns_lock:
+                if _conns.get(key) is conn:
+                    del _conns[key]
+
+
+def get_stats(hosts=None):
+    """Return {host: (connects, handshake seconds)} of the connections to
+    `hosts`, of all connections by default"""
+    return {
+        "{}@{}:{}".format(user, host, port):
+        (conn.connects, conn.handshake_time)
+        for (host, port, user), conn in _of_hosts(hosts)
+    }
@@ -27,10 +27,10 @@ import sys
 import string
 import time
 import re
-import base64
 import shlex
 import httplib
 import json
+import zlib
 
 # on older installers (EL 2) we might not have xmlrpclib
 # and can't do logging, however this is more widely
@@ -54,11 +54,13 @@ class WatchedFile:
         self.alias = alias
         self.reset()
 
-        self._headers = {"Content-Type": "application/json", }
-
     def reset(self):
         self.where = 0
         self.last_size = 0
+        self.committed = 0
+        # set when the file is sent again from the start, the server cuts
+        # its copy then
+        self.restart = 0
         self.lfrag = ''
         self.re_list = {}
         self.seen_line = {}
@@ -80,63 +82,175 @@ class WatchedFile:
         if not self.exists():
             return 0
         size = os.stat(self.fn)[6]
-        if size > self.last_size:
-            self.last_size = size
+        if size < self.committed:
+            # the file was truncated or replaced, send it again
+            self.committed = 0
+            self.restart = 1
+        self.last_size = size
+        if size > self.committed:
             return 1
         else:
             return 0
 
-    def _upload_log_data(self, name, alias, sz, offset, data):
-        json_data = json.dumps(dict(data=data))
-        conn = httplib.HTTPConnection(server_ip, server_port)
-
-        conn.request("GET", "/upload/{0}/{1}/{2}".format(stage, alias, offset),
-                     json_data, self._headers)
+    def read_delta(self, maxsize):
+        """return the bytes after what the server has committed"""
+        fo = open(self.fn, "rb")
+        try:
+            fo.seek(self.committed)
+            return fo.read(min(maxsize, self.last_size - self.committed))
+        finally:
+            fo.close()
+
+
+class Uploader:
+    """Send the new bytes of several files in one request per tick, over
+    one http connection kept open for the whole install. A server without
+    /upload/v2 gets a request per file on /upload/v1 instead.
+    """
+
+    def __init__(self, blocksize=2621445, level=6):
+        self.blocksize = blocksize
+        self.level = level
+        self.conn = None
+        # set once the server says it can decode compressed bodies, until
+        # the first answer only a small block is sent in plain
+        self.encoding = None
+        self.negotiated = False
+        self.version = 2
+        self._headers = {"Content-Type": "application/octet-stream", }
+
+    def _connection(self):
+        if self.conn is None:
+            self.conn = httplib.HTTPConnection(server_ip, server_port)
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def request(self, method, url, body):
+        """return the status and the json answer, the answer is None when
+        the server has no such url"""
+        headers = dict(self._headers)
+        if self.encoding:
+            body = zlib.compress(body, self.level)
+            headers["Content-Encoding"] = self.encoding
+        debug("%s %s, %d bytes\n" % (method, url, len(body)))
+        conn = self._connection()
+        conn.request(method, url, body, headers)
         response = conn.getresponse()
+        data = response.read()
+        if response.status == 404:
+            return response.status, None
+        self.negotiate(response)
+        return response.status, json.loads(data)
+
+    def commit(self, files, committed):
+        for wf in files:
+            if wf.alias in committed:
+                wf.committed = committed[wf.alias]
+                wf.restart = 0
+
+    def url(self, version, *parts):
+        """the upload url of the job and machine, when anamon knows them"""
+        parts = [str(p) for p in parts]
+        if job and machine:
+            parts = [job, machine] + parts
+        return "/upload/v%d/%s" % (version, "/".join(parts))
+
+    def first_block(self):
+        if self.negotiated:
+            return self.blocksize
+        return min(self.blocksize, 65536)
+
+    def send(self, files):
+        if self.version == 1:
+            return self.send_v1(files)
+
+        manifest = []
+        chunks = []
+        left = self.first_block()
+        for wf in files:
+            if left <= 0:
+                break
+            data = wf.read_delta(left)
+            if not data:
+                continue
+            chunk = dict(name=wf.alias, offset=wf.committed, size=len(data))
+            if wf.restart:
+                chunk["truncate"] = True
+            manifest.append(chunk)
+            chunks.append(data)
+            left = left - len(data)
+        if not manifest:
+            return True
+
+        body = json.dumps(manifest) + "\n" + "".join(chunks)
+        debug("upload %s\n" % (manifest, ))
+        try:
+            status, committed = self.request(
+                "POST", self.url(2, stage), body)
+        except Exception, e:
+            debug("upload failed: %s\n" % (e, ))
+            # a new connection is made on the next tick
+            self.close()
+            return False
+
+        if committed is None:
+            debug("no /upload/v2 on the server, use /upload/v1\n")
+            self.version = 1
+            return self.send_v1(files)
+        self.commit(files, committed)
+        return True
 
-        conn.close()
-        # TODO handle response
+    def send_v1(self, files):
+        """send the new bytes of each file in a request of its own"""
+        left = self.first_block()
+        for wf in files:
+            if left <= 0:
+                break
+            data = wf.read_delta(left)
+            if not data:
+                continue
+            url = self.url(1, stage, wf.alias, wf.committed)
+            if wf.restart:
+                url = url + "?truncate=1"
+            try:
+                status, answer = self.request("PUT", url, data)
+            except Exception, e:
+                debug("upload failed: %s\n" % (e, ))
+                self.close()
+                return False
+            if answer is None:
+                return False
+            self.commit([wf], {wf.alias: answer["committed"]})
+            left = left - len(data)
         return True
 
-    def uploadWrapper(self, blocksize=2621445):
-        """upload a file in chunks using the uploadFile call"""
-        retries = 3
-        fo = file(self.fn, "r")
-        totalsize = os.path.getsize(self.fn)
-        ofs = 0
+    def negotiate(self, response):
+        """compress the next bodies if the server can decode them, the
+        zlib format of zlib.compress is the "deflate" of http"""
+        accepted = response.getheader("X-Accept-Encoding") or ""
+        accepted = [e.strip().lower() for e in accepted.split(",")]
+        if "deflate" in accepted:
+            self.encoding = "deflate"
+        else:
+            self.encoding = None
+        self.negotiated = True
+
+    def update(self, files):
+        """send everything new in `files`, a block per request"""
         while True:
-            lap = time.time()
-            contents = fo.read(blocksize)
-            size = len(contents)
-            data = base64.encodestring(contents)
-            if size == 0:
-                offset = -1
-                sz = ofs
-            else:
-                offset = ofs
-                sz = size
-            del contents
-            tries = 0
-            while tries <= retries:
-                debug("upload_log_data('%s')\n" % (offset, ))
-                if self._upload_log_data(name, self.alias, sz, offset, data):
-                    break
-                else:
-                    tries = tries + 1
-            if size == 0:
+            changed = [wf for wf in files if wf.changed()]
+            if not changed:
+                break
+            before = [wf.committed for wf in changed]
+            if not self.send(changed):
+                break
+            if before == [wf.committed for wf in changed]:
+                # the server took nothing, try again on the next tick
                 break
-            ofs += size
-        fo.close()
-
-    def update(self):
-        if not self.exists():
-            return
-        if not self.changed():
-            return
-        try:
-            self.uploadWrapper()
-        except:
-            raise
 
 
 class MountWatcher:
@@ -175,6 +289,71 @@ class MountWatcher:
             return 0
 
 
+class InotifyWaiter:
+    """Sleep until a watched file or the mount table changes, by inotify
+    through ctypes and epoll, so nothing extra is needed in the installer
+    """
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_NONBLOCK = 0x00000800
+    IN_CLOEXEC = 0x00080000
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        import select
+        libc_name = ctypes.util.find_library("c") or "libc.so.6"
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}
+
+        self.epoll = select.epoll()
+        self.epoll.register(self.fd, select.EPOLLIN)
+        # the mount table is readable all the time, a change is signalled
+        # with POLLPRI instead
+        self.mounts = open("/proc/self/mounts")
+        self.mounts.read()
+        self.epoll.register(self.mounts.fileno(),
+                            select.EPOLLPRI | select.EPOLLERR)
+
+    def watch(self, fn):
+        """watch the directory of fn, or its closest existing parent when
+        the directory is not created yet"""
+        d = os.path.dirname(fn)
+        while d != "/" and not os.path.isdir(d):
+            d = os.path.dirname(d)
+        if d in self.dirs:
+            return
+        wd = self.libc.inotify_add_watch(self.fd, d, self.MASK)
+        if wd >= 0:
+            self.dirs[d] = wd
+
+    def wait(self, timeout):
+        for fd, event in self.epoll.poll(timeout):
+            if fd == self.fd:
+                try:
+                    while os.read(self.fd, 65536):
+                        pass
+                except OSError:
+                    pass
+            else:
+                self.mounts.seek(0)
+                self.mounts.read()
+
+
+def wait_timeout(sysimage, waitlist):
+    """the longest wait on inotify, the waitlist is also checked when
+    /mnt/sysimage turns stable, and no file event tells when that is"""
+    if waitlist and sysimage.line and not sysimage.stable():
+        return max(60 - (time.time() - sysimage.time), 0) + 1
+    return -1
+
+
 def anamon_loop():
     alog = WatchedFile("/tmp/anaconda.log", "anaconda.log")
     alog.lookfor("step installpackages$")
@@ -237,9 +416,29 @@ def anamon_loop():
         waitlist.extend(package_logs)
         waitlist.extend(bootloader_cfgs)
 
+    uploader = Uploader()
+
+    waiter = None
+    if use_inotify:
+        try:
+            waiter = InotifyWaiter()
+        except Exception, e:
+            debug("inotify is not available, poll instead: %s\n" % (e, ))
+
     # Monitor loop
+    first = True
     while 1:
-        time.sleep(5)
+        if waiter is None:
+            time.sleep(5)
+        else:
+            # directories may show up with new mounts, watch them then
+            for wf in watchlist + waitlist:
+                waiter.watch(wf.fn)
+            if not first:
+                waiter.wait(wait_timeout(sysimage, waitlist))
+                # let a burst of writes go out in one request
+                time.sleep(0.1)
+            first = False
 
         # Not all log files are available at the start, we'll loop through the
         # waitlist to determine when each file can be added to the watchlist
@@ -251,8 +450,7 @@ def anamon_loop():
                 waitlist.remove(watch)
 
         # Send any updates
-        for wf in watchlist:
-            wf.update()
+        uploader.update(watchlist)
 
         # If asked to run_once, exit now
         if exit:
@@ -267,48 +465,61 @@ debug = lambda x, **y: None
 watchfiles = []
 exit = False
 stage = ""
-
-# Process command-line args
-n = 0
-while n < len(sys.argv):
-    arg = sys.argv[n]
-    if arg == '--name':
-        n = n + 1
-        name = sys.argv[n]
-    elif arg == '--watchfile':
-        n = n + 1
-        watchfiles.extend(shlex.split(sys.argv[n]))
-    elif arg == '--exit':
-        exit = True
-    elif arg == '--server':
+use_inotify = False
+job = ""
+machine = ""
+
+# Run as a script, tests import the classes above
+if __name__ == '__main__':
+    # Process command-line args
+    n = 0
+    while n < len(sys.argv):
+        arg = sys.argv[n]
+        if arg == '--name':
+            n = n + 1
+            name = sys.argv[n]
+        elif arg == '--watchfile':
+            n = n + 1
+            watchfiles.extend(shlex.split(sys.argv[n]))
+        elif arg == '--exit':
+            exit = True
+        elif arg == '--server':
+            n = n + 1
+            server_ip = sys.argv[n]
+        elif arg == '--stage':
+            n = n + 1
+            stage = sys.argv[n]
+        elif arg == '--port':
+            n = n + 1
+            server_port = sys.argv[n]
+        elif arg == '--debug':
+            debug = lambda x, **y: sys.stderr.write(x % y)
+        elif arg == '--fg':
+            daemon = 0
+        elif arg == '--inotify':
+            use_inotify = True
+        elif arg == '--job':
+            n = n + 1
+            job = sys.argv[n]
+        elif arg == '--machine':
+            n = n + 1
+            machine = sys.argv[n]
         n = n + 1
-        server_ip = sys.argv[n]
-    elif arg == '--stage':
-        n = n + 1
-        stage = sys.argv[n]
-    elif arg == '--port':
-        n = n + 1
-        server_port = sys.argv[n]
-    elif arg == '--debug':
-        debug = lambda x, **y: sys.stderr.write(x % y)
-    elif arg == '--fg':
-        daemon = 0
-    n = n + 1
-
-# Create an xmlrpc session handle
-# session = xmlrpclib.Server("http://%s:%s/cobbler_api" % (server, port))
-
-# Fork and loop
-if daemon:
-    if not os.fork():
-        # Redirect the standard I/O file descriptors to the specified file.
-        DEVNULL = getattr(os, "devnull", "/dev/null")
-        os.open(DEVNULL, os.O_RDWR)  # standard input (0)
-        os.dup2(0, 1)  # Duplicate standard input to standard output (1)
-        os.dup2(0, 2)  # Duplicate standard input to standard error (2)
 
+    # Create an xmlrpc session handle
+    # session = xmlrpclib.Server("http://%s:%s/cobbler_api" % (server, port))
+
+    # Fork and loop
+    if daemon:
+        if not os.fork():
+            # Redirect the standard I/O file descriptors to the specified file.
+            DEVNULL = getattr(os, "devnull", "/dev/null")
+            os.open(DEVNULL, os.O_RDWR)  # standard input (0)
+            os.dup2(0, 1)  # Duplicate standard input to standard output (1)
+            os.dup2(0, 2)  # Duplicate standard input to standard error (2)
+
+            anamon_loop()
+            sys.exit(1)
+        sys.exit(0)
+    else:
         anamon_loop()
-        sys.exit(1)
-    sys.exit(0)
-else:
-    anamon_loop()
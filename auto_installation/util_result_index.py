@@ -1,40 +1,259 @@
 import os
 import json
+import glob
+import time
 from constants import PROJECT_ROOT
 from utils import init_redis
 
 LOGS_DIR = os.path.join(PROJECT_ROOT, 'logs') + '/'
+FINAL_RESULTS = 'final_results.json'
+
+# every date has a hash of its runs, {"<time>__<build>": [ks_dirs, sum]}
+SUMMARY_KEY = 'logs_summary:{}'
+DATES_KEY = 'logs_summary:dates'
+# mtime of every indexed final_results.json, {relative path: mtime}
+MTIMES_KEY = 'logs_summary:mtimes'
+BUILT_KEY = 'logs_summary:built'
+# bumped on every change, so clients can tell if the summary changed. It
+# starts at the time it's created, a flushed index never gives a version
+# seen before again
+VERSION_KEY = 'logs_summary:version'
+
+# indexes for queries, the run ids are "<date>/<time>__<build>":
+# sorted set of all runs scored by their start time, YYYYmmddHHMMSS
+RUNS_KEY = 'logs_summary:runs'
+# set of all builds, and a set of runs for every build and test flag
+BUILDS_KEY = 'logs_summary:builds'
+BUILD_RUNS_KEY = 'logs_summary:build:{}'
+FLAG_RUNS_KEY = 'logs_summary:flag:{}'
+
+TEST_FLAGS = ('install', 'upgrade', 'vdsm')
+
+
+def parse_run(run_path):
+    """Return (date, time_build, [ks_dirs, sum]) of the run under
+    logs/<date>/<time>/<build>, or None if it has no valid final results
+    """
+    date, time_, build = os.path.relpath(run_path, LOGS_DIR).split('/')[:3]
+    try:
+        final_res = json.load(open(os.path.join(run_path,
+                                                FINAL_RESULTS)))['sum']
+    except (IOError, ValueError, KeyError):
+        print("erros exists in file:: " + os.path.join(run_path,
+                                                       FINAL_RESULTS))
+        return None
+
+    dnames = sorted(d for d in os.listdir(run_path)
+                    if os.path.isdir(os.path.join(run_path, d)))
+    return date, time_ + '__' + build, [dnames, final_res]
+
+
+def _run_score(date, time_):
+    # the time of a job run is followed by its id, 10-00-00_0a1b2c3d
+    time_ = time_.split('_', 1)[0]
+    return int(date.replace('-', '') + time_.replace('-', ''))
+
+
+def _run_id_score(run_id):
+    date, time_build = run_id.split('/', 1)
+    return _run_score(date, time_build.split('__', 1)[0])
+
+
+def _seed_version(conn):
+    conn.set(VERSION_KEY, int(time.time() * 1000), nx=True)
+
+
+def _test_flag(final_res):
+    """Return the test flag of the run, older results only have it in the
+    title, e.g. 4_1_Node_Upgrade_AutoTest_from_..."""
+    flag = final_res.get('test_flag')
+    if flag:
+        return flag
+    title = (final_res.get('title') or '').lower()
+    for flag in TEST_FLAGS:
+        if '_node_{}_'.format(flag) in title:
+            return flag
+    return None
+
+
+def index_run(conn, run_path, force=False):
+    """Put the run into the index, if its final results changed since it
+    was indexed last time. Return True when the index is updated
+    """
+    jfile = os.path.join(run_path, FINAL_RESULTS)
+    rel_path = os.path.relpath(jfile, LOGS_DIR)
+    try:
+        mtime = str(os.path.getmtime(jfile))
+    except OSError:
+        return False
+
+    if not force and conn.hget(MTIMES_KEY, rel_path) == mtime:
+        return False
+
+    parsed = parse_run(run_path)
+    if not parsed:
+        return False
+    date, time_build, entry = parsed
+    time_, build = time_build.split('__', 1)
+    run_id = '{}/{}'.format(date, time_build)
+
+    pipe = conn.pipeline()
+    pipe.hset(SUMMARY_KEY.format(date), time_build, json.dumps(entry))
+    pipe.sadd(DATES_KEY, date)
+    pipe.hset(MTIMES_KEY, rel_path, mtime)
+    pipe.zadd(RUNS_KEY, _run_score(date, time_), run_id)
+    pipe.sadd(BUILDS_KEY, build)
+    pipe.sadd(BUILD_RUNS_KEY.format(build), run_id)
+    flag = _test_flag(entry[1])
+    if flag:
+        pipe.sadd(FLAG_RUNS_KEY.format(flag), run_id)
+    pipe.incr(VERSION_KEY)
+    pipe.execute()
+    return True
+
+
+def remove_run(conn, rel_path):
+    """Take the run of the final results at `rel_path` out of the index"""
+    date, time_, build = rel_path.split('/')[:3]
+    time_build = time_ + '__' + build
+    run_id = '{}/{}'.format(date, time_build)
+
+    pipe = conn.pipeline()
+    pipe.hdel(SUMMARY_KEY.format(date), time_build)
+    pipe.hdel(MTIMES_KEY, rel_path)
+    pipe.zrem(RUNS_KEY, run_id)
+    pipe.srem(BUILD_RUNS_KEY.format(build), run_id)
+    for flag in TEST_FLAGS:
+        pipe.srem(FLAG_RUNS_KEY.format(flag), run_id)
+    pipe.incr(VERSION_KEY)
+    pipe.execute()
+
+    if not conn.hlen(SUMMARY_KEY.format(date)):
+        conn.srem(DATES_KEY, date)
+    if not conn.scard(BUILD_RUNS_KEY.format(build)):
+        conn.srem(BUILDS_KEY, build)
 
 
 def walk_the_logs():
-    """=+_="""
-    summary = dict()
-    for dpath, dnames, files in os.walk(LOGS_DIR):
-        if 'final_results.json' in files:
-            index = files.index('final_results.json')
-            tmp = dpath.replace(LOGS_DIR, '').split('/')
-            date = tmp[0]
-            time_build = tmp[1] + '__' + tmp[2]
-            try:
-                final_res = json.load(
-                    open(os.path.join(dpath, files[index])))['sum']
-            except ValueError:
-                print("erros exists in file:: " + os.path.join(
-                    dpath, files[index]))
-                continue
-
-            if summary.get(date, None):
-                summary[date][time_build] = [dnames, final_res]
-            else:
-                summary[date] = {time_build: [dnames, final_res]}
+    """Yield the path of every run which has final results"""
+    # runs are always logs/<date>/<time>/<build>, no need to walk the
+    # ks dirs below them
+    for jfile in glob.iglob(os.path.join(LOGS_DIR, '*', '*', '*',
+                                         FINAL_RESULTS)):
+        yield os.path.dirname(jfile)
+
+
+def cache_logs_summary(run_path=None, conn=None):
+    """Index the run just finished, or check all runs for new or changed
+    final results when `run_path` is not given, the runs removed from the
+    logs are removed from the index then too
+    """
+    conn = conn or init_redis()
+    _seed_version(conn)
+    if run_path:
+        index_run(conn, run_path)
+        return
+
+    found = set()
+    for path in walk_the_logs():
+        index_run(conn, path)
+        found.add(os.path.relpath(os.path.join(path, FINAL_RESULTS),
+                                  LOGS_DIR))
+    for rel_path in set(conn.hkeys(MTIMES_KEY)) - found:
+        remove_run(conn, rel_path)
+    conn.set(BUILT_KEY, 1)
+
+
+def ensure_logs_summary(conn=None):
+    """Build the index if there is none yet"""
+    conn = conn or init_redis()
+    if not conn.get(BUILT_KEY):
+        print("no cache found, generate new cache")
+        cache_logs_summary(conn=conn)
+
+
+def get_logs_summary(conn=None):
+    """Return {date: {"<time>__<build>": [ks_dirs, sum]}} from the index"""
+    conn = conn or init_redis()
+    ensure_logs_summary(conn)
 
+    dates = sorted(conn.smembers(DATES_KEY))
+    pipe = conn.pipeline()
+    for date in dates:
+        pipe.hgetall(SUMMARY_KEY.format(date))
+
+    summary = {}
+    for date, runs in zip(dates, pipe.execute()):
+        summary[date] = {k: json.loads(v) for k, v in runs.items()}
     return summary
 
 
-def cache_logs_summary():
-    conn = init_redis()
-    logs = json.dumps(walk_the_logs())
-    conn.set("logs_summary", logs)
+def get_logs_summary_version(conn=None):
+    conn = conn or init_redis()
+    _seed_version(conn)
+    return int(conn.get(VERSION_KEY))
+
+
+def query_logs_summary(conn=None,
+                       date_from=None,
+                       date_to=None,
+                       build=None,
+                       test_flag=None,
+                       page=1,
+                       limit=20):
+    """Return the total number of matched runs and the runs in `page`,
+    newest first, as {date, run, ks, sum} dicts.
+
+    Dates are YYYY-mm-dd and inclusive, `build` matches a part of the build
+    name.
+    """
+    conn = conn or init_redis()
+    ensure_logs_summary(conn)
+
+    lo = _run_score(date_from, '00-00-00') if date_from else float('-inf')
+    hi = _run_score(date_to, '23-59-59') if date_to else float('inf')
+    start = (page - 1) * limit
+
+    if not build and not test_flag:
+        # only the page is read from the sorted set of all runs
+        total = conn.zcount(RUNS_KEY, lo, hi)
+        page_ids = conn.zrevrangebyscore(RUNS_KEY, hi, lo,
+                                         start=start, num=limit)
+    else:
+        # the sets of the matched builds and flag are usually much smaller
+        # than all runs, the dates are checked on what is left of them
+        matched = None
+        if build:
+            builds = [b for b in conn.smembers(BUILDS_KEY) if build in b]
+            if builds:
+                matched = conn.sunion(
+                    *[BUILD_RUNS_KEY.format(b) for b in builds])
+            else:
+                matched = set()
+        if test_flag:
+            flag_runs = conn.smembers(FLAG_RUNS_KEY.format(test_flag))
+            matched = flag_runs if matched is None else matched & flag_runs
+        run_ids = sorted(
+            (r for r in matched if lo <= _run_id_score(r) <= hi),
+            key=lambda r: (_run_id_score(r), r),
+            reverse=True)
+        total = len(run_ids)
+        page_ids = run_ids[start:start + limit]
+
+    pipe = conn.pipeline()
+    for run_id in page_ids:
+        date, time_build = run_id.split('/', 1)
+        pipe.hget(SUMMARY_KEY.format(date), time_build)
+
+    runs = []
+    for run_id, entry in zip(page_ids, pipe.execute()):
+        if not entry:
+            continue
+        date, time_build = run_id.split('/', 1)
+        dnames, final_res = json.loads(entry)
+        runs.append(dict(date=date, run=time_build, ks=dnames, sum=final_res))
+
+    return total, runs
 
 
 if __name__ == "__main__":
@@ -1,9 +1,12 @@
 import os
+import json
+import attr
+import collections
 import logging.config
 import yaml
 import redis
 import time
-import subprocess as sp
+import threading
 from constants import PROJECT_ROOT, \
     TEST_LEVEL, \
     ANACONDA_TIER1, ANACONDA_TIER2, KS_TIER1, KS_TIER2, \
@@ -26,12 +29,156 @@ User::<{user_name_r}>, but currently reserved by User::<{user_name_w}>'''
                              .format(**message))
 
 
+class ThreadLogRouter(logging.Handler):
+    """Dispatch records to the log file bound to the emitting thread
+
+    Several machines are provisioned at the same time, each in its own
+    worker thread, so the single `logfile` handler from logger.yml can not
+    follow all of them. Every worker binds its own file here instead.
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self._handlers = {}
+        self._shared = {}
+        self._parents = {}
+
+    def bind(self, log_file, formatter, ident=None):
+        fh = logging.FileHandler(log_file)
+        fh.setFormatter(formatter)
+        ident = ident or threading.current_thread().ident
+        self.acquire()
+        try:
+            old = self._handlers.get(ident)
+            self._handlers[ident] = fh
+        finally:
+            self.release()
+        if old:
+            old.close()
+
+    def unbind(self, ident=None):
+        ident = ident or threading.current_thread().ident
+        self.acquire()
+        try:
+            old = self._handlers.pop(ident, None)
+        finally:
+            self.release()
+        if old:
+            old.close()
+
+    def share(self, owner, ident=None):
+        """Let thread `ident` log to the file bound to thread `owner`,
+        for helper threads working on behalf of the owner
+        """
+        ident = ident or threading.current_thread().ident
+        self._shared[ident] = owner
+
+    def unshare(self, ident=None):
+        ident = ident or threading.current_thread().ident
+        self._shared.pop(ident, None)
+
+    def owner(self, ident):
+        """The thread `ident` logs on behalf of"""
+        return self._shared.get(ident, ident)
+
+    def join(self, parent, ident=None):
+        """Copy the records of thread `ident` to the file bound to thread
+        `parent` as well, the log of a job collects those of its machines
+        """
+        ident = ident or threading.current_thread().ident
+        self._parents[ident] = parent
+
+    def leave(self, ident=None):
+        ident = ident or threading.current_thread().ident
+        self._parents.pop(ident, None)
+
+    def emit(self, record):
+        owner = self.owner(record.thread)
+        for ident in (owner, self._parents.get(owner)):
+            fh = self._handlers.get(ident)
+            if fh:
+                fh.handle(record)
+
+
+log_router = ThreadLogRouter()
+
+# state changes and log lines of a job are published here as json
+JOB_EVENTS_CHANNEL = 'job_events:{}'
+# hash of the state of a job and of each of its machines, kept for a week
+# once the job is done
+JOB_KEY = 'job:{}'
+JOB_TTL = 7 * 24 * 3600
+
+
+class JobLogPublisher(logging.Handler):
+    """Publish the records of the threads working for a job to the events
+    channel of the job, for the clients following its progress
+    """
+
+    def __init__(self, rd_conn=None):
+        logging.Handler.__init__(self)
+        self.rd_conn = rd_conn
+        self._jobs = {}
+
+    def bind(self, job_id, ident=None):
+        ident = ident or threading.current_thread().ident
+        self._jobs[ident] = job_id
+
+    def unbind(self, ident=None):
+        ident = ident or threading.current_thread().ident
+        self._jobs.pop(ident, None)
+
+    def emit(self, record):
+        job_id = self._jobs.get(log_router.owner(record.thread))
+        if job_id is None:
+            return
+        try:
+            if self.rd_conn is None:
+                self.rd_conn = init_redis()
+            self.rd_conn.publish(JOB_EVENTS_CHANNEL.format(job_id),
+                                 json.dumps(dict(type='log', job=job_id,
+                                                 line=self.format(record))))
+        except Exception:
+            self.handleError(record)
+
+
+job_log_publisher = JobLogPublisher()
+
+_logging_lock = threading.Lock()
+_logging_done = False
+
+
+def setup_logging(log_file=None):
+    """Configure the loggers from logger.yml, once per process. The jobs
+    bind their own files on log_router, `log_file` is where the records of
+    no job go, bender.log by default
+    """
+    global _logging_done
+    with _logging_lock:
+        if _logging_done:
+            return
+        conf = yaml.load(open(os.path.join(PROJECT_ROOT, 'logger.yml')))
+        if log_file:
+            conf['logging']['handlers']['logfile']['filename'] = log_file
+        logging.config.dictConfig(conf['logging'])
+        # dictConfig drops every handler it doesn't know about
+        logging.getLogger('bender').addHandler(log_router)
+        fmt = conf['logging']['formatters']['simpleFormatter']
+        job_log_publisher.setFormatter(
+            logging.Formatter(fmt['format'], fmt['datefmt']))
+        logging.getLogger('bender').addHandler(job_log_publisher)
+        _logging_done = True
+
+
 class ResultsAndLogs(object):
     """This class will prepare logs directory structure
     """
 
-    def __init__(self):
+    def __init__(self, job_id=None):
         self._logs_root_dir = os.path.join(PROJECT_ROOT, 'logs')
+        # jobs started in the same second on the same build get their own
+        # directories
+        self.job_id = job_id
         self._img_url = None
         self.logger_conf = os.path.join(PROJECT_ROOT, 'logger.yml')
         self._logger_name = "results"
@@ -40,6 +187,9 @@ class ResultsAndLogs(object):
         self._current_log_file = "/tmp/logs"
         self._current_date = self.get_current_date()
         self._current_time = self.get_current_time()
+        self._local = threading.local()
+        # bkr_name -> log path of the kickstart the machine installs
+        self._machine_log_paths = {}
 
     @property
     def img_url(self):
@@ -51,19 +201,33 @@ class ResultsAndLogs(object):
 
     @property
     def logger_name(self):
-        return self._logger_name
+        return getattr(self._local, 'logger_name', self._logger_name)
 
     @logger_name.setter
     def logger_name(self, val):
-        self._logger_name = val
+        if self.thread_bound:
+            self._local.logger_name = val
+        else:
+            self._logger_name = val
+
+    @property
+    def thread_bound(self):
+        return getattr(self._local, 'bound', False)
 
     @property
     def current_log_path(self):
-        return self._current_log_path
+        return getattr(self._local, 'log_path', self._current_log_path)
 
     @property
     def current_log_file(self):
-        return self._current_log_file
+        return getattr(self._local, 'log_file', self._current_log_file)
+
+    def set_machine_log_path(self, bkr_name, log_path):
+        self._machine_log_paths[bkr_name] = log_path
+
+    def machine_log_path(self, bkr_name):
+        """Where the logs uploaded by the installer of `bkr_name` go"""
+        return self._machine_log_paths.get(bkr_name)
 
     def get_current_date(self):
         return time.strftime("%Y-%m-%d", time.localtime())
@@ -77,28 +241,48 @@ class ResultsAndLogs(object):
     def parse_img_url(self):
         return self.img_url.split('/')[-2]
 
-    def get_actual_logger(self, ks_name=''):
-        log_file = os.path.join(PROJECT_ROOT, 'logs',
-                                self._current_date,
-                                self._current_time,
-                                self.parse_img_url(), ks_name,
-                                self.logger_name)
+    def _run_dir(self):
+        time_dir = self._current_time
+        if self.job_id:
+            time_dir = '{}_{}'.format(time_dir, self.job_id[:8])
+        return os.path.join(self._logs_root_dir, self._current_date,
+                            time_dir, self.parse_img_url())
+
+    def _gen_log_file(self, ks_name):
+        log_file = os.path.join(self._run_dir(), ks_name, self.logger_name)
         if not os.path.exists(log_file):
             os.system("mkdir -p {0}".format(os.path.dirname(log_file)))
 
+        # keep the latest one visible to the api, whichever thread it is
         self._current_log_path = os.path.dirname(log_file)
         self._current_log_file = log_file
+        return log_file
+
+    def get_actual_logger(self, ks_name=''):
+        if self.thread_bound:
+            return self.get_thread_logger(ks_name)
+
+        # for the scripts running a single check, nothing else logs then
+        setup_logging(self._gen_log_file(ks_name))
 
-        self.logger_dict['logging']['handlers']['logfile'][
-            'filename'] = log_file
+    def get_thread_logger(self, ks_name=''):
+        """Like get_actual_logger, but only for records of current thread"""
+        self._local.bound = True
+        log_file = self._gen_log_file(ks_name)
 
-        logging.config.dictConfig(self.logger_dict['logging'])
+        self._local.log_path = os.path.dirname(log_file)
+        self._local.log_file = log_file
+
+        fmt = self.logger_dict['logging']['formatters']['simpleFormatter']
+        log_router.bind(log_file,
+                        logging.Formatter(fmt['format'], fmt['datefmt']))
+
+    def release_thread_logger(self):
+        log_router.unbind()
+        self._local.__dict__.clear()
 
     def del_existing_logs(self, ks_name=''):
-        log_file = os.path.join(PROJECT_ROOT, 'logs',
-                                self._current_date,
-                                self._current_time,
-                                self.parse_img_url(), ks_name)
+        log_file = os.path.join(self._run_dir(), ks_name)
         if os.path.exists(log_file):
             os.system('rm -rf {}/*'.format(log_file))
 
@@ -131,99 +315,249 @@ def init_kickstart_file(fn, args):
 
 
 def setup_funcs(redis_conn):
-    print("flush all keys from current database")
-    redis_conn.flushdb()
+    print("flush all keys but the job states from current database")
+    # the installers of the jobs before a restart still fetch their
+    # kickstarts by the job id, the states are dropped a week later
+    keep = JOB_KEY.format('')
+    pipe = redis_conn.pipeline(transaction=False)
+    for key in redis_conn.scan_iter(count=1000):
+        if key.startswith(keep):
+            pipe.expire(key, JOB_TTL)
+        else:
+            pipe.delete(key)
+    pipe.execute()
     print("set key 'running' value to '0'")
     redis_conn.set('running', 0, nx=True)
 
 
+_TIER_TESTCASE_MAPS = (
+    (ANACONDA_TIER1, ANACONDA_TIER1_TESTCASE_MAP),
+    (ANACONDA_TIER2, ANACONDA_TIER2_TESTCASE_MAP),
+    (KS_TIER1, KS_TIER1_TESTCASE_MAP),
+    (KS_TIER2, KS_TIER2_TESTCASE_MAP),
+    (DEBUG_TIER, DEBUG_TIER_TESTCASE_MAP),
+    (UPGRADE_TIER1, UPGRADE_TIER1_TESTCASE_MAP),
+    (UPGRADE_TIER2, UPGRADE_TIER2_TESTCASE_MAP),
+    (VDSM_TIER, VDSM_TIER_TESTCASE_MAP),
+)
+
+
+@attr.s(frozen=True)
+class TestcaseIndex(object):
+    """All lookups over the testcase map of one test level, computed once
+
+    Lookups return copies, the index itself is never changed after build.
+    """
+    testcases = attr.ib()  # {case: (ks, machine, checkpoint)}
+    _by_ks = attr.ib()  # {ks: (case, ...)}
+    _by_machine = attr.ib()  # {machine: (case, ...)}
+    _by_checkpoint = attr.ib()  # {checkpoint: (case, ...)}
+    _ks_machine = attr.ib()  # {ks: machine}
+    _machine_ksl = attr.ib()  # {machine: (ks, ...)}
+    _checkpoint_cases = attr.ib()  # {(ks, machine): {checkpoint: (case, ...)}}
+
+    @classmethod
+    def build(cls, test_level):
+        testcase_map = {}
+        for tier, tier_map in _TIER_TESTCASE_MAPS:
+            if test_level & tier:
+                testcase_map.update(tier_map)
+
+        if not testcase_map:
+            raise ValueError('Invaild TEST_LEVEL')
+
+        return cls.from_testcase_map(testcase_map)
+
+    @classmethod
+    def from_testcase_map(cls, testcase_map):
+        by_ks, by_machine, by_checkpoint = {}, {}, {}
+        ks_machine, machine_ksl, checkpoint_cases = {}, {}, {}
+
+        for case, value in testcase_map.items():
+            if len(value) != 3:
+                raise ValueError(
+                    'Testcase %s should be (ks, machine, checkpoint), got %s' %
+                    (case, value))
+            ks, machine, checkpoint = value
+
+            if ks_machine.setdefault(ks, machine) != machine:
+                raise ValueError(
+                    'One kickstart file %s cannot be run on two machines.' % ks)
+
+            by_ks.setdefault(ks, []).append(case)
+            by_machine.setdefault(machine, []).append(case)
+            by_checkpoint.setdefault(checkpoint, []).append(case)
+            checkpoint_cases.setdefault((ks, machine), {}).setdefault(
+                checkpoint, []).append(case)
+
+            ksl = machine_ksl.setdefault(machine, [])
+            if ks not in ksl:
+                ksl.extend([ks] * int(KS_PRESSURE_MAP.get(ks, 1)))
+
+        def freeze(d):
+            return {k: tuple(sorted(v)) for k, v in d.items()}
+
+        return cls(
+            testcases=dict(testcase_map),
+            by_ks=freeze(by_ks),
+            by_machine=freeze(by_machine),
+            by_checkpoint=freeze(by_checkpoint),
+            ks_machine=ks_machine,
+            machine_ksl=freeze(machine_ksl),
+            checkpoint_cases={
+                key: freeze(value)
+                for key, value in checkpoint_cases.items()
+            })
+
+    def cases_of_ks(self, ks):
+        return self._by_ks.get(ks, ())
+
+    def cases_of_machine(self, machine):
+        return self._by_machine.get(machine, ())
+
+    def cases_of_checkpoint(self, checkpoint):
+        return self._by_checkpoint.get(checkpoint, ())
+
+    def machine_of_ks(self, ks):
+        return self._ks_machine.get(ks)
+
+    def ks_machine_map(self):
+        return dict(self._ks_machine)
+
+    def machine_ksl_map(self):
+        return {m: list(ksl) for m, ksl in self._machine_ksl.items()}
+
+    def checkpoint_cases_map(self, ks, machine):
+        return {
+            checkpoint: list(cases)
+            for checkpoint, cases in self._checkpoint_cases.get(
+                (ks, machine), {}).items()
+        }
+
+
+_testcase_indexes = {}
+
+
+def get_testcase_index(test_level=TEST_LEVEL):
+    index = _testcase_indexes.get(test_level)
+    if index is None:
+        index = _testcase_indexes[test_level] = TestcaseIndex.build(
+            test_level)
+    return index
+
+
 def get_testcase_map():
-    # get testcase map
-    testcase_map = {}
-    if TEST_LEVEL & ANACONDA_TIER1:
-        testcase_map.update(ANACONDA_TIER1_TESTCASE_MAP)
-    if TEST_LEVEL & ANACONDA_TIER2:
-        testcase_map.update(ANACONDA_TIER2_TESTCASE_MAP)
-    if TEST_LEVEL & KS_TIER1:
-        testcase_map.update(KS_TIER1_TESTCASE_MAP)
-    if TEST_LEVEL & KS_TIER2:
-        testcase_map.update(KS_TIER2_TESTCASE_MAP)
-    if TEST_LEVEL & DEBUG_TIER:
-        testcase_map.update(DEBUG_TIER_TESTCASE_MAP)
-    if TEST_LEVEL & UPGRADE_TIER1:
-        testcase_map.update(UPGRADE_TIER1_TESTCASE_MAP)
-    if TEST_LEVEL & UPGRADE_TIER2:
-        testcase_map.update(UPGRADE_TIER2_TESTCASE_MAP)
-    if TEST_LEVEL & VDSM_TIER:
-        testcase_map.update(VDSM_TIER_TESTCASE_MAP)
-
-    if not testcase_map:
-        raise ValueError('Invaild TEST_LEVEL')
-
-    return testcase_map
+    return dict(get_testcase_index().testcases)
 
 
 def get_machine_ksl_map():
-    machine_ksl_map = {}
-    testcase_map = get_testcase_map()
-    for value in testcase_map.itervalues():
-        ks = value[0]
-        machine = value[1]
-        flag = False
-        if machine in machine_ksl_map:
-            if ks not in machine_ksl_map.get(machine):
-                flag = True
-        else:
-            machine_ksl_map[machine] = []
-            flag = True
+    return get_testcase_index().machine_ksl_map()
 
-        if flag:
-            if ks in KS_PRESSURE_MAP:
-                ks_repeat_ls = [ks] * int(KS_PRESSURE_MAP.get(ks))
-                machine_ksl_map[machine].extend(ks_repeat_ls)
-            else:
-                machine_ksl_map[machine].append(ks)
-    for k in machine_ksl_map:
-        machine_ksl_map[k].sort()
 
-    return machine_ksl_map
+def get_ks_machine_map():
+    return get_testcase_index().ks_machine_map()
 
 
-def get_ks_machine_map():
-    ks_mashine_map = {}
-    testcase_map = get_testcase_map()
-    for value in testcase_map.itervalues():
-        ks = value[0]
-        machine = value[1]
-        if ks in ks_mashine_map:
-            if machine != ks_mashine_map.get(ks):
-                raise ValueError(
-                    'One kickstart file %s cannot be run on two machines.' % ks)
-        else:
-            ks_mashine_map[ks] = machine
+def get_checkpoint_cases_map(ks, mc):
+    return get_testcase_index().checkpoint_cases_map(ks, mc)
 
-    return ks_mashine_map
 
+def _split_lines(buf):
+    """Split at newlines only, as tail does, the newlines are kept"""
+    lines = [line + '\n' for line in buf.split('\n')]
+    lines[-1] = lines[-1][:-1]
+    if not lines[-1]:
+        lines.pop()
+    return lines
 
-def get_checkpoint_cases_map(ks, mc):
-    # get testcase map
-    testcase_map = get_testcase_map()
-
-    checkpoint_cases_map = {}
-    for key, value in testcase_map.items():
-        if set((ks, mc)) < set(value):
-            checkpoint = value[2]
-            if checkpoint in checkpoint_cases_map:
-                checkpoint_cases_map[checkpoint].append(key)
+
+@attr.s
+class _TailPosition(object):
+    ino = attr.ib()
+    offset = attr.ib()
+    lines = attr.ib()
+    # lines holds the whole file
+    from_start = attr.ib()
+
+
+class LogTail(object):
+    """Read the end of log files without forking tail
+
+    The position and last lines of every file read are remembered, the next
+    call only reads what was appended since. A file which shrank or was
+    replaced, or grew by more than `reread_size`, is read backwards from
+    its end again.
+    """
+
+    def __init__(self, block_size=8192, reread_size=64 * 1024,
+                 max_files=128):
+        self.block_size = block_size
+        self.reread_size = reread_size
+        self.max_files = max_files
+        self._positions = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _scan_back(self, fp, end, n):
+        """Return the last `n` lines before `end`, and if they hold the
+        whole file"""
+        pos, buf = end, ''
+        # more than n newlines before the last byte, the first segment may
+        # be a partial line
+        while pos > 0 and buf[:-1].count('\n') < n:
+            size = min(self.block_size, pos)
+            pos -= size
+            fp.seek(pos)
+            buf = fp.read(size) + buf
+        lines = _split_lines(buf)
+        return lines[-n:], pos == 0 and len(lines) <= n
+
+    def last_lines(self, file_path, n=1):
+        """Return the last `n` lines of the file, newlines included"""
+        with open(file_path, 'rb') as fp:
+            st = os.fstat(fp.fileno())
+            with self._lock:
+                pos = self._positions.pop(file_path, None)
+
+            appended = pos and pos.ino == st.st_ino and \
+                0 <= st.st_size - pos.offset <= self.reread_size and \
+                (len(pos.lines) >= n or pos.from_start)
+            if appended:
+                fp.seek(pos.offset)
+                data = fp.read(st.st_size - pos.offset)
+                lines = _split_lines(''.join(pos.lines) + data)
+                keep = max(n, len(pos.lines))
+                pos = _TailPosition(st.st_ino, pos.offset + len(data),
+                                    lines[-keep:],
+                                    pos.from_start and len(lines) <= keep)
             else:
-                checkpoint_cases_map[checkpoint] = []
-                checkpoint_cases_map[checkpoint].append(key)
+                lines, from_start = self._scan_back(fp, st.st_size, n)
+                pos = _TailPosition(st.st_ino, st.st_size, lines, from_start)
+
+        with self._lock:
+            self._positions[file_path] = pos
+            while len(self._positions) > self.max_files:
+                self._positions.popitem(last=False)
+        return pos.lines[-n:]
+
+    def read(self, file_path, offset, size=1024 * 1024):
+        """Return up to `size` bytes from `offset` of the file, and the
+        offset to read on from"""
+        with open(file_path, 'rb') as fp:
+            fp.seek(offset)
+            data = fp.read(size)
+        return data, offset + len(data)
+
 
-    return checkpoint_cases_map
+log_tail = LogTail()
 
 
 def get_lastline_of_file(file_path):
-    return sp.check_output(['tail', '-1', file_path])
+    """The last line of the file as `tail -1` prints it, '' when the file
+    can't be read"""
+    try:
+        return ''.join(log_tail.last_lines(file_path, 1))
+    except (IOError, OSError):
+        return ''
 
 
 if __name__ == '__main__':
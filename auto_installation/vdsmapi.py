@@ -1,7 +1,6 @@
 import base64
 import time
-import requests
-import shutil
+from rhvmconn import get_rhevm_connection
 import re
 
 
@@ -21,11 +20,6 @@ class RhevmAction:
         "Content-type": "application/xml"
     }
 
-    cert_url = ("https://{rhevm_fqdn}/ovirt-engine/services"
-                "/pki-resource?resource=ca-certificate&format=X509-PEM-CA")
-
-    rhevm_cert = "/tmp/rhevm.cert"
-
     def __init__(self,
                  rhevm_fqdn,
                  user="admin",
@@ -39,24 +33,18 @@ class RhevmAction:
         self.token = base64.b64encode(
             self.auth_format.format(
                 user=self.user, domain=self.domain, password=self.password))
+        self.headers = dict(self.headers)
         self.headers.update({
             "Authorization": "Basic {token}".format(token=self.token)
         })
-        self._get_rhevm_cert_file()
-        self.req = requests.Session()
-
-    def _get_rhevm_cert_file(self):
-        r = requests.get(self.cert_url.format(rhevm_fqdn=self.rhevm_fqdn),
-                         stream=True,
-                         verify=False)
-
-        if r.status_code == 200:
-            with open(self.rhevm_cert, 'wb') as f:
-                r.raw.decode_content = True
-                shutil.copyfileobj(r.raw, f)
-        else:
-            raise RuntimeError("Can not get the cert file from %s" %
-                               self.rhevm_fqdn)
+        # session and cert are shared by all instances of the same engine
+        self._conn = get_rhevm_connection(self.rhevm_fqdn, self.token)
+        self.rhevm_cert = self._conn.cert
+        self.req = self._conn.session
+
+    @property
+    def round_trips(self):
+        return self._conn.round_trips
 
     ###################################
     # Datacenter related functions
@@ -103,7 +91,11 @@ class RhevmAction:
             rhevm_fqdn=self.rhevm_fqdn,
             item="datacenters")
 
-        r = self.req.get(api_url, headers=self.headers, verify=self.rhevm_cert)
+        r = self.req.get(
+            api_url,
+            headers=self.headers,
+            verify=self.rhevm_cert,
+            params={'search': 'name=%s' % dc_name})
 
         if r.status_code != 200:
             raise RuntimeError("Failed to list datacenter "
@@ -165,7 +157,11 @@ class RhevmAction:
             rhevm_fqdn=self.rhevm_fqdn,
             item="clusters")
 
-        r = self.req.get(api_url, headers=self.headers, verify=self.rhevm_cert)
+        r = self.req.get(
+            api_url,
+            headers=self.headers,
+            verify=self.rhevm_cert,
+            params={'search': 'name=%s' % cluster_name})
 
         if r.status_code != 200:
             raise RuntimeError("Failed to list cluster "
@@ -266,7 +262,11 @@ class RhevmAction:
         api_url = self.api_url.format(
             rhevm_fqdn=self.rhevm_fqdn,
             item="hosts")
-        r = self.req.get(api_url, headers=self.headers, verify=self.rhevm_cert)
+        r = self.req.get(
+            api_url,
+            headers=self.headers,
+            verify=self.rhevm_cert,
+            params={'search': 'name=%s' % host_name})
 
         if r.status_code != 200:
             raise RuntimeError("Failed to list host "
@@ -401,7 +401,11 @@ class RhevmAction:
     def list_storage_domain(self, sd_name):
         api_url = self.api_url.format(rhevm_fqdn=self.rhevm_fqdn, item="storagedomains")
 
-        r = self.req.get(api_url, headers=self.headers, verify=self.rhevm_cert)
+        r = self.req.get(
+            api_url,
+            headers=self.headers,
+            verify=self.rhevm_cert,
+            params={'search': 'name=%s' % sd_name})
 
         if r.status_code != 200:
             raise RuntimeError("Failed to list storage domain "
@@ -440,7 +444,11 @@ class RhevmAction:
 
         dc_id = self.list_datacenter(dc_name)['id']
 
-        r = self.req.get(api_url, headers=self.headers, verify=self.rhevm_cert)
+        r = self.req.get(
+            api_url,
+            headers=self.headers,
+            verify=self.rhevm_cert,
+            params={'search': 'name=%s' % network_name})
 
         if r.status_code != 200:
             raise RuntimeError("Failed to list network of "
@@ -601,7 +609,8 @@ class RhevmAction:
         r = self.req.get(
             api_url_base,
             headers=self.headers,
-            verify=self.rhevm_cert)
+            verify=self.rhevm_cert,
+            params={'search': 'name=%s' % disk_name})
 
         if r.status_code != 200:
             raise RuntimeError("Failed to list disk "
@@ -657,7 +666,8 @@ class RhevmAction:
         r = self.req.get(
             api_url_base,
             headers=self.headers,
-            verify=self.rhevm_cert)
+            verify=self.rhevm_cert,
+            params={'search': 'name=%s' % vm_name})
 
         if r.status_code != 200:
             raise RuntimeError("Failed to list vm "
@@ -0,0 +1,225 @@
+import os
+import imp
+import json
+import zlib
+import shutil
+import tempfile
+from nose.tools import ok_, eq_, with_setup
+
+anamon = imp.load_source('anamon', os.path.join(
+    os.path.dirname(__file__), '..', 'auto_installation', 'static',
+    'anamon.py'))
+
+JOB = '1' * 32
+MACHINE = 'dell-per510-01.lab.eng.pek2.redhat.com'
+
+
+class FakeResponse(object):
+    def __init__(self, status, data, headers):
+        self.status = status
+        self.data = data
+        self.headers = headers
+
+    def read(self):
+        return self.data
+
+    def getheader(self, name):
+        return self.headers.get(name)
+
+
+class FakeServer(object):
+    """httplib connection to an upload server keeping the logs in memory,
+    with /upload/v2 unless `v2` is false. A server which `takes_nothing`
+    answers with what it has without writing"""
+
+    def __init__(self, v2=True, accept='deflate', takes_nothing=False):
+        self.v2 = v2
+        self.accept = accept
+        self.takes_nothing = takes_nothing
+        self.logs = {}
+        self.requests = []
+        self.response = None
+
+    def _write(self, name, offset, data, truncate):
+        log = self.logs.get(name, '')
+        if truncate:
+            log = log[:offset]
+        if offset <= len(log) and not self.takes_nothing:
+            log = log[:offset] + data + log[offset + len(data):]
+        self.logs[name] = log
+        return len(log)
+
+    def request(self, method, url, body, headers):
+        self.requests.append((method, url, headers, len(body)))
+        if headers.get('Content-Encoding') == 'deflate':
+            body = zlib.decompress(body)
+        path, _, query = url.partition('?')
+        parts = path.split('/')[2:]
+        status, answer = 200, None
+        if parts[0] == 'v2' and self.v2:
+            eq_(parts[1:], [JOB, MACHINE, 'pre'])
+            manifest, _, data = body.partition('\n')
+            answer = {}
+            for chunk in json.loads(manifest):
+                answer[chunk['name']] = self._write(
+                    chunk['name'], chunk['offset'], data[:chunk['size']],
+                    chunk.get('truncate'))
+                data = data[chunk['size']:]
+        elif parts[0] == 'v1':
+            eq_(parts[1:4], [JOB, MACHINE, 'pre'])
+            answer = {'committed': self._write(
+                parts[4], int(parts[5]), body, query == 'truncate=1')}
+        else:
+            status = 404
+        headers = {'X-Accept-Encoding': self.accept} if self.accept else {}
+        self.response = FakeResponse(status, json.dumps(answer), headers)
+
+    def getresponse(self):
+        return self.response
+
+    def close(self):
+        pass
+
+
+def setup_files():
+    global tmp
+    tmp = tempfile.mkdtemp()
+    anamon.stage, anamon.job, anamon.machine = 'pre', JOB, MACHINE
+
+
+def teardown_files():
+    shutil.rmtree(tmp)
+
+
+def _watched(alias, content):
+    path = os.path.join(tmp, alias)
+    with open(path, 'w') as fp:
+        fp.write(content)
+    return anamon.WatchedFile(path, alias)
+
+
+def _uploader(server, **kwargs):
+    uploader = anamon.Uploader(**kwargs)
+    uploader.conn = server
+    return uploader
+
+
+@with_setup(setup_files, teardown_files)
+def test_read_delta():
+    wf = _watched('anaconda.log', 'abc')
+    ok_(wf.changed())
+    eq_(wf.read_delta(10), 'abc')
+    wf.committed = 3
+    ok_(not wf.changed())
+    with open(wf.fn, 'a') as fp:
+        fp.write('def')
+    ok_(wf.changed())
+    eq_(wf.read_delta(2), 'de')
+    ok_(not wf.restart)
+
+
+@with_setup(setup_files, teardown_files)
+def test_file_replaced():
+    wf = _watched('anaconda.log', 'abcdef')
+    wf.committed = 6
+    _watched('anaconda.log', 'xy')
+    ok_(wf.changed())
+    eq_(wf.committed, 0)
+    ok_(wf.restart)
+    eq_(wf.read_delta(10), 'xy')
+
+
+@with_setup(setup_files, teardown_files)
+def test_update():
+    server = FakeServer()
+    files = [_watched('anaconda.log', 'abc'), _watched('sys.log', 'xy')]
+    uploader = _uploader(server)
+    uploader.update(files)
+    # both files in one request
+    eq_([r[:2] for r in server.requests],
+        [('POST', '/upload/v2/%s/%s/pre' % (JOB, MACHINE))])
+    eq_(server.logs, {'anaconda.log': 'abc', 'sys.log': 'xy'})
+    eq_([wf.committed for wf in files], [3, 2])
+
+    # only the new bytes go out
+    with open(files[0].fn, 'a') as fp:
+        fp.write('def')
+    uploader.update(files)
+    eq_(len(server.requests), 2)
+    eq_(server.logs['anaconda.log'], 'abcdef')
+    uploader.update(files)
+    eq_(len(server.requests), 2)
+
+
+@with_setup(setup_files, teardown_files)
+def test_first_block():
+    server = FakeServer()
+    content = os.urandom(200000)
+    wf = _watched('anaconda.log', content)
+    uploader = _uploader(server, blocksize=100000)
+    uploader.update([wf])
+    eq_(server.logs['anaconda.log'], content)
+    # a small plain block until the server tells what it decodes, full
+    # compressed blocks then
+    eq_([r[2].get('Content-Encoding') for r in server.requests],
+        [None, 'deflate', 'deflate'])
+    ok_(server.requests[0][3] < 65536 + 100)
+    eq_(uploader.encoding, 'deflate')
+
+
+@with_setup(setup_files, teardown_files)
+def test_negotiate_plain():
+    server = FakeServer(accept=None)
+    wf = _watched('anaconda.log', 'a' * 100000)
+    uploader = _uploader(server)
+    uploader.update([wf])
+    eq_(server.logs['anaconda.log'], 'a' * 100000)
+    eq_([r[2].get('Content-Encoding') for r in server.requests],
+        [None, None])
+    ok_(uploader.negotiated)
+    eq_(uploader.encoding, None)
+
+
+@with_setup(setup_files, teardown_files)
+def test_file_sent_again():
+    server = FakeServer()
+    wf = _watched('anaconda.log', 'abcdef')
+    uploader = _uploader(server)
+    uploader.update([wf])
+    _watched('anaconda.log', 'xy')
+    uploader.update([wf])
+    eq_(server.logs['anaconda.log'], 'xy')
+    eq_(wf.committed, 2)
+    ok_(not wf.restart)
+
+
+@with_setup(setup_files, teardown_files)
+def test_v1_server():
+    server = FakeServer(v2=False)
+    files = [_watched('anaconda.log', 'abcdef'), _watched('sys.log', 'xy')]
+    uploader = _uploader(server)
+    uploader.update(files)
+    eq_(uploader.version, 1)
+    eq_(server.logs, {'anaconda.log': 'abcdef', 'sys.log': 'xy'})
+    v1 = '/upload/v1/%s/%s/pre/' % (JOB, MACHINE)
+    eq_([r[:2] for r in server.requests],
+        [('POST', '/upload/v2/%s/%s/pre' % (JOB, MACHINE)),
+         ('PUT', v1 + 'anaconda.log/0'), ('PUT', v1 + 'sys.log/0')])
+
+    # v2 isn't asked again, a replaced file cuts the server's copy
+    _watched('anaconda.log', 'xyz')
+    uploader.update(files)
+    eq_(server.requests[-1][:2], ('PUT', v1 + 'anaconda.log/0?truncate=1'))
+    eq_(len(server.requests), 4)
+    eq_(server.logs['anaconda.log'], 'xyz')
+
+
+@with_setup(setup_files, teardown_files)
+def test_server_takes_nothing():
+    server = FakeServer(takes_nothing=True)
+    wf = _watched('anaconda.log', 'abc')
+    uploader = _uploader(server)
+    uploader.update([wf])
+    # tried again on the next tick, not in a loop
+    eq_(len(server.requests), 1)
+    eq_(wf.committed, 0)
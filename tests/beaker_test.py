@@ -0,0 +1,268 @@
+import json
+import time
+import Queue
+import threading
+import BaseHTTPServer
+from nose.tools import ok_, eq_
+from auto_installation.beaker import InstallWatcher, BkrExecutor, \
+    BkrSession, Beaker
+
+
+class FakePubSub(object):
+    """Like redis-py, listen() returns once nothing is subscribed, which
+    is known when the reply to the last unsubscribe is read"""
+
+    def __init__(self):
+        self.handlers = {}
+        self.queue = Queue.Queue()
+
+    def subscribe(self, **kwargs):
+        self.handlers.update(kwargs)
+
+    def unsubscribe(self, *args):
+        self.queue.put(dict(type='unsubscribe', channel=args))
+
+    def listen(self):
+        while self.handlers:
+            msg = self.queue.get()
+            if msg is not None and msg['type'] == 'unsubscribe':
+                for ch in msg['channel']:
+                    self.handlers.pop(ch, None)
+                continue
+            if msg is None:
+                raise RuntimeError("connection closed")
+            handler = self.handlers.get(msg['channel'])
+            if handler:
+                handler(msg)
+            else:
+                yield msg
+
+    def close(self):
+        self.queue.put(None)
+
+
+class FakeRedis(object):
+    def __init__(self):
+        self.p = FakePubSub()
+
+    def pubsub(self, **kwargs):
+        return self.p
+
+    def publish(self, channel, data):
+        self.p.queue.put(
+            dict(type='message', pattern=None, channel=channel, data=data))
+
+
+def _watcher(timeout=60):
+    removed = []
+    ins = InstallWatcher(FakeRedis(), timeout=timeout, on_done=removed.append)
+    return ins, removed
+
+
+def test_watch_done():
+    ins, removed = _watcher()
+    w1 = ins.watch('host-01')
+    w2 = ins.watch('host-02')
+    ins.redis_conn.publish('host-02', 'done,10.0.0.2')
+    ins.redis_conn.publish('host-01', 'done,10.0.0.1')
+    eq_(w1.wait(), '10.0.0.1')
+    eq_(w2.wait(), '10.0.0.2')
+    eq_(sorted(removed), ['host-01', 'host-02'])
+    ins.close()
+
+
+def test_watch_again():
+    ins, removed = _watcher()
+    # the listener stops once the only machine is done
+    w = ins.watch('host-01')
+    ins.redis_conn.publish('host-01', 'done,10.0.0.1')
+    eq_(w.wait(), '10.0.0.1')
+    time.sleep(0.1)
+    # and the next kickstart of the machine gets a new one
+    w = ins.watch('host-01')
+    ins.redis_conn.publish('host-01', 'done,10.0.0.2')
+    eq_(w.wait(), '10.0.0.2')
+    eq_(removed, ['host-01', 'host-01'])
+    ins.close()
+
+
+def test_watch_fail():
+    ins, removed = _watcher()
+    w = ins.watch('host-01')
+    ins.redis_conn.publish('host-01', 'fail')
+    eq_(w.wait(), False)
+    eq_(removed, ['host-01'])
+    ins.close()
+
+
+def test_watch_timeout():
+    ins, removed = _watcher(timeout=0.1)
+    w = ins.watch('host-01')
+    eq_(w.wait(), False)
+    # a late message must not remove the system twice
+    ins.redis_conn.publish('host-01', 'done,10.0.0.1')
+    ok_(not removed)
+    ins.close()
+
+
+class FakeBkr(object):
+    """Counts the commands run and the most run at once"""
+
+    def __init__(self, secs=0.05):
+        self.secs = secs
+        self.argvs = []
+        self.running = 0
+        self.most = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, argv):
+        with self.lock:
+            self.argvs.append(argv)
+            self.running += 1
+            self.most = max(self.most, self.running)
+        time.sleep(self.secs)
+        with self.lock:
+            self.running -= 1
+        return ' '.join(argv)
+
+
+def test_executor_lab_limit():
+    bkr = FakeBkr()
+    ex = BkrExecutor(workers=8, per_lab=2, call=bkr)
+    results = [ex.submit(['bkr', 'system-reserve', 'host-%d.lab-a' % i],
+                         'host-%d.lab-a' % i) for i in range(6)]
+    eq_([r.get() for r in results],
+        ['bkr system-reserve host-%d.lab-a' % i for i in range(6)])
+    eq_(bkr.most, 2)
+
+
+def test_executor_busy_lab():
+    bkr = FakeBkr(secs=0.1)
+    ex = BkrExecutor(workers=2, per_lab=1, call=bkr)
+    results = [ex.submit(['bkr', 'system-reserve', 'host-%d.lab-a' % i],
+                         'host-%d.lab-a' % i) for i in range(3)]
+    other = ex.submit(['bkr', 'system-reserve', 'host-0.lab-b'],
+                      'host-0.lab-b')
+    other.get()
+    # the commands waiting for lab-a don't hold a thread of the pool
+    eq_(bkr.argvs[1], ['bkr', 'system-reserve', 'host-0.lab-b'])
+    eq_([r.get() for r in results],
+        ['bkr system-reserve host-%d.lab-a' % i for i in range(3)])
+
+
+def test_executor_shares_status():
+    bkr = FakeBkr()
+    ex = BkrExecutor(check_output=bkr)
+    argv = ['bkr', 'system-status', 'host-01.lab-a', '--format', 'json']
+    results = [ex.submit(argv, 'host-01.lab-a', output=True, ttl=10)
+               for _ in range(5)]
+    eq_(len(set(r.get() for r in results)), 1)
+    # and reuses it for a while
+    eq_(ex.submit(argv, 'host-01.lab-a', output=True, ttl=10).get(),
+        results[0].get())
+    eq_(len(bkr.argvs), 1)
+    ex.clock = lambda: time.time() + 11
+    ex.submit(argv, 'host-01.lab-a', output=True, ttl=10).get()
+    eq_(len(bkr.argvs), 2)
+
+
+class FakeBeakerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """The beaker server as far as BkrSession uses it"""
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, code, body=''):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self):
+        srv = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        srv.requests.append((self.command, self.path, body))
+        if srv.down:
+            return self._reply(503)
+        if srv.reject or \
+                'beaker_auth_token=t' not in self.headers.get('Cookie', ''):
+            return self._reply(401)
+        if self.path.endswith('/status'):
+            return self._reply(200, json.dumps(dict(
+                condition='Automated',
+                current_reservation=dict(user_name='yaniwang'))))
+        if self.path.endswith('/commands/') or '/reservations/' in self.path:
+            return self._reply(201 if self.command == 'POST' else 200, '{}')
+        self._reply(404)
+
+    def do_POST(self):
+        if self.path == '/login' and not self.server.down:
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.server.requests.append(('POST', '/login', ''))
+            self.server.logins += 1
+            self.send_response(200)
+            self.send_header('Set-Cookie', 'beaker_auth_token=t; Path=/')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self._handle()
+
+    do_GET = do_PATCH = _handle
+
+
+def _fake_beaker():
+    srv = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), FakeBeakerHandler)
+    srv.requests, srv.logins, srv.down, srv.reject = [], 0, False, False
+    t = threading.Thread(target=srv.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    return srv
+
+
+def test_rest_backend():
+    srv = _fake_beaker()
+    cli = FakeBkr(secs=0)
+    try:
+        session = BkrSession(url='http://127.0.0.1:%d' % srv.server_port,
+                             credential=('yaniwang', 'secret'))
+        bk = Beaker(backend='rest', session=session,
+                    executor=BkrExecutor(call=cli, check_output=cli))
+        eq_(bk.reserve('host-01.lab-a'), 0)
+        eq_(bk.reboot('host-01.lab-a'), 0)
+        eq_(bk.status('host-01.lab-a'), True)
+        eq_(srv.logins, 1)
+        eq_(srv.requests[1:], [
+            ('POST', '/systems/host-01.lab-a/reservations/', '{}'),
+            ('POST', '/systems/host-01.lab-a/commands/',
+             '{"action": "reboot"}'),
+            ('GET', '/systems/host-01.lab-a/status', '')])
+        eq_(cli.argvs, [])
+
+        # the bkr client takes over while the server is down
+        srv.down = True
+        eq_(bk.release('host-01.lab-a'), 'bkr system-release host-01.lab-a')
+        eq_(cli.argvs, [['bkr', 'system-release', 'host-01.lab-a']])
+    finally:
+        srv.shutdown()
+        srv.server_close()
+
+
+def test_rest_backend_rejected():
+    srv = _fake_beaker()
+    srv.reject = True
+    cli = FakeBkr(secs=0)
+    try:
+        session = BkrSession(url='http://127.0.0.1:%d' % srv.server_port,
+                             credential=('yaniwang', ''))
+        bk = Beaker(backend='rest', session=session,
+                    executor=BkrExecutor(call=cli, check_output=cli))
+        eq_(bk.reserve('host-01.lab-a'), 'bkr system-reserve host-01.lab-a')
+        eq_(bk.reboot('host-01.lab-a'),
+            'bkr system-power --action reboot host-01.lab-a')
+        # a 401 right after the login is a failed login, it isn't tried
+        # again for a while
+        eq_(srv.logins, 1)
+        eq_(len(cli.argvs), 2)
+    finally:
+        srv.shutdown()
+        srv.server_close()
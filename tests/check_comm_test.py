@@ -0,0 +1,151 @@
+import time
+import logging
+import threading
+import subprocess
+from nose.tools import ok_, eq_
+from auto_installation.check_comm import CheckYoo, readonly_checkpoint
+from auto_installation.sshpool import CmdResult, CommandTimeout
+
+
+class FakeCheck(CheckYoo):
+    def __init__(self):
+        super(FakeCheck, self).__init__()
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def _probe(self, name):
+        time.sleep(0.2)
+        with self.lock:
+            self.calls.append(name)
+        return True
+
+    @readonly_checkpoint
+    def a_check(self):
+        return self._probe('a')
+
+    @readonly_checkpoint
+    def b_check(self):
+        return self._probe('b')
+
+    @readonly_checkpoint
+    def c_check(self):
+        return self._probe('c')
+
+    def setup_check(self):
+        self.calls.append('setup')
+        return True
+
+    def roll_back_check(self):
+        self.calls.append('roll_back')
+        return False
+
+
+def test_run_checkpoints():
+    ck = FakeCheck()
+    cks = {}
+    start = time.time()
+    ck.run_checkpoints([('a_check', ['RHEVM-1']), ('b_check', ['RHEVM-2']),
+                        ('setup_check', ['RHEVM-3']), ('c_check', ['RHEVM-4']),
+                        ('roll_back_check', ['RHEVM-5'])], cks)
+
+    # a and b run at the same time, the stateful ones keep their place
+    ok_(time.time() - start < 0.6)
+    eq_(sorted(ck.calls[:2]), ['a', 'b'])
+    eq_(ck.calls[2:], ['setup', 'c', 'roll_back'])
+    eq_(cks, {'RHEVM-1': 'passed', 'RHEVM-2': 'passed',
+              'RHEVM-3': 'passed', 'RHEVM-4': 'passed',
+              'RHEVM-5': 'failed'})
+    eq_(sorted(ck.durations), ['a_check', 'b_check', 'c_check',
+                               'roll_back_check', 'setup_check'])
+
+
+class LocalConn(object):
+    """Runs the script with the local bash and answers like
+    SSHConnection.run. A pty turns the newlines into \r\n, a script killed
+    by a timeout stops in the middle of command `killed_at`"""
+
+    def __init__(self, pty=False, killed_at=None, error=None):
+        self.pty = pty
+        self.killed_at = killed_at
+        self.error = error
+        self.scripts = []
+
+    def run(self, cmd, timeout=None):
+        self.scripts.append(cmd)
+        if self.error:
+            raise self.error
+        if self.killed_at is not None:
+            cmd = '\n'.join(cmd.split('\n')[:self.killed_at] +
+                            ['printf cut; exit 124'])
+        p = subprocess.Popen(['/bin/bash', '-c', cmd], stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+        output = p.communicate()[0]
+        if self.pty:
+            output = output.replace('\n', '\r\n')
+        return CmdResult.make(output.strip(), p.returncode, cmd)
+
+
+class BatchCheck(CheckYoo):
+    def __init__(self, conn):
+        super(BatchCheck, self).__init__()
+        self._conn = conn
+
+    @property
+    def conn(self):
+        return self._conn
+
+
+class Records(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+CMDS = ['printf abc', 'echo def', 'printf "a\\nb\\n"', 'true']
+
+
+def test_run_cmds():
+    conn = LocalConn()
+    eq_(BatchCheck(conn).run_cmds(CMDS),
+        [(True, 'abc'), (True, 'def'), (True, 'a\nb'), (True, '')])
+    # a single round trip
+    eq_(len(conn.scripts), 1)
+
+
+def test_run_cmds_pty():
+    eq_(BatchCheck(LocalConn(pty=True)).run_cmds(CMDS),
+        [(True, 'abc'), (True, 'def'), (True, 'a\r\nb'), (True, '')])
+
+
+def test_run_cmds_failed_cmd():
+    eq_(BatchCheck(LocalConn()).run_cmds(
+        ['echo a', 'echo b; exit 3', 'ls /nonexistent >/dev/null 2>&1',
+         'echo c']),
+        [(True, 'a'), (False, 'b'), (False, ''), (True, 'c')])
+
+
+def test_run_cmds_killed():
+    eq_(BatchCheck(LocalConn(killed_at=1)).run_cmds(
+        ['echo a', 'echo b; sleep 600', 'echo c']),
+        [(True, 'a'), (False, 'cut'), (False, '')])
+
+
+def test_run_cmds_batch_failed():
+    e = CommandTimeout(60)
+    eq_(BatchCheck(LocalConn(error=e)).run_cmds(['echo a', 'echo b']),
+        [(False, e), (False, e)])
+
+
+def test_run_cmds_logged_once():
+    records = Records()
+    log = logging.getLogger('bender')
+    log.addHandler(records)
+    try:
+        BatchCheck(LocalConn()).run_cmds(['echo a', 'false'])
+    finally:
+        log.removeHandler(records)
+    eq_(records.messages, ['Run cmd "echo a" succeeded',
+                           'Run cmd "false" failed'])
@@ -0,0 +1,57 @@
+import logging
+from nose.tools import eq_
+from auto_installation import check_vdsm
+
+
+class FakeRhevmAction(object):
+    # the session is shared with the checks before
+    round_trips = 40
+
+    def __init__(self, rhevm_fqdn):
+        self.rhevm_fqdn = rhevm_fqdn
+
+
+class FakeCheckVdsm(check_vdsm.CheckVdsm):
+    def _get_rhvm_fqdn(self):
+        self._rhvm_fqdn = 'rhvm41.example.com'
+
+    def _create_datacenter(self):
+        FakeRhevmAction.round_trips += 2
+
+    def _create_cluster(self):
+        FakeRhevmAction.round_trips += 1
+
+    def run_cases(self):
+        FakeRhevmAction.round_trips += 5
+        return {}
+
+    def _teardown_after_check(self):
+        FakeRhevmAction.round_trips += 2
+
+
+class Records(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def test_round_trips_of_check():
+    records = Records()
+    log = logging.getLogger('bender')
+    log.addHandler(records)
+    rhevm_action = check_vdsm.RhevmAction
+    check_vdsm.RhevmAction = FakeRhevmAction
+    try:
+        FakeCheckVdsm().go_check()
+        # the requests of other checks in between are not counted
+        FakeRhevmAction.round_trips += 7
+        FakeCheckVdsm().go_check()
+    finally:
+        check_vdsm.RhevmAction = rhevm_action
+        log.removeHandler(records)
+    eq_([m for m in records.messages if 'requests have been sent' in m],
+        ["10 requests have been sent to rhvm41.example.com over the shared "
+         "session during this check"] * 2)
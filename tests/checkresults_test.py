@@ -0,0 +1,69 @@
+import os
+import uuid
+import shutil
+import tempfile
+from nose.tools import ok_, eq_, with_setup
+from auto_installation import check_comm, checkresults, reports
+
+_get_checkpoint_cases_map = check_comm.get_checkpoint_cases_map
+
+
+def setup_cases():
+    check_comm.get_checkpoint_cases_map = lambda ks, mc: {
+        'install_check': ['RHEVM-1', 'RHEVM-2'], 'iqn_check': ['RHEVM-3']}
+
+
+def teardown_cases():
+    check_comm.get_checkpoint_cases_map = _get_checkpoint_cases_map
+
+
+class FakeCheck(check_comm.CheckYoo):
+    def install_check(self):
+        return True
+
+    def iqn_check(self):
+        # every install has its own iqn
+        self.run_info['iqn'] = 'iqn.1994-05.com.redhat:' + uuid.uuid4().hex
+        return True
+
+
+def _run(results_file, ksfile='ati_fc_04.ks', failed=()):
+    ck = FakeCheck()
+    ck.ksfile, ck.beaker_name = ksfile, 'host-01'
+    cks = {}
+    ck.run_checkpoints([('install_check', ['RHEVM-1', 'RHEVM-2']),
+                        ('iqn_check', ['RHEVM-3'])], cks)
+    for case in failed:
+        cks[case] = 'failed'
+    ck.save_results(results_file, cks, 0)
+
+
+@with_setup(setup_cases, teardown_cases)
+def test_save_and_read_results():
+    tmp = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(tmp, 'ati_fc_04.ks'))
+        results_file = os.path.join(tmp, 'ati_fc_04.ks',
+                                    checkresults.RESULTS_FILE)
+        _run(results_file)
+        _run(results_file, failed=['RHEVM-2'])
+        # a run cut short while writing is left out
+        with open(results_file, 'a') as fp:
+            fp.write('{"run": "x", "case": "RHEVM-1", "sta')
+
+        runs = checkresults.read_runs(results_file)
+        eq_([run['cases'] for run in runs], [
+            {'RHEVM-1': 'passed', 'RHEVM-2': 'passed', 'RHEVM-3': 'passed'},
+            {'RHEVM-1': 'passed', 'RHEVM-2': 'failed', 'RHEVM-3': 'passed'}])
+        ok_(runs[0]['iqn'].startswith('iqn.1994-05.com.redhat:'))
+        eq_(runs[0]['total'], 3)
+
+        report = reports.ResultsToPolarion(tmp, '-l')
+        # three installs are expected, until then there are no results
+        eq_(report._read_checkpoint_results(results_file), {})
+        _run(results_file)
+        # a case passes only if it passed on every install
+        eq_(report._read_checkpoint_results(results_file),
+            {'RHEVM-1': 'passed', 'RHEVM-2': 'failed', 'RHEVM-3': 'passed'})
+    finally:
+        shutil.rmtree(tmp)
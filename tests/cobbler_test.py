@@ -0,0 +1,112 @@
+import threading
+import xmlrpclib
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+from nose.tools import eq_
+from auto_installation.cobbler import Cobbler
+
+
+class QuietHandler(SimpleXMLRPCRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class FakeCobbler(SimpleXMLRPCServer):
+    """The cobbler api as far as Cobbler uses it, counting the requests"""
+
+    def __init__(self):
+        SimpleXMLRPCServer.__init__(self, ('127.0.0.1', 0), QuietHandler,
+                                    logRequests=False)
+        self.register_multicall_functions()
+        for name in ('login', 'new_system', 'modify_system', 'save_system',
+                     'remove_system'):
+            self.register_function(getattr(self, name), name)
+        self.requests = 0
+        self.logins = 0
+        self.token = None
+        self.systems = {}
+        # the token expires at the next call of this method
+        self.expire_on = None
+
+    def _marshaled_dispatch(self, *args, **kwargs):
+        # a multicall is one request
+        self.requests += 1
+        return SimpleXMLRPCServer._marshaled_dispatch(self, *args, **kwargs)
+
+    def _check(self, method, token):
+        if self.expire_on == method:
+            self.expire_on, self.token = None, None
+        if token != self.token:
+            raise xmlrpclib.Fault(1, "invalid token: %s" % token)
+
+    def login(self, user, password):
+        self.logins += 1
+        self.token = 'token-%d' % self.logins
+        return self.token
+
+    def new_system(self, token):
+        self._check('new_system', token)
+        system_id = '___NEW___system::%d' % len(self.systems)
+        self.systems[system_id] = {}
+        return system_id
+
+    def modify_system(self, system_id, key, value, token):
+        self._check('modify_system', token)
+        self.systems[system_id][key] = value
+        return True
+
+    def save_system(self, system_id, token):
+        self._check('save_system', token)
+        self.systems[system_id]['saved'] = True
+        return True
+
+    def remove_system(self, name, token):
+        self._check('remove_system', token)
+        return True
+
+
+def _fake_cobbler():
+    srv = FakeCobbler()
+    t = threading.Thread(target=srv.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    return srv, 'http://127.0.0.1:%d/' % srv.server_address[1]
+
+
+def _add(cb_api, name):
+    with Cobbler(cb_api=cb_api, credential=('cobbler', 'cobbler')) as cb:
+        cb.add_new_system(name=name, profile='RHVH-4.1',
+                          modify_interface={'macaddress-em1': 'aa'})
+
+
+def test_add_system_rpcs():
+    srv, cb_api = _fake_cobbler()
+    try:
+        _add(cb_api, 'host-01')
+        # login, new_system and one multicall for all fields
+        eq_(srv.requests, 3)
+        _add(cb_api, 'host-02')
+        # the session and its token are reused
+        eq_(srv.requests, 5)
+        eq_(srv.logins, 1)
+        eq_(sorted(s['name'] for s in srv.systems.values() if s.get('saved')),
+            ['host-01', 'host-02'])
+    finally:
+        srv.shutdown()
+        srv.server_close()
+
+
+def test_expired_token_in_multicall():
+    srv, cb_api = _fake_cobbler()
+    try:
+        _add(cb_api, 'host-01')
+        srv.expire_on = 'modify_system'
+        _add(cb_api, 'host-02')
+        eq_(srv.logins, 2)
+        eq_(srv.systems['___NEW___system::1']['saved'], True)
+        srv.expire_on = 'new_system'
+        _add(cb_api, 'host-03')
+        eq_(srv.logins, 3)
+        eq_(srv.systems['___NEW___system::2']['saved'], True)
+    finally:
+        srv.shutdown()
+        srv.server_close()
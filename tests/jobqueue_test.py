@@ -0,0 +1,198 @@
+import json
+import threading
+from nose.tools import ok_, eq_, raises, with_setup
+from auto_installation import jobqueue
+
+
+class FakePipeline(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call(*args):
+            self.calls.append((name, args))
+            return self
+        return call
+
+    def execute(self):
+        calls, self.calls = self.calls, []
+        return [getattr(self.conn, name)(*args) for name, args in calls]
+
+
+class FakeRedis(object):
+    def __init__(self):
+        self.data = {}
+        self.published = []
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def hmset(self, key, mapping):
+        self.data.setdefault(key, {}).update(mapping)
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def expire(self, key, seconds):
+        pass
+
+    def publish(self, channel, message):
+        self.published.append((channel, json.loads(message)))
+
+    def set(self, key, value, nx=False, px=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = str(value)
+        return True
+
+    def register_script(self, script):
+        def run(keys, args):
+            if self.data.get(keys[0]) != args[0]:
+                return 0
+            if script is jobqueue._RELEASE_SCRIPT:
+                del self.data[keys[0]]
+            return 1
+        return run
+
+
+class FakeRunner(object):
+    """Jobs run until they are finished by the test"""
+
+    def __init__(self):
+        self.started = []
+        self.finish = {}
+        self.cond = threading.Condition()
+
+    def __call__(self, job, rd_conn, on_state):
+        with self.cond:
+            self.finish[job.id] = threading.Event()
+            self.started.append(job)
+            self.cond.notify_all()
+        self.finish[job.id].wait()
+
+    def wait_started(self, n):
+        with self.cond:
+            while len(self.started) < n:
+                self.cond.wait(1)
+
+
+_get_machine_ksl_map = jobqueue.get_machine_ksl_map
+
+
+def setup_machines():
+    jobqueue.get_machine_ksl_map = lambda: {
+        'm1': ['a.ks'], 'm2': ['b.ks'], 'm3': ['c.ks']}
+
+
+def teardown_machines():
+    jobqueue.get_machine_ksl_map = _get_machine_ksl_map
+
+
+def test_machine_locks():
+    conn = FakeRedis()
+    locks = jobqueue.MachineLocks(conn)
+    ok_(locks.acquire(['m1', 'm2'], 'job1'))
+    # all or nothing
+    ok_(not locks.acquire(['m2', 'm3'], 'job2'))
+    eq_(locks.owner('m3'), None)
+    eq_(locks.renew(['m1', 'm2'], 'job2'), ['m1', 'm2'])
+    locks.release(['m1', 'm2'], 'job2')
+    eq_(locks.owner('m1'), 'job1')
+    locks.release(['m1', 'm2'], 'job1')
+    eq_(conn.data, {})
+
+
+@with_setup(setup_machines, teardown_machines)
+def test_job_queue():
+    conn, runner = FakeRedis(), FakeRunner()
+    queue = jobqueue.JobQueue(conn, runner=runner, interval=1)
+    job1 = queue.submit('url1', machines=['m1'])
+    job2 = queue.submit('url2', machines=['m1', 'm2'])
+    job3 = queue.submit('url3', machines=['m3'])
+
+    # job3 doesn't share machines with job1, job2 waits for m1
+    runner.wait_started(2)
+    eq_([j.id for j in runner.started], [job1.id, job3.id])
+    eq_(queue.get(job2.id), job2)
+    eq_(queue.get('nothing'), None)
+    eq_([j['state'] for j in queue.status()],
+        ['provisioning', 'queued', 'provisioning'])
+    eq_(conn.get('running'), '1')
+    # job4 must not jump ahead of job2 waiting for m2
+    job4 = queue.submit('url4', machines=['m2'])
+
+    runner.finish[job1.id].set()
+    runner.wait_started(3)
+    eq_(runner.started[2].id, job2.id)
+    eq_(conn.get(jobqueue.MACHINE_LOCK_KEY.format('m1')), job2.id)
+
+    runner.finish[job2.id].set()
+    runner.wait_started(4)
+    eq_(runner.started[3].id, job4.id)
+
+    for job in (job3, job4):
+        runner.finish[job.id].set()
+    for _ in range(50):
+        if not queue.status():
+            break
+        threading.Event().wait(0.1)
+    eq_(queue.status(), [])
+    eq_(queue.get(job1.id), None)
+    eq_(conn.get('running'), '0')
+    queue.close()
+
+
+def test_job_states():
+    conn = FakeRedis()
+    queue = jobqueue.JobQueue(conn)
+    job = jobqueue.Job('url', frozenset(['m1', 'm2']))
+    for state, machine in [('queued', None), ('provisioning', None),
+                           ('installing', 'm1'), ('provisioning', 'm2'),
+                           ('done', 'm1'), ('checking', 'm2')]:
+        queue.set_state(job, state, machine)
+
+    # the job never goes back, and isn't done with one of its machines
+    eq_([e['state'] for _, e in conn.published],
+        ['queued', 'provisioning', 'installing', 'installing', 'installing',
+         'checking'])
+    eq_(set(c for c, _ in conn.published), set(['job_events:' + job.id]))
+
+    saved = jobqueue.get_job(conn, job.id)
+    eq_(saved['state'], 'checking')
+    eq_(saved['machine_states'], {'m1': 'done', 'm2': 'checking'})
+    eq_(saved['machines'], ['m1', 'm2'])
+    eq_(jobqueue.get_job(conn, 'nothing'), None)
+
+
+@raises(ValueError)
+@with_setup(setup_machines, teardown_machines)
+def test_unknown_machine():
+    jobqueue.JobQueue(FakeRedis()).submit('url', machines=['m4'])
+
+
+@with_setup(setup_machines, teardown_machines)
+def test_announced_job():
+    conn, runner = FakeRedis(), FakeRunner()
+    queue = jobqueue.JobQueue(conn, runner=runner, interval=1)
+    announced = queue.announce('rhvh-4.1-20170601.0')
+    eq_(jobqueue.get_job(conn, announced.id)['state'], 'queued')
+
+    # the celery task submits the job with the id it was given
+    job = queue.submit('url', machines=['m1'], job_id=announced.id)
+    eq_(job.id, announced.id)
+    runner.wait_started(1)
+    saved = jobqueue.get_job(conn, announced.id)
+    eq_((saved['img_url'], saved['machines']), ('url', ['m1']))
+    try:
+        queue.submit('url', machines=['m2'], job_id=announced.id)
+    except ValueError:
+        pass
+    else:
+        ok_(False, "a job id is queued twice")
+
+    runner.finish[job.id].set()
+    queue.close()
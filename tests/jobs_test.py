@@ -0,0 +1,120 @@
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from nose.tools import ok_, eq_
+from auto_installation import jobs, poll, sshpool
+from auto_installation.utils import ResultsAndLogs, job_log_publisher
+
+IMG_URL = 'http://example.com/rhvh-4.1-20170601.0/'
+
+
+class FakeRunner(jobs.JobRunner):
+    """Checks its machines without provisioning them, waits for the other
+    job at the checks so that both jobs run at the same time"""
+
+    def _set_repos(self):
+        pass
+
+    @property
+    def job_queue(self):
+        return {m: ['ati_local_01.ks'] for m in self.machines}
+
+    def _run_ks(self, ks, m):
+        self.results_logs.get_thread_logger(ks)
+        jobs.log.info("checking %s", m)
+        ip = '10.0.0.%d' % int(m[-1])
+        self._hosts.add(ip)
+        sshpool.get_connection(ip, 'root', 'redhat')
+        self.barrier.wait()
+        poll.poll(lambda: True, 10, name='host up')
+
+    def generate_final_results(self):
+        pass
+
+
+class FakeRedis(object):
+    def __init__(self):
+        self.published = []
+
+    def publish(self, channel, message):
+        self.published.append(channel)
+
+
+class Barrier(object):
+    def __init__(self, parties):
+        self.parties = parties
+        self.cond = threading.Condition()
+
+    def wait(self):
+        with self.cond:
+            self.parties -= 1
+            self.cond.notify_all()
+            while self.parties > 0:
+                self.cond.wait(5)
+
+
+def _runner(tmp, job_id, machines, barrier):
+    results_logs = ResultsAndLogs(job_id)
+    results_logs._logs_root_dir = tmp
+    results_logs.img_url = IMG_URL
+    runner = FakeRunner(IMG_URL, None, results_logs, None,
+                        machines=machines, job_id=job_id)
+    runner.barrier = barrier
+    return runner
+
+
+def test_concurrent_jobs():
+    tmp = tempfile.mkdtemp()
+    rd_conn = job_log_publisher.rd_conn
+    job_log_publisher.rd_conn = FakeRedis()
+    try:
+        barrier = Barrier(3)
+        runners = [
+            _runner(tmp, '1' * 32, ['host-1', 'host-2'], barrier),
+            _runner(tmp, '2' * 32, ['host-3'], barrier)
+        ]
+        threads = [threading.Thread(target=r.go) for r in runners]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # jobs started in the same second have a directory each
+        run_dirs = [r.results_logs._run_dir() for r in runners]
+        eq_(len(set(run_dirs)), 2)
+
+        job_logs = [open(os.path.join(d, 'results')).read()
+                    for d in run_dirs]
+        ok_('checking host-1' in job_logs[0])
+        ok_('checking host-2' in job_logs[0])
+        ok_('checking host-3' not in job_logs[0])
+        ok_('checking host-3' in job_logs[1])
+        ok_('checking host-1' not in job_logs[1])
+        ks_log = open(os.path.join(run_dirs[0], 'ati_local_01.ks',
+                                   'results')).read()
+        ok_('checking host-2' in ks_log or 'checking host-1' in ks_log)
+
+        # each job tells the ssh connections and waits of its own
+        ok_('root@10.0.0.3:22' in job_logs[1])
+        ok_('root@10.0.0.1:22' not in job_logs[1])
+        ok_('waited for host up 2 times' in job_logs[0])
+        ok_('waited for host up 1 times' in job_logs[1])
+        eq_(sshpool.get_stats(['10.0.0.1', '10.0.0.2', '10.0.0.3']), {})
+        eq_(poll.get_wait_stats('1' * 32), {})
+        eq_(set(job_log_publisher.rd_conn.published),
+            set(['job_events:' + '1' * 32, 'job_events:' + '2' * 32]))
+    finally:
+        job_log_publisher.rd_conn = rd_conn
+        shutil.rmtree(tmp)
+
+
+def test_get_test_flag():
+    job_queue = OrderedDict([
+        ('host-1', ['ati_local_01.ks', 'atv_bond_01.ks']),
+        ('host-2', ['atu_yum_update.ks', 'ati_fc_01.ks', 'cockpit.ks'])])
+    eq_(jobs.get_test_flag(job_queue), 'install')
+    job_queue['host-3'] = ['atv_nfs_01.ks']
+    eq_(jobs.get_test_flag(job_queue), 'vdsm')
+    eq_(jobs.get_test_flag({'host-1': ['cockpit.ks']}), None)
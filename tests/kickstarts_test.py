@@ -1,12 +1,27 @@
 import os
-import sys
-import string
+import shutil
+import tempfile
+import subprocess
 from nose import with_setup
 from nose.tools import ok_, eq_
-sys.path.insert(0, os.path.abspath("../auto_installation"))
-from auto_installation.kickstarts import KickStartFiles
-from auto_installation.constants import SMOKE_TEST_LIST, P1_TEST_LIST, \
-                                        MUST_HAVE_TEST_LIST
+from auto_installation import kickstarts
+from auto_installation.kickstarts import KickStartFiles, RenderCache
+
+LIVEIMG = "http://10.66.10.22:8090/rhvh/rhvh-4.1-20170601.0/redhat-virtualization-host-4.1-20170601.0.x86_64.liveimg.squashfs"
+M1 = 'dell-per510-01.lab.eng.pek2.redhat.com'
+M2 = 'dell-pet105-01.qe.lab.eng.nay.redhat.com'
+
+TEMPLATE = """lang en_US.UTF-8
+#liveimg url will be substitued by autoframework
+liveimg --url=http://example.com/old.squashfs --noverifyssl
+%packages
+%end"""
+
+RENDERED = """lang en_US.UTF-8
+#liveimg url will be substitued by autoframework
+liveimg --url={}
+%packages
+%end""".format(LIVEIMG)
 
 ksf = None
 
@@ -14,49 +29,145 @@ ksf = None
 def setup_func():
     global ksf
     ksf = KickStartFiles()
+    ksf.liveimg = LIVEIMG
 
 
-@with_setup(setup_func)
-def test_get_all_ks():
-    ksf.ks_filter = 'all'
-    ret = ksf._get_all_ks_files()
-    ok_(ret[-1] == 'ati_vlan_bond.ks')
+def setup_templates():
+    global tmp, saved
+    setup_func()
+    tmp = tempfile.mkdtemp()
+    saved = (kickstarts.KS_FILES_DIR, kickstarts.KS_FILES_AUTO_DIR,
+             kickstarts.get_ks_machine_map)
+    kickstarts.KS_FILES_DIR = os.path.join(tmp, 'templates')
+    kickstarts.KS_FILES_AUTO_DIR = os.path.join(tmp, 'auto')
+    kickstarts.get_ks_machine_map = lambda: {
+        'ati_fc_01.ks': M1, 'ati_fc_02.ks': M1, 'ati_local_01.ks': M2}
+    os.makedirs(kickstarts.KS_FILES_DIR)
+    for ks in ('ati_fc_01.ks', 'ati_fc_02.ks', 'ati_local_01.ks'):
+        _template(ks, TEMPLATE)
 
 
-@with_setup(setup_func)
-def test_get_smoke_ks():
-    ksf.ks_filter = 'smoke'
-    ret = ksf._get_all_ks_files()
-    ret_s = string.join(ret)
-    for i in SMOKE_TEST_LIST:
-        ok_(i in ret_s)
+def teardown_templates():
+    kickstarts.KS_FILES_DIR, kickstarts.KS_FILES_AUTO_DIR, \
+        kickstarts.get_ks_machine_map = saved
+    kickstarts._templates.clear()
+    shutil.rmtree(tmp)
 
 
-@with_setup(setup_func)
-def test_get_p1_ks():
-    ksf.ks_filter = 'p1'
+def _template(ks, content, mtime=None):
+    path = os.path.join(kickstarts.KS_FILES_DIR, ks)
+    with open(path, 'w') as fp:
+        fp.write(content)
+    if mtime:
+        os.utime(path, (mtime, mtime))
+    return path
 
-    ret = ksf._get_all_ks_files()
-    ret_s = string.join(ret)
 
-    for i in P1_TEST_LIST:
-        ok_(i in ret_s)
+def _sed(ks):
+    """The template as the sed of the kickstarts written before wrote it"""
+    return subprocess.check_output(
+        ["sed", "/liveimg --url=/ c\\liveimg --url=" + LIVEIMG,
+         os.path.join(kickstarts.KS_FILES_DIR, ks)])
 
 
-@with_setup(setup_func)
-def test_convert_auto_ks():
-    ksf.ks_filter = 'must'
-    ksf.liveimg = "http://10.66.10.22:8090/rhevh/rhevh7-ng-36/rhev-hypervisor7-ng-4.0-20160527.0/rhev-hypervisor7-ng-4.0-20160527.0.x86_64.liveimg.squashfs"
-    ksf._convert_to_auto_ks()
+@with_setup(setup_templates, teardown_templates)
+def test_render():
+    eq_(ksf.render('ati_fc_01.ks', M1, pre_script='%pre\n%end\n'),
+        RENDERED + '%pre\n%end\n' + ksf._post_script('ati_fc_01.ks', M1))
+    eq_(_sed('ati_fc_01.ks'), RENDERED)
 
 
 @with_setup(setup_func)
-def test_get_host_by_type():
-    eq_(ksf._get_host()[0], 'dell-per510-01.lab.eng.pek2.redhat.com')
+def test_render_like_sed():
+    # the kickstarts were written by sed before, the templates come out
+    # the same
+    names = sorted(n for n in os.listdir(kickstarts.KS_FILES_DIR)
+                   if n.endswith('.ks'))
+    ok_(names)
+    for ks in names:
+        eq_(ksf.render(ks, M1, pre_script=''),
+            _sed(ks) + ksf._post_script(ks, M1), ks)
 
 
 @with_setup(setup_func)
-def test_get_must_ks():
-    ksf.ks_filter = 'must'
-    ret = ksf._get_all_ks_files()
-    eq_(len(ret), len(MUST_HAVE_TEST_LIST))
+def test_pre_script_of_job():
+    pre = ksf._pre_script('1' * 32, M1)
+    ok_('--job {} --machine {}'.format('1' * 32, M1) in pre)
+    ok_('--job' not in ksf._pre_script())
+
+
+@with_setup(setup_templates, teardown_templates)
+def test_template_edited():
+    _template('ati_fc_01.ks', TEMPLATE, mtime=1000)
+    rendered = ksf.render('ati_fc_01.ks', M1, pre_script='')
+    ok_(rendered.startswith(RENDERED))
+    lines = kickstarts._templates[
+        os.path.join(kickstarts.KS_FILES_DIR, 'ati_fc_01.ks')][1]
+
+    # the unchanged template isn't read again
+    ksf.render('ati_fc_01.ks', M1, pre_script='')
+    ok_(kickstarts._templates[
+        os.path.join(kickstarts.KS_FILES_DIR, 'ati_fc_01.ks')][1] is lines)
+
+    _template('ati_fc_01.ks', 'lang fr_FR.UTF-8\n' + TEMPLATE, mtime=1001)
+    rendered = ksf.render('ati_fc_01.ks', M1, pre_script='')
+    ok_(rendered.startswith('lang fr_FR.UTF-8\n' + RENDERED))
+
+
+@with_setup(setup_templates, teardown_templates)
+def test_convert_to_auto_ks():
+    auto_dir = kickstarts.KS_FILES_AUTO_DIR
+    os.makedirs(auto_dir)
+    with open(os.path.join(auto_dir, 'ati_local_01.ks'), 'w') as fp:
+        fp.write('installing')
+
+    # the kickstart of M2 may be downloaded by another job
+    ksf._convert_to_auto_ks([M1])
+    eq_(sorted(os.listdir(auto_dir)),
+        ['ati_fc_01.ks', 'ati_fc_02.ks', 'ati_local_01.ks'])
+    eq_(open(os.path.join(auto_dir, 'ati_local_01.ks')).read(), 'installing')
+    eq_(open(os.path.join(auto_dir, 'ati_fc_01.ks')).read(),
+        ksf.render('ati_fc_01.ks', M1))
+    eq_(oct(os.stat(os.path.join(auto_dir, 'ati_fc_01.ks')).st_mode & 0777),
+        '0644')
+
+    # all machines, the old files go first
+    with open(os.path.join(auto_dir, 'ati_old.ks'), 'w') as fp:
+        fp.write('old')
+    ksf._convert_to_auto_ks()
+    eq_(sorted(os.listdir(auto_dir)),
+        ['ati_fc_01.ks', 'ati_fc_02.ks', 'ati_local_01.ks'])
+    eq_(open(os.path.join(auto_dir, 'ati_local_01.ks')).read(),
+        ksf.render('ati_local_01.ks', M2))
+
+
+@with_setup(setup_templates, teardown_templates)
+def test_render_cache():
+    cache = RenderCache(size=2)
+    etag, content = cache.get('ati_fc_01.ks', LIVEIMG, M1, '1' * 32)
+    eq_(content, ksf.render('ati_fc_01.ks', M1, token='1' * 32))
+    # the same kickstart for another job is another one
+    other = cache.get('ati_fc_01.ks', LIVEIMG, M1, '2' * 32)
+    ok_(other[0] != etag)
+    ok_(cache.get('ati_fc_01.ks', LIVEIMG, M1, '1' * 32)[1] is content)
+
+    # the kickstart used least recently goes first
+    cache.get('ati_local_01.ks', LIVEIMG, M2, '1' * 32)
+    eq_([key[:4] for key in cache._items],
+        [('ati_fc_01.ks', LIVEIMG, M1, '1' * 32),
+         ('ati_local_01.ks', LIVEIMG, M2, '1' * 32)])
+    ok_(cache.get('ati_fc_01.ks', LIVEIMG, M1, '2' * 32)[1] is not other[1])
+
+
+@with_setup(setup_templates, teardown_templates)
+def test_render_cache_template_edited():
+    cache = RenderCache()
+    _template('ati_fc_01.ks', TEMPLATE, mtime=1000)
+    etag, content = cache.get('ati_fc_01.ks', LIVEIMG, M1)
+    ok_(content.startswith(RENDERED))
+    eq_(cache.get('ati_fc_01.ks', LIVEIMG, M1), (etag, content))
+
+    _template('ati_fc_01.ks', 'lang fr_FR.UTF-8\n' + TEMPLATE, mtime=1001)
+    new_etag, content = cache.get('ati_fc_01.ks', LIVEIMG, M1)
+    ok_(new_etag != etag)
+    ok_(content.startswith('lang fr_FR.UTF-8\n' + RENDERED))
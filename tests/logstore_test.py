@@ -0,0 +1,66 @@
+import io
+import os
+import zlib
+import shutil
+import tempfile
+from nose.tools import ok_, eq_, raises
+from auto_installation import logstore
+
+
+def test_write_chunk():
+    tmp = tempfile.mkdtemp()
+    try:
+        log_file = os.path.join(tmp, 'pre', 'anaconda.log')
+        eq_(logstore.committed_length(log_file), 0)
+        eq_(logstore.write_chunk(log_file, 0, 'abc'), 3)
+        eq_(logstore.write_chunk(log_file, 3, 'def'), 6)
+        # a retried chunk leaves the rest of the file alone
+        eq_(logstore.write_chunk(log_file, 0, 'abc'), 6)
+        eq_(open(log_file).read(), 'abcdef')
+        # the lock of the file goes with the last write
+        ok_(log_file not in logstore._locks)
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_write_chunk_truncate():
+    tmp = tempfile.mkdtemp()
+    try:
+        log_file = os.path.join(tmp, 'anaconda.log')
+        eq_(logstore.write_chunk(log_file, 0, 'abcdef'), 6)
+        # the client's file was replaced by a shorter one
+        eq_(logstore.write_chunk(log_file, 0, 'xy', truncate=True), 2)
+        eq_(open(log_file).read(), 'xy')
+    finally:
+        shutil.rmtree(tmp)
+
+
+@raises(logstore.ChunkGapError)
+def test_write_chunk_gap():
+    tmp = tempfile.mkdtemp()
+    try:
+        logstore.write_chunk(os.path.join(tmp, 'a.log'), 1, 'abc')
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_decoded_stream():
+    body = b'[{"name": "sys.log"}]\n' + b'kernel: eth0 link up\n' * 5000
+    gz = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for encoding, data in [('deflate', zlib.compress(body)),
+                           ('gzip', gz.compress(body) + gz.flush())]:
+        stream = logstore.request_stream(io.BytesIO(data), encoding)
+        eq_(stream.readline(), b'[{"name": "sys.log"}]\n')
+        chunks = []
+        while True:
+            chunk = stream.read(1000)
+            if not chunk:
+                break
+            ok_(len(chunk) <= 1000)
+            chunks.append(chunk)
+        eq_(b''.join(chunks), body[len(b'[{"name": "sys.log"}]\n'):])
+
+
+@raises(logstore.UnsupportedEncoding)
+def test_decoded_stream_unsupported():
+    logstore.request_stream(io.BytesIO(b'abc'), 'br')
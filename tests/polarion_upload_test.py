@@ -0,0 +1,177 @@
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+from nose.tools import ok_, eq_, raises
+from auto_installation import polarion_upload
+
+Record = namedtuple('Record', 'test_case_id result')
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class FakeTestRun(object):
+    """Keeps the records of the last update, the update fails as many
+    times as asked to and takes `latency` seconds. A test run which doesn't
+    `keep` its records only takes them one by one"""
+
+    def __init__(self, clock, fail=0, latency=0.1, keep=True):
+        self.test_run_id = 'RHVH_4_1_06011000'
+        self.clock = clock
+        self.fail = fail
+        self.latency = latency
+        self.keep = keep
+        self.records = []
+        self.saved = []
+        self.updates = 0
+        self.adds = 0
+
+    def _call(self):
+        self.clock.now += self.latency
+        if self.fail:
+            self.fail -= 1
+            raise Exception('503 Service Unavailable')
+
+    def update(self):
+        self.updates += 1
+        self._call()
+        if self.keep:
+            self.saved = list(self.records)
+
+    def add_test_record_by_fields(self, test_case_id, test_result, **kwargs):
+        self.adds += 1
+        self._call()
+        self.saved.append(Record(test_case_id, test_result))
+
+    def reload(self):
+        """The test run as read again from the server"""
+        self.records = list(self.saved)
+        return self
+
+
+def _exporter(tr, clock, journal=None):
+    limiter = polarion_upload.RateLimiter(clock=clock.time, sleep=clock.sleep)
+    return polarion_upload.BulkExporter(
+        tr, journal, batch_size=10, retries=3, limiter=limiter,
+        make_record=Record, reload=tr.reload)
+
+
+def _records(n, ks='ati_fc_04.ks'):
+    return [(ks, 'RHEVM-%d' % i, 'passed') for i in range(n)]
+
+
+def test_upload_in_batches():
+    clock = FakeClock()
+    tr = FakeTestRun(clock)
+    records = _records(25) + [('ati_fc_04.ks', 'RHEVM-99', 'blocked')]
+    eq_(_exporter(tr, clock).upload(records), 25)
+    eq_(tr.updates, 3)
+    eq_(tr.saved, [Record(case, result) for _, case, result in records[:25]])
+    # quick answers don't make the upload wait
+    eq_(clock.slept, [])
+
+
+def test_retry_and_slow_down():
+    clock = FakeClock()
+    tr = FakeTestRun(clock, fail=2)
+    exporter = _exporter(tr, clock)
+    exporter.upload(_records(10))
+    eq_(tr.updates, 3)
+    eq_(len(tr.saved), 10)
+    ok_(exporter.limiter.interval > 0)
+    # the wait halves on every quick answer
+    interval = exporter.limiter.interval
+    exporter.upload(_records(10, 'ati_local_01.ks'))
+    eq_(exporter.limiter.interval, interval / 2)
+    eq_(len(tr.saved), 20)
+
+
+def test_slow_server():
+    clock = FakeClock()
+    tr = FakeTestRun(clock, latency=8)
+    exporter = _exporter(tr, clock)
+    exporter.upload(_records(20))
+    eq_(exporter.limiter.interval, 8)
+
+
+@raises(Exception)
+def test_give_up():
+    clock = FakeClock()
+    _exporter(FakeTestRun(clock, fail=4), clock).upload(_records(10))
+
+
+def test_resume():
+    tmp = tempfile.mkdtemp()
+    try:
+        journal = polarion_upload.UploadJournal(
+            os.path.join(tmp, polarion_upload.JOURNAL_FILE))
+        clock = FakeClock()
+        tr = FakeTestRun(clock)
+        journal.started(tr.test_run_id)
+        _exporter(tr, clock, journal).upload(_records(10))
+        # the second batch never makes it
+        tr.fail = 100
+        try:
+            _exporter(tr, clock, journal).upload(_records(25))
+        except Exception:
+            pass
+        with open(journal.path, 'a') as fp:
+            fp.write('{"test_run": "RHVH_4_1_06011000", "rec')
+
+        tr.fail = 0
+        # the test run is read again from the server when resuming
+        tr.reload()
+        eq_(journal.test_run_id(), tr.test_run_id)
+        eq_(_exporter(tr, clock, journal).upload(_records(25)), 15)
+        eq_(tr.saved, [Record(case, result) for _, case, result in _records(25)])
+        journal.finished(tr.test_run_id)
+        eq_(journal.test_run_id(), None)
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_lost_journal_entry():
+    tmp = tempfile.mkdtemp()
+    try:
+        journal = polarion_upload.UploadJournal(
+            os.path.join(tmp, polarion_upload.JOURNAL_FILE))
+        clock = FakeClock()
+        tr = FakeTestRun(clock)
+        journal.started(tr.test_run_id)
+        _exporter(tr, clock, journal).upload(_records(20))
+        # the entry of the second batch never reached the disk
+        with open(journal.path) as fp:
+            lines = fp.readlines()
+        with open(journal.path, 'w') as fp:
+            fp.writelines(lines[:-1])
+
+        tr.reload()
+        eq_(_exporter(tr, clock, journal).upload(_records(25)), 5)
+        eq_(tr.saved, [Record(case, result) for _, case, result in
+                       _records(25)])
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_records_one_by_one():
+    clock = FakeClock()
+    tr = FakeTestRun(clock, keep=False)
+    exporter = _exporter(tr, clock)
+    eq_(exporter.upload(_records(25)), 25)
+    ok_(not exporter.bulk)
+    # only the first update was tried
+    eq_(tr.updates, 1)
+    eq_(tr.adds, 25)
+    eq_(tr.saved, [Record(case, result) for _, case, result in
+                   _records(25)])
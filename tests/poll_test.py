@@ -0,0 +1,54 @@
+from nose.tools import ok_, eq_, raises, with_setup
+from auto_installation import poll
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+def _ready_at(clock, at, value='up', fail_at=None):
+    def check():
+        if fail_at is not None and clock.now >= fail_at:
+            raise RuntimeError('install_failed')
+        return value if clock.now >= at else None
+    return check
+
+
+def _poll(clock, check, timeout, **kwargs):
+    return poll.poll(check, timeout, name='host up', jitter=0,
+                     sleep=clock.sleep, clock=clock.time, **kwargs)
+
+
+@with_setup(poll.reset_wait_stats)
+def test_backoff():
+    clock = FakeClock()
+    # done after 4 minutes, seen within a minute of it
+    eq_(_poll(clock, _ready_at(clock, 240), 1200, interval=5,
+              max_interval=60), 'up')
+    ok_(240 <= clock.now <= 300)
+    eq_(clock.slept[:5], [5, 10, 20, 40, 60])
+    eq_(poll.get_wait_stats()['host up'][:3], (1, clock.now, clock.now))
+
+
+@with_setup(poll.reset_wait_stats)
+def test_deadline():
+    clock = FakeClock()
+    eq_(_poll(clock, _ready_at(clock, 1000), 100, delay=30), None)
+    eq_(clock.now, 100)
+    eq_(clock.slept[0], 30)
+    eq_(poll.get_wait_stats()['host up'][3], 1)
+
+
+@raises(RuntimeError)
+def test_terminal_state():
+    clock = FakeClock()
+    _poll(clock, _ready_at(clock, 1000, fail_at=20), 600)
@@ -0,0 +1,163 @@
+import io
+import os
+import shutil
+import tempfile
+import requests
+from requests.adapters import BaseAdapter
+from urllib3.response import HTTPResponse
+from nose.tools import ok_, eq_, raises, with_setup
+from auto_installation import rhvmconn
+
+FQDN = 'rhvm41.example.com'
+API_URL = 'https://%s/ovirt-engine/api' % FQDN
+
+
+class FakeEngine(BaseAdapter):
+    """Answers every request, a request verified with a ca cert other than
+    the engine's fails with SSLError"""
+
+    def __init__(self, cert='ca-1'):
+        super(FakeEngine, self).__init__()
+        self.cert = cert
+        self.requests = []
+
+    def send(self, request, verify=True, **kwargs):
+        self.requests.append((request.url, verify))
+        if verify not in (True, False, None):
+            with open(verify) as fp:
+                if fp.read() != self.cert:
+                    raise requests.exceptions.SSLError(
+                        'certificate verify failed')
+        body = self.cert if 'pki-resource' in request.url else '<api/>'
+        r = requests.Response()
+        r.status_code = 200
+        r.url = request.url
+        r.request = request
+        r.raw = HTTPResponse(body=io.BytesIO(body), preload_content=False)
+        return r
+
+    def close(self):
+        pass
+
+
+class BrokenCertEngine(FakeEngine):
+    """An engine whose ca cert never verifies"""
+
+    def send(self, request, verify=True, **kwargs):
+        if verify not in (True, False, None):
+            self.requests.append((request.url, verify))
+            raise requests.exceptions.SSLError('certificate verify failed')
+        return FakeEngine.send(self, request, verify, **kwargs)
+
+
+def setup_certs():
+    global tmp, cert_file
+    tmp = tempfile.mkdtemp()
+    cert_file = rhvmconn.CERT_FILE
+    rhvmconn.CERT_FILE = os.path.join(tmp, 'rhevm-{rhevm_fqdn}.cert')
+
+
+def teardown_certs():
+    rhvmconn.CERT_FILE = cert_file
+    rhvmconn._conns.clear()
+    shutil.rmtree(tmp)
+
+
+def _cached_cert(content):
+    path = rhvmconn.CERT_FILE.format(rhevm_fqdn=FQDN)
+    with open(path, 'w') as fp:
+        fp.write(content)
+    # written long before any request of the test
+    os.utime(path, (0, 0))
+    return path
+
+
+def _connection(engine):
+    session = rhvmconn.RhevmSession()
+    # the longer prefix wins over the adapter setup mounts
+    session.mount('https://%s/' % FQDN, engine)
+    conn = rhvmconn.RhevmConnection(FQDN, session=session)
+    conn.setup()
+    return conn
+
+
+@with_setup(setup_certs, teardown_certs)
+def test_connection_reused():
+    _cached_cert('ca-1')
+    conn = rhvmconn.get_rhevm_connection(FQDN, 'token-1')
+    ok_(rhvmconn.get_rhevm_connection(FQDN, 'token-1') is conn)
+    other = rhvmconn.get_rhevm_connection(FQDN, 'token-2')
+    ok_(other is not conn)
+    ok_(other.session is not conn.session)
+    # the cert is cached by engine, not by token
+    eq_(other.cert, conn.cert)
+
+
+@with_setup(setup_certs, teardown_certs)
+def test_cert_fetched_once():
+    engine = FakeEngine()
+    conn = _connection(engine)
+    eq_(len(engine.requests), 1)
+    ok_('pki-resource' in engine.requests[0][0])
+    eq_(engine.requests[0][1], False)
+    eq_(open(conn.cert).read(), 'ca-1')
+
+    # another connection to the same engine reads the cached cert
+    other = FakeEngine()
+    eq_(_connection(other).cert, conn.cert)
+    eq_(other.requests, [])
+
+
+@with_setup(setup_certs, teardown_certs)
+def test_round_trips():
+    _cached_cert('ca-1')
+    engine = FakeEngine()
+    conn = _connection(engine)
+    eq_(conn.round_trips, 0)
+    for _ in range(3):
+        conn.session.get(API_URL, verify=conn.cert)
+    eq_(conn.round_trips, 3)
+    eq_(len(engine.requests), 3)
+
+
+@with_setup(setup_certs, teardown_certs)
+def test_stale_cert_fetched_again():
+    # the engine was reinstalled with a new ca since the cert was cached
+    _cached_cert('ca-0')
+    engine = FakeEngine()
+    conn = _connection(engine)
+    r = conn.session.get(API_URL, verify=conn.cert)
+    eq_(r.status_code, 200)
+    eq_([url for url, _ in engine.requests],
+        [API_URL, rhvmconn.CERT_URL.format(rhevm_fqdn=FQDN), API_URL])
+    eq_(open(conn.cert).read(), 'ca-1')
+    # the failed request never got an answer
+    eq_(conn.round_trips, 2)
+
+
+@with_setup(setup_certs, teardown_certs)
+@raises(requests.exceptions.SSLError)
+def test_stale_cert_retried_once():
+    _cached_cert('ca-0')
+    engine = BrokenCertEngine()
+    conn = _connection(engine)
+    try:
+        conn.session.get(API_URL, verify=conn.cert)
+    finally:
+        eq_(len(engine.requests), 3)
+
+
+@with_setup(setup_certs, teardown_certs)
+@raises(requests.exceptions.SSLError)
+def test_ssl_error_other_cert():
+    # a request which doesn't verify with the cached cert isn't retried
+    _cached_cert('ca-1')
+    engine = FakeEngine()
+    conn = _connection(engine)
+    other = os.path.join(tmp, 'other.cert')
+    with open(other, 'w') as fp:
+        fp.write('ca-2')
+    try:
+        conn.session.get(API_URL, verify=other)
+    finally:
+        eq_(len(engine.requests), 1)
@@ -0,0 +1,198 @@
+import os
+import json
+import shutil
+import tempfile
+from nose.tools import ok_, eq_, with_setup
+from auto_installation import server, kickstarts
+from auto_installation.jobqueue import Job
+from auto_installation.kickstarts import RenderCache
+from auto_installation.utils import ResultsAndLogs, JOB_KEY
+
+TOKEN = '1' * 32
+IMG_URL = 'http://example.com/rhvh-4.1-20170601.0.x86_64.liveimg.squashfs'
+M1 = 'dell-per510-01.lab.eng.pek2.redhat.com'
+M2 = 'dell-pet105-01.qe.lab.eng.nay.redhat.com'
+
+
+class FakeJobQueue(object):
+    def __init__(self):
+        self.jobs = {}
+        self.latest = None
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+
+class FakeRedis(object):
+    def __init__(self):
+        self.data = {}
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+
+class CurrentLogs(object):
+    def __init__(self, log_path):
+        self.current_log_path = log_path
+
+
+def setup_uploads():
+    global tmp, client, saved
+    tmp = tempfile.mkdtemp()
+    saved = server.job_queue, server.results_logs
+    server.job_queue = FakeJobQueue()
+    server.results_logs = CurrentLogs(os.path.join(tmp, 'current'))
+    results_logs = ResultsAndLogs(TOKEN)
+    results_logs.set_machine_log_path('host-01', os.path.join(tmp, 'host-01'))
+    server.job_queue.jobs[TOKEN] = Job('http://example.com/img/', ['host-01'],
+                                       id=TOKEN, results_logs=results_logs)
+    client = server.app.test_client()
+
+
+def teardown_uploads():
+    server.job_queue, server.results_logs = saved
+    shutil.rmtree(tmp)
+
+
+def _read(*parts):
+    with open(os.path.join(tmp, *parts)) as fp:
+        return fp.read()
+
+
+def _json(res):
+    return json.loads(res.get_data())
+
+
+@with_setup(setup_uploads, teardown_uploads)
+def test_upload_v1():
+    res = client.put('/upload/v1/pre/anaconda.log/0', data='abc')
+    eq_(res.status_code, 200)
+    eq_(_json(res), {'committed': 3})
+    res = client.put('/upload/v1/pre/anaconda.log/3', data='def')
+    eq_(_json(res), {'committed': 6})
+    eq_(_json(client.get('/upload/v1/pre/anaconda.log')), {'committed': 6})
+    eq_(_read('current', 'pre', 'anaconda.log'), 'abcdef')
+
+    # a chunk past the end is refused with what the server has
+    res = client.put('/upload/v1/pre/anaconda.log/9', data='x')
+    eq_(res.status_code, 409)
+    eq_(_json(res), {'committed': 6})
+
+    res = client.put('/upload/v1/pre/anaconda.log/0?truncate=1', data='xy')
+    eq_(_json(res), {'committed': 2})
+    eq_(_read('current', 'pre', 'anaconda.log'), 'xy')
+
+
+@with_setup(setup_uploads, teardown_uploads)
+def test_upload_v1_of_machine():
+    url = '/upload/v1/{}/host-01/post/ks.cfg'.format(TOKEN)
+    eq_(_json(client.put(url + '/0', data='abc')), {'committed': 3})
+    eq_(_json(client.get(url)), {'committed': 3})
+    eq_(_read('host-01', 'post', 'ks.cfg'), 'abc')
+    # the job is over, or the machine isn't one of it
+    eq_(client.put('/upload/v1/{}/host-01/post/ks.cfg/0'.format('2' * 32),
+                   data='abc').status_code, 410)
+    eq_(client.put('/upload/v1/{}/host-02/post/ks.cfg/0'.format(TOKEN),
+                   data='abc').status_code, 410)
+
+
+@with_setup(setup_uploads, teardown_uploads)
+def test_upload_v2():
+    manifest = [{'name': 'anaconda.log', 'offset': 0, 'size': 3},
+                {'name': 'syslog', 'offset': 0, 'size': 2}]
+    res = client.post('/upload/v2/{}/host-01/pre'.format(TOKEN),
+                      data=json.dumps(manifest) + '\nabcxy')
+    eq_(res.status_code, 200)
+    eq_(_json(res), {'anaconda.log': 3, 'syslog': 2})
+    eq_(_read('host-01', 'pre', 'anaconda.log'), 'abc')
+    eq_(_read('host-01', 'pre', 'syslog'), 'xy')
+    ok_('X-Accept-Encoding' in res.headers)
+
+
+@with_setup(setup_uploads, teardown_uploads)
+def test_upload_outside_log_dir():
+    for url in ('/upload/v1/../evil.log/0', '/upload/v1/pre/../0',
+                '/upload/v1/./evil.log/0', '/upload/v1/pre/./0',
+                '/upload/v1/{}/host-01/../evil.log/0'.format(TOKEN)):
+        eq_(client.put(url, data='abc').status_code, 400, url)
+    eq_(client.get('/upload/v1/../evil.log').status_code, 400)
+
+    body = json.dumps([{'name': 'evil.log', 'offset': 0, 'size': 3}]) + \
+        '\nabc'
+    eq_(client.post('/upload/v2/..', data=body).status_code, 400)
+    for name in ('..', '../evil.log', '', 'pre/../../evil.log'):
+        body = json.dumps([{'name': 'anaconda.log', 'offset': 0, 'size': 3},
+                           {'name': name, 'offset': 0, 'size': 3}]) + \
+            '\nabcabc'
+        eq_(client.post('/upload/v2/pre', data=body).status_code, 400, name)
+    ok_(not os.path.exists(os.path.join(tmp, 'evil.log')))
+    ok_(not os.path.exists(os.path.join(tmp, 'current', 'evil.log')))
+    # a rejected manifest writes nothing
+    ok_(not os.path.exists(os.path.join(tmp, 'current', 'pre')))
+
+
+def setup_kickstarts():
+    global tmp, client, saved
+    tmp = tempfile.mkdtemp()
+    saved = (server.rd_conn, server.ks_cache, server.get_machine_ksl_map,
+             kickstarts.KS_FILES_DIR)
+    server.rd_conn = FakeRedis()
+    job = Job(IMG_URL, [M1, M2], id=TOKEN)
+    server.rd_conn.data[JOB_KEY.format(TOKEN)] = {
+        'job': json.dumps(job.as_dict()), 'state': 'running'}
+    server.ks_cache = RenderCache()
+    server.get_machine_ksl_map = lambda: {
+        M1: ['ati_fc_01.ks', 'ati_gone.ks'], M2: ['ati_local_01.ks']}
+    kickstarts.KS_FILES_DIR = tmp
+    for ks in ('ati_fc_01.ks', 'ati_local_01.ks'):
+        with open(os.path.join(tmp, ks), 'w') as fp:
+            fp.write('liveimg --url=http://example.com/old.squashfs\n')
+    client = server.app.test_client()
+
+
+def teardown_kickstarts():
+    server.rd_conn, server.ks_cache, server.get_machine_ksl_map, \
+        kickstarts.KS_FILES_DIR = saved
+    kickstarts._templates.clear()
+    shutil.rmtree(tmp)
+
+
+@with_setup(setup_kickstarts, teardown_kickstarts)
+def test_kickstart():
+    url = '/ks/{}/{}/ati_fc_01.ks'.format(TOKEN, M1)
+    res = client.get(url)
+    eq_(res.status_code, 200)
+    content = res.get_data()
+    ok_(content.startswith('liveimg --url={}\n'.format(IMG_URL)))
+    ok_('--job {} --machine {}'.format(TOKEN, M1) in content)
+    etag = res.headers['ETag']
+
+    # the installer fetches it again
+    res = client.get(url, headers={'If-None-Match': etag})
+    eq_(res.status_code, 304)
+    eq_(res.get_data(), '')
+    eq_(res.headers['ETag'], etag)
+    eq_(client.get(url, headers={'If-None-Match': '"other"'}).status_code,
+        200)
+
+    # another machine of the job
+    res = client.get('/ks/{}/{}/ati_local_01.ks'.format(TOKEN, M2))
+    eq_(res.status_code, 200)
+    ok_(res.headers['ETag'] != etag)
+
+
+@with_setup(setup_kickstarts, teardown_kickstarts)
+def test_kickstart_not_found():
+    for url in (
+            # no such job
+            '/ks/{}/{}/ati_fc_01.ks'.format('2' * 32, M1),
+            # the job doesn't install the machine
+            '/ks/{}/{}/ati_fc_01.ks'.format(
+                TOKEN, 'dell-per515-01.lab.eng.pek2.redhat.com'),
+            # the kickstart isn't queued for the machine
+            '/ks/{}/{}/ati_local_01.ks'.format(TOKEN, M1),
+            '/ks/{}/{}/atv_bonda_01.ks'.format(TOKEN, M1),
+            '/ks/{}/{}/..'.format(TOKEN, M1),
+            # queued, but there is no such template
+            '/ks/{}/{}/ati_gone.ks'.format(TOKEN, M1)):
+        eq_(client.get(url).status_code, 404, url)
@@ -0,0 +1,116 @@
+import socket
+import threading
+import subprocess
+import paramiko
+from nose.tools import ok_, eq_, raises
+from auto_installation.sshpool import SSHConnection, CommandTimeout
+from auto_installation.sshpool import get_connection
+
+HOST_KEY = paramiko.RSAKey.generate(1024)
+
+
+class FakeHost(paramiko.ServerInterface):
+    """Accept password 'redhat' and run exec requests on localhost"""
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        if password == 'redhat':
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        t = threading.Thread(target=self._exec, args=(channel, command))
+        t.setDaemon(True)
+        t.start()
+        return True
+
+    def _exec(self, channel, command):
+        p = subprocess.Popen(
+            command,
+            shell=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env={'PATH': '/usr/bin:/bin', 'HOME': '/nonexistent'})
+        channel.sendall(p.communicate()[0])
+        channel.send_exit_status(p.returncode)
+        channel.close()
+
+
+class SSHServer(object):
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        self.transports = []
+        t = threading.Thread(target=self._serve)
+        t.setDaemon(True)
+        t.start()
+
+    def _serve(self):
+        while True:
+            client, _ = self.sock.accept()
+            transport = paramiko.Transport(client)
+            transport.add_server_key(HOST_KEY)
+            transport.start_server(server=FakeHost())
+            self.transports.append(transport)
+
+    def drop(self):
+        """Close all connections like a rebooting host"""
+        for transport in self.transports:
+            transport.close()
+        self.transports = []
+
+
+server = SSHServer()
+
+
+def _conn():
+    return SSHConnection('127.0.0.1', 'root', 'redhat', port=server.port)
+
+
+def test_run_reuses_connection():
+    conn = _conn()
+    ret = conn.run('echo "a $((1 + 1))"', timeout=30)
+    eq_(ret, 'a 2')
+    ok_(ret.succeeded)
+    ret = conn.run('exit 3', timeout=30)
+    eq_(ret.return_code, 3)
+    ok_(ret.failed)
+    eq_(conn.connects, 1)
+    conn.close()
+
+
+def test_reconnect_after_drop():
+    conn = _conn()
+    eq_(conn.run('echo before', timeout=30), 'before')
+    server.drop()
+    eq_(conn.run('echo after', timeout=30), 'after')
+    eq_(conn.connects, 2)
+    ok_(conn.handshake_time > 0)
+    conn.close()
+
+
+@raises(CommandTimeout)
+def test_run_timeout():
+    conn = _conn()
+    try:
+        conn.run('sleep 5', timeout=0.5)
+    finally:
+        conn.close()
+
+
+def test_get_connection():
+    conn = get_connection('127.0.0.1:%d' % server.port, 'root', 'redhat')
+    ok_(conn is get_connection('127.0.0.1:%d' % server.port, 'root'))
+    eq_(conn.port, server.port)
+    # asking without a password keeps the one to reconnect with
+    eq_(conn.password, 'redhat')
@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+from nose.tools import ok_, eq_, with_setup
+from auto_installation import util_result_index as uri
+
+
+class FakePipeline(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call(*args):
+            self.calls.append((name, args))
+            return self
+        return call
+
+    def execute(self):
+        calls, self.calls = self.calls, []
+        return [getattr(self.conn, name)(*args) for name, args in calls]
+
+
+class FakeRedis(object):
+    def __init__(self):
+        self.data = {}
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = str(value)
+        return True
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = value
+
+    def hdel(self, key, field):
+        self.data.get(key, {}).pop(field, None)
+
+    def hkeys(self, key):
+        return list(self.data.get(key, {}))
+
+    def hlen(self, key):
+        return len(self.data.get(key, {}))
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def sadd(self, key, *values):
+        self.data.setdefault(key, set()).update(values)
+
+    def srem(self, key, *values):
+        self.data.get(key, set()).difference_update(values)
+
+    def scard(self, key):
+        return len(self.data.get(key, set()))
+
+    def smembers(self, key):
+        return set(self.data.get(key, set()))
+
+    def sunion(self, *keys):
+        return set().union(*[self.smembers(k) for k in keys])
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1)
+
+    def zadd(self, key, score, member):
+        self.data.setdefault(key, {})[member] = score
+
+    def zrem(self, key, member):
+        self.data.get(key, {}).pop(member, None)
+
+    def zcount(self, key, lo, hi):
+        return len(self.zrevrangebyscore(key, hi, lo))
+
+    def zrevrangebyscore(self, key, hi, lo, start=None, num=None):
+        hi, lo = float(hi), float(lo)
+        members = self.data.get(key, {}).items()
+        ret = [m for m, score in sorted(members, key=lambda x: (x[1], x[0]),
+                                        reverse=True)
+               if lo <= score <= hi]
+        if start is not None:
+            ret = ret[start:start + num]
+        return ret
+
+
+def _add_run(date, time_, build, passed, title=''):
+    run_path = os.path.join(uri.LOGS_DIR, date, time_, build)
+    os.makedirs(os.path.join(run_path, 'ati_local_01.ks'))
+    with open(os.path.join(run_path, uri.FINAL_RESULTS), 'w') as fp:
+        json.dump({'sum': {'passed': passed, 'title': title}}, fp)
+    return run_path
+
+
+_logs_dir = uri.LOGS_DIR
+
+
+def setup_logs():
+    uri.LOGS_DIR = tempfile.mkdtemp() + '/'
+
+
+def teardown_logs():
+    shutil.rmtree(uri.LOGS_DIR)
+    uri.LOGS_DIR = _logs_dir
+
+
+@with_setup(setup_logs, teardown_logs)
+def test_logs_summary():
+    conn = FakeRedis()
+    _add_run('2017-06-01', '10-00-00', 'rhvh-4.1-20170531.0', 10)
+
+    eq_(uri.get_logs_summary(conn), {
+        '2017-06-01': {
+            '10-00-00__rhvh-4.1-20170531.0': [['ati_local_01.ks'], {
+                'passed': 10,
+                'title': ''
+            }]
+        }
+    })
+
+    # only the given run is parsed, the others are left alone
+    run_path = _add_run('2017-06-02', '11-00-00', 'rhvh-4.1-20170601.0', 3)
+    ok_(uri.index_run(conn, run_path))
+    ok_(not uri.index_run(conn, run_path))
+    uri.cache_logs_summary(run_path, conn=conn)
+
+    summary = uri.get_logs_summary(conn)
+    eq_(sorted(summary), ['2017-06-01', '2017-06-02'])
+    eq_(summary['2017-06-02']['11-00-00__rhvh-4.1-20170601.0'][1]['passed'],
+        3)
+
+
+@with_setup(setup_logs, teardown_logs)
+def test_query_logs_summary():
+    conn = FakeRedis()
+    _add_run('2017-06-01', '10-00-00', 'rhvh-4.1-20170531.0', 1,
+             '4_1_Node_Install_AutoTest_rhvh-4.1-20170531.0')
+    _add_run('2017-06-02', '10-00-00', 'rhvh-4.1-20170601.0', 2,
+             '4_1_Node_Vdsm_AutoTest_rhvh-4.1-20170601.0')
+    _add_run('2017-06-03', '10-00-00', 'rhvh-4.1-20170601.0', 3,
+             '4_1_Node_Install_AutoTest_rhvh-4.1-20170601.0')
+    version = uri.get_logs_summary_version(conn)
+
+    total, runs = uri.query_logs_summary(conn)
+    eq_(total, 3)
+    eq_([r['date'] for r in runs], ['2017-06-03', '2017-06-02', '2017-06-01'])
+    eq_(uri.get_logs_summary_version(conn), version + 3)
+
+    total, runs = uri.query_logs_summary(
+        conn, date_from='2017-06-02', date_to='2017-06-02')
+    eq_([r['sum']['passed'] for r in runs], [2])
+
+    total, runs = uri.query_logs_summary(conn, build='20170601')
+    eq_([r['sum']['passed'] for r in runs], [3, 2])
+
+    total, runs = uri.query_logs_summary(conn, test_flag='install', limit=1)
+    eq_(total, 2)
+    eq_([r['sum']['passed'] for r in runs], [3])
+    total, runs = uri.query_logs_summary(
+        conn, test_flag='install', page=2, limit=1)
+    eq_([r['run'] for r in runs], ['10-00-00__rhvh-4.1-20170531.0'])
+
+    eq_(uri.query_logs_summary(conn, build='nothing'), (0, []))
+
+    total, runs = uri.query_logs_summary(conn, page=2, limit=2)
+    eq_(total, 3)
+    eq_([r['date'] for r in runs], ['2017-06-01'])
+    total, runs = uri.query_logs_summary(
+        conn, build='20170601', test_flag='install', date_to='2017-06-02')
+    eq_((total, runs), (0, []))
+
+
+@with_setup(setup_logs, teardown_logs)
+def test_version_after_flush():
+    conn = FakeRedis()
+    _add_run('2017-06-01', '10-00-00', 'rhvh-4.1-20170531.0', 1)
+    uri.cache_logs_summary(conn=conn)
+    version = uri.get_logs_summary_version(conn)
+
+    # a restarted server flushes the index, its versions are all new
+    conn.data.clear()
+    time.sleep(0.01)
+    uri.ensure_logs_summary(conn)
+    ok_(uri.get_logs_summary_version(conn) > version)
+
+
+@with_setup(setup_logs, teardown_logs)
+def test_removed_runs():
+    conn = FakeRedis()
+    _add_run('2017-06-01', '10-00-00', 'rhvh-4.1-20170531.0', 1,
+             '4_1_Node_Install_AutoTest_rhvh-4.1-20170531.0')
+    run_path = _add_run('2017-06-02', '10-00-00', 'rhvh-4.1-20170601.0', 2,
+                        '4_1_Node_Install_AutoTest_rhvh-4.1-20170601.0')
+    uri.cache_logs_summary(conn=conn)
+    eq_(uri.query_logs_summary(conn)[0], 2)
+
+    version = uri.get_logs_summary_version(conn)
+    shutil.rmtree(os.path.dirname(os.path.dirname(run_path)))
+    uri.cache_logs_summary(conn=conn)
+    eq_(uri.get_logs_summary_version(conn), version + 1)
+    eq_(sorted(uri.get_logs_summary(conn)), ['2017-06-01'])
+    eq_(uri.query_logs_summary(conn, test_flag='install')[0], 1)
+    eq_(uri.query_logs_summary(conn, build='20170601'), (0, []))
+    eq_(conn.smembers(uri.BUILDS_KEY), set(['rhvh-4.1-20170531.0']))
@@ -1,4 +1,11 @@
+import os
+import json
 import time
+import shutil
+import logging
+import tempfile
+from nose.tools import eq_, raises
+from auto_installation import utils
 
 
 def ptime():
@@ -13,3 +20,126 @@ def ptime():
 
 
 ptime()
+
+TESTCASE_MAP = {
+    'RHEVM-1': ('ati_local_01.ks', 'host-01', 'install_check'),
+    'RHEVM-2': ('ati_local_01.ks', 'host-01', 'partition_check'),
+    'RHEVM-3': ('ati_local_01.ks', 'host-01', 'install_check'),
+    'RHEVM-4': ('ati_fc_01.ks', 'host-02', 'install_check'),
+}
+
+
+def test_testcase_index():
+    index = utils.TestcaseIndex.from_testcase_map(TESTCASE_MAP)
+    eq_(index.cases_of_ks('ati_local_01.ks'), ('RHEVM-1', 'RHEVM-2', 'RHEVM-3'))
+    eq_(index.cases_of_machine('host-02'), ('RHEVM-4', ))
+    eq_(index.cases_of_checkpoint('install_check'),
+        ('RHEVM-1', 'RHEVM-3', 'RHEVM-4'))
+    eq_(index.cases_of_ks('missing.ks'), ())
+    eq_(index.machine_of_ks('ati_fc_01.ks'), 'host-02')
+    eq_(index.machine_ksl_map(), {'host-01': ['ati_local_01.ks'],
+                                  'host-02': ['ati_fc_01.ks']})
+    eq_(index.checkpoint_cases_map('ati_local_01.ks', 'host-01'),
+        {'install_check': ['RHEVM-1', 'RHEVM-3'],
+         'partition_check': ['RHEVM-2']})
+    eq_(index.checkpoint_cases_map('ati_local_01.ks', 'host-02'), {})
+
+    # callers may change what they get back
+    index.checkpoint_cases_map('ati_fc_01.ks', 'host-02').pop('install_check')
+    eq_(index.checkpoint_cases_map('ati_fc_01.ks', 'host-02'),
+        {'install_check': ['RHEVM-4']})
+
+
+@raises(ValueError)
+def test_testcase_index_ks_on_two_machines():
+    testcase_map = dict(TESTCASE_MAP)
+    testcase_map['RHEVM-5'] = ('ati_fc_01.ks', 'host-01', 'install_check')
+    utils.TestcaseIndex.from_testcase_map(testcase_map)
+
+
+class FakePublisher(object):
+    def __init__(self):
+        self.published = []
+
+    def publish(self, channel, message):
+        self.published.append((channel, message))
+
+
+def test_job_log_publisher():
+    conn = FakePublisher()
+    publisher = utils.JobLogPublisher(conn)
+    record = logging.LogRecord('bender', logging.INFO, __file__, 1,
+                               'provisioning %s', ('host-01', ), None)
+
+    publisher.handle(record)
+    eq_(conn.published, [])
+
+    publisher.bind('job1', ident=record.thread)
+    publisher.handle(record)
+    eq_([(c, json.loads(m)) for c, m in conn.published],
+        [('job_events:job1',
+          dict(type='log', job='job1', line='provisioning host-01'))])
+    publisher.unbind(ident=record.thread)
+
+
+class FakeRedis(object):
+    def __init__(self, keys):
+        self.data = dict.fromkeys(keys, 'x')
+        self.expires = {}
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def execute(self):
+        pass
+
+    def scan_iter(self, count=None):
+        return iter(list(self.data))
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def expire(self, key, seconds):
+        self.expires[key] = seconds
+
+    def set(self, key, value, nx=False):
+        if not nx or key not in self.data:
+            self.data[key] = str(value)
+
+
+def test_setup_funcs():
+    conn = FakeRedis(['job:1', 'machine_lock:host-01', 'running',
+                      'logs_summary:dates'])
+    utils.setup_funcs(conn)
+    # an installer of a job before the restart still gets its kickstart
+    eq_(sorted(conn.data), ['job:1', 'running'])
+    eq_(conn.data['running'], '0')
+    eq_(conn.expires, {'job:1': utils.JOB_TTL})
+
+
+def test_log_tail():
+    tmp = tempfile.mkdtemp()
+    try:
+        log_file = os.path.join(tmp, 'results')
+        with open(log_file, 'w') as fp:
+            fp.write(''.join('line %d\n' % i for i in range(1000)))
+
+        tail = utils.LogTail(block_size=64)
+        eq_(tail.last_lines(log_file, 2), ['line 998\n', 'line 999\n'])
+        with open(log_file, 'a') as fp:
+            fp.write('line 1000\nline 10')
+        # only the appended bytes are read
+        eq_(tail.last_lines(log_file, 2), ['line 1000\n', 'line 10'])
+        eq_(tail.last_lines(log_file, 3)[0], 'line 999\n')
+
+        # the file is rotated
+        with open(log_file + '.new', 'w') as fp:
+            fp.write('new\n')
+        os.rename(log_file + '.new', log_file)
+        eq_(tail.last_lines(log_file, 3), ['new\n'])
+
+        eq_(tail.read(log_file, 1), ('ew\n', 4))
+        eq_(utils.get_lastline_of_file(log_file), 'new\n')
+        eq_(utils.get_lastline_of_file(os.path.join(tmp, 'missing')), '')
+    finally:
+        shutil.rmtree(tmp)